@@ -133,23 +133,23 @@ app_license = "bsl-1.0"
 # Scheduled Tasks
 # ---------------
 
-# scheduler_events = {
-# 	"all": [
-# 		"moodle_integration.tasks.all"
-# 	],
-# 	"daily": [
-# 		"moodle_integration.tasks.daily"
-# 	],
-# 	"hourly": [
-# 		"moodle_integration.tasks.hourly"
-# 	],
-# 	"weekly": [
-# 		"moodle_integration.tasks.weekly"
-# 	],
-# 	"monthly": [
-# 		"moodle_integration.tasks.monthly"
-# 	],
-# }
+scheduler_events = {
+	"all": [
+		"moodle_integration.scripts.moodle_scheduler.kick"
+	],
+	"hourly": [
+		"moodle_integration.scripts.moodle_calendar_sync.sync_all_calendars",
+		"moodle_integration.scripts.moodle_connection_analytics.rollup_connections"
+	],
+	"daily": [
+		"moodle_integration.scripts.moodle_cascade_delete.collect_orphans",
+		"moodle_integration.scripts.moodle_cohort_sync.sync_all_cohorts",
+		"moodle_integration.scripts.moodle_completion_sync.sync_all_completions",
+		"moodle_integration.scripts.moodle_quiz_sync.sync_all_quizzes",
+		"moodle_integration.scripts.moodle_enrollment_counters.verify_enrollment_counters",
+		"moodle_integration.scripts.moodle_connection_analytics.downsample_connections"
+	],
+}
 
 # Testing
 # -------
@@ -221,7 +221,8 @@ app_license = "bsl-1.0"
 # Automatically update python controller files with type annotations for this app.
 # export_python_type_annotations = True
 
-# default_log_clearing_doctypes = {
-# 	"Logging DocType Name": 30  # days to retain logs
-# }
+default_log_clearing_doctypes = {
+	"Moodle Sync Run": 30,
+	"Moodle Sync Profile": 30,
+}
 
@@ -0,0 +1,8 @@
+// Copyright (c) 2026, xappiens and contributors
+// For license information, please see license.txt
+
+// frappe.ui.form.on("Moodle Cohort", {
+// 	refresh(frm) {
+
+// 	},
+// });
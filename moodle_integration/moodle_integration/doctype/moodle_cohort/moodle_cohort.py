@@ -0,0 +1,10 @@
+# Copyright (c) 2026, xappiens and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class MoodleCohort(Document):
+	def on_trash(self):
+		frappe.db.delete("Moodle Cohort Member", {"member_cohort": self.name})
@@ -0,0 +1,14 @@
+# Copyright (c) 2026, xappiens and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class MoodleCohortMember(Document):
+	pass
+
+
+def on_doctype_update():
+	# Una fila por usuario y cohorte; el diff de miembros consulta por cohorte
+	frappe.db.add_unique("Moodle Cohort Member", ["member_cohort", "member_moodle_id"])
@@ -0,0 +1,14 @@
+# Copyright (c) 2026, xappiens and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class MoodleConnectionEvent(Document):
+	pass
+
+
+def on_doctype_update():
+	# Las consolidaciones y la retención recorren los eventos de una instancia por rango de fechas
+	frappe.db.add_index("Moodle Connection Event", ["connection_instance", "connection_time"])
@@ -0,0 +1,14 @@
+# Copyright (c) 2026, xappiens and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class MoodleConnectionRollup(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Moodle Connection Rollup", ["rollup_instance", "rollup_granularity", "rollup_period"])
+	frappe.db.add_index("Moodle Connection Rollup", ["rollup_course", "rollup_granularity", "rollup_period"])
@@ -1,9 +1,26 @@
 # Copyright (c) 2024, xappiens and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
+from moodle_integration.scripts.moodle_enrollment_counters import (
+	COURSE_PROTECTED_FIELDS,
+	remove_course_counters,
+	update_course_counters,
+)
 
 
 class MoodleCourse(Document):
-	pass
+	def before_save(self):
+		# Los totales se actualizan con sentencias directas: no pisarlos con los valores cargados en memoria
+		if not self.is_new():
+			self.update(frappe.db.get_value(
+				"Moodle Course", self.name, COURSE_PROTECTED_FIELDS, as_dict=True, for_update=True
+			) or {})
+
+	def on_update(self):
+		if self.has_value_changed("course_category"):
+			update_course_counters(self.name)
+
+	def on_trash(self):
+		remove_course_counters([self.name])
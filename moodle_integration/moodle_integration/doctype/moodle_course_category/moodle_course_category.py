@@ -1,9 +1,20 @@
 # Copyright (c) 2024, xappiens and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
+from moodle_integration.scripts.moodle_enrollment_counters import CATEGORY_PROTECTED_FIELDS, move_category_counters
 
 
 class MoodleCourseCategory(Document):
-	pass
+	def before_save(self):
+		# Los totales se actualizan con sentencias directas: no pisarlos con los valores cargados en memoria
+		if not self.is_new():
+			self.update(frappe.db.get_value(
+				"Moodle Course Category", self.name, CATEGORY_PROTECTED_FIELDS, as_dict=True, for_update=True
+			) or {})
+
+	def on_update(self):
+		previous = self.get_doc_before_save()
+		if previous and previous.coursecat_parent != self.coursecat_parent:
+			move_category_counters(self.name, previous.coursecat_parent, self.coursecat_parent)
@@ -0,0 +1,13 @@
+# Copyright (c) 2026, xappiens and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class MoodleCourseCompletion(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Moodle Course Completion", ["completion_course", "completion_completed"])
@@ -1,9 +1,15 @@
 # Copyright (c) 2024, xappiens and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 
 class MoodleEvent(Document):
 	pass
+
+
+def on_doctype_update():
+	# Consultas de los paneles: eventos de un curso o de un usuario en un rango de fechas
+	frappe.db.add_index("Moodle Event", ["event_course", "event_start"])
+	frappe.db.add_index("Moodle Event", ["event_user", "event_start"])
@@ -4,6 +4,16 @@
 # import frappe
 from frappe.model.document import Document
 
+from moodle_integration.scripts.moodle_gradebook import clear_gradebook_cache
+
 
 class MoodleGradeItem(Document):
-	pass
+	def on_update(self):
+		courses = {self.grade_item_course}
+		if before_save := self.get_doc_before_save():
+			courses.add(before_save.grade_item_course)
+		clear_gradebook_cache(filter(None, courses))
+
+	def on_trash(self):
+		if self.grade_item_course:
+			clear_gradebook_cache([self.grade_item_course])
@@ -1,9 +1,31 @@
 # Copyright (c) 2024, xappiens and contributors
 # For license information, please see license.txt
 
-# import frappe
+import ipaddress
+
+import frappe
 from frappe.model.document import Document
 
+from moodle_integration.scripts.moodle_rate_limiter import clear_instance_limits
+from moodle_integration.scripts.moodle_scheduler import clear_scheduling_settings, drop_instance_queues
+from moodle_integration.scripts.moodle_webhook_auth import clear_webhook_auth_cache
+
 
 class MoodleInstance(Document):
-	pass
+	def validate(self):
+		for ip in (self.webhook_allowed_ips or "").splitlines():
+			if not ip.strip():
+				continue
+			try:
+				ipaddress.ip_network(ip.strip(), strict=False)
+			except ValueError:
+				frappe.throw(f"IP o red no válida en IPs Permitidas: {ip.strip()}")
+
+	def on_update(self):
+		clear_instance_limits(self.name)
+		clear_scheduling_settings(self.name)
+		clear_webhook_auth_cache()
+
+	def on_trash(self):
+		clear_webhook_auth_cache()
+		drop_instance_queues(self.name)
@@ -0,0 +1,10 @@
+# Copyright (c) 2026, xappiens and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class MoodleQuiz(Document):
+	def on_trash(self):
+		frappe.db.delete("Moodle Quiz Attempt", {"attempt_quiz": self.name})
@@ -0,0 +1,14 @@
+# Copyright (c) 2026, xappiens and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class MoodleQuizAttempt(Document):
+	pass
+
+
+def on_doctype_update():
+	# Resultados de un estudiante en los cuestionarios de un curso
+	frappe.db.add_index("Moodle Quiz Attempt", ["attempt_user", "attempt_quiz"])
@@ -1,9 +1,20 @@
 # Copyright (c) 2025, xappiens and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
+from moodle_integration.scripts.moodle_gradebook import clear_gradebook_cache
+
 
 class MoodleStudentGrade(Document):
-	pass
+	def on_update(self):
+		self.clear_gradebook()
+
+	def on_trash(self):
+		self.clear_gradebook()
+
+	def clear_gradebook(self):
+		course = frappe.db.get_value("Moodle Grade Item", self.grade_item, "grade_item_course")
+		if course:
+			clear_gradebook_cache([course])
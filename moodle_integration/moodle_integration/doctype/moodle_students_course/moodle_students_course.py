@@ -1,9 +1,14 @@
 # Copyright (c) 2024, xappiens and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 
 class MoodleStudentsCourse(Document):
 	pass
+
+
+def on_doctype_update():
+	# Las consolidaciones de conexiones buscan los cursos de cada usuario que se conectó
+	frappe.db.add_index("Moodle Students Course", ["user_student", "parenttype"])
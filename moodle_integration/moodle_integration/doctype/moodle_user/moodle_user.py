@@ -4,6 +4,10 @@
 # import frappe
 from frappe.model.document import Document
 
+from moodle_integration.scripts.moodle_user_snapshot import clear_user_snapshot
+
 
 class MoodleUser(Document):
-	pass
+	def on_trash(self):
+		if self.user_instance:
+			clear_user_snapshot(self.user_instance, self.moodle_user_id)
@@ -1,9 +1,82 @@
 import frappe
-from urllib.parse import unquote, urlparse
 from datetime import datetime
 from moodle_integration.scripts.moodle_user_sync import process_moodle_user
 from moodle_integration.scripts.moodle_course_sync import process_moodle_course
 from moodle_integration.scripts.moodle_category_sync import process_moodle_category
+from moodle_integration.scripts.moodle_cohort_sync import process_moodle_cohort
+from moodle_integration.scripts.moodle_api import build_api_url
+from moodle_integration.scripts.moodle_dead_letter import record_failed_event
+from moodle_integration.scripts.moodle_entity_lock import EntityLock
+from moodle_integration.scripts.moodle_idempotency import claim_event, get_idempotency_key, release_event
+from moodle_integration.scripts.moodle_metrics import inc
+from moodle_integration.scripts.moodle_response_cache import get_invalidation_tags, invalidate_moodle_cache
+from moodle_integration.scripts.moodle_scheduler import enqueue_instance_event
+from moodle_integration.scripts.moodle_webhook_auth import authenticate_webhook
+
+# Veces que se repite una sincronización marcada como sucia mientras corría
+MAX_DIRTY_RERUNS = 3
+
+# Mapeo de acciones a handlers específicos
+ENTITY_MAPPING = {
+    "_course": {"key": "course_id", "handler": process_moodle_course},
+    "_category": {"key": "object_id", "handler": process_moodle_category},
+    "_user": {"key": "user_id", "handler": process_moodle_user},
+    "_cohort": {"key": "cohort_id", "handler": process_moodle_cohort},
+}
+
+
+def get_action_handler(action):
+    """
+    Detecta si la acción termina en `_user`, `_course`, `_category` o `_cohort` y devuelve su handler.
+    """
+    for entity, details in ENTITY_MAPPING.items():
+        if action.endswith(entity):
+            return details
+    return None
+
+
+def _call_handler(details, moodle_instance, action, entity_id):
+    return details["handler"](
+        moodle_instance_name=moodle_instance["name"],
+        **{details["key"]: entity_id},
+        api_url=build_api_url(moodle_instance["site_url"]),
+        token=moodle_instance["api_key"],
+        action=action
+    )
+
+
+def run_moodle_action(moodle_instance, action, entity_id):
+    """
+    Ejecuta el handler de la acción para una Moodle Instance ya resuelta
+    (dict con name, api_key y site_url).
+    Si la misma entidad ya se está sincronizando en otro worker no se espera: se marca
+    como sucia y ese worker la vuelve a sincronizar al terminar con la última acción recibida.
+    """
+    details = get_action_handler(action)
+    lock = EntityLock(moodle_instance["name"], details["key"], entity_id)
+
+    if not lock.acquire(action):
+        return {
+            "status": "deferred",
+            "message": "Sincronización en curso para esta entidad; se repetirá al terminar.",
+        }
+
+    try:
+        response = _call_handler(details, moodle_instance, action, entity_id)
+        for _ in range(MAX_DIRTY_RERUNS):
+            # El bloqueo solo se suelta si no quedó nada pendiente, en la misma operación
+            dirty_action = lock.release(keep_if_dirty=True)
+            if not dirty_action:
+                return response
+            response = _call_handler(get_action_handler(dirty_action), moodle_instance, dirty_action, entity_id)
+        return response
+    finally:
+        # Agotadas las repeticiones o si el handler falla, lo pendiente vuelve a la cola en vez de perderse
+        pending_action = lock.release()
+        if pending_action:
+            enqueue_instance_event(
+                moodle_instance["name"], pending_action, get_action_handler(pending_action)["key"], entity_id
+            )
 
 @frappe.whitelist(allow_guest=True)
 def handle_moodle_data(**kwargs):
@@ -13,6 +86,7 @@ def handle_moodle_data(**kwargs):
     """
 
     logs = []
+    idempotency_key = None
     
     try:
         # Leer datos JSON correctamente desde la solicitud
@@ -33,66 +107,81 @@ def handle_moodle_data(**kwargs):
             logs.append("[ERROR] No se proporcionó 'action'.")
             return {"status": "error", "message": "No se proporcionó 'action'.", "logs": logs}
 
-        # Procesar dominio de la URL de Moodle
-        domain = urlparse(unquote(moodle_url).rstrip("/")).netloc.replace("https://", "").replace("http://", "").strip("/")
-        logs.append(f"Dominio detectado: {domain}")
+        # Rechazar tráfico no autenticado sin tocar la base de datos
+        moodle_instance_name = authenticate_webhook(moodle_url, "handle_moodle_data")
+        if not moodle_instance_name:
+            logs.append("[ERROR] Webhook rechazado: instancia, IP o firma no válidas.")
+            return {"status": "error", "message": "Webhook no autorizado.", "logs": logs}
+
+        inc("moodle_webhooks_received_total", {"action": action})
+
+        # Descartar reintentos de Moodle de un evento ya recibido antes de tocar la base de datos
+        details = get_action_handler(action)
+        idempotency_key = get_idempotency_key(request_data, kwargs.get(details["key"]) if details else None)
+        if idempotency_key and not claim_event(idempotency_key):
+            inc("moodle_webhooks_duplicate_total", {"action": action})
+            logs.append("Evento ya recibido anteriormente, se ignora el reintento.")
+            return {"status": "duplicate", "message": "Evento ya recibido anteriormente.", "logs": logs}
 
-        # Obtener instancia de Moodle en una sola consulta SQL
+        # La instancia ya se resolvió por dominio al autenticar el webhook
         moodle_instance_data = frappe.db.sql("""
-            SELECT name, api_key, site_url 
-            FROM `tabMoodle Instance` 
-            WHERE LOWER(site_url) LIKE %s
-        """, (f"%{domain.lower()}%",), as_dict=True)
+            SELECT name, api_key, site_url, enqueue_webhooks
+            FROM `tabMoodle Instance`
+            WHERE name = %s
+        """, (moodle_instance_name,), as_dict=True)
 
         if not moodle_instance_data:
-            logs.append(f"[ERROR] No se encontró una Moodle Instance para el dominio: {domain}.")
-            return {"status": "error", "message": f"No se encontró una Moodle Instance para el dominio: {domain}.", "logs": logs}
+            logs.append(f"[ERROR] No se encontró la Moodle Instance {moodle_instance_name}.")
+            return {"status": "error", "message": f"No se encontró la Moodle Instance {moodle_instance_name}.", "logs": logs}
 
         moodle_instance = moodle_instance_data[0]
         logs.append(f"Instancia de Moodle encontrada: {moodle_instance['name']} ({moodle_instance['site_url']})")
 
-        api_url = f"https://{moodle_instance['site_url'].rstrip('/')}/webservice/rest/server.php"
-
-        # Mapeo de acciones a handlers específicos
-        entity_mapping = {
-            "_course": {"key": "course_id", "handler": process_moodle_course},
-            "_category": {"key": "object_id", "handler": process_moodle_category},
-            "_user": {"key": "user_id", "handler": process_moodle_user},
-        }
+        # Descartar respuestas cacheadas de Moodle afectadas por este evento, también los de
+        # grupos y roles, que no tienen handler propio
+        invalidate_moodle_cache(moodle_instance["name"], get_invalidation_tags(action, {**request_data, **kwargs}))
 
         # Determinar el script adecuado según la acción
-        for entity, details in entity_mapping.items():
-            if action.endswith(entity):  # Detecta si la acción termina en `_user`, `_course` o `_category`
-                entity_id = kwargs.get(details["key"])
-
-                if not entity_id:
-                    logs.append(f"Error: No se proporcionó '{details['key']}' en kwargs. Datos recibidos: {kwargs}")
-                    return {"status": "error", "message": f"No se proporcionó '{details['key']}'", "logs": logs}
-
-                logs.append(
-                    f"Llamando a {details['handler'].__name__} con: "
-                    f"moodle_instance={moodle_instance['name']}, {details['key']}={entity_id}, action={action}"
-                )
-
-                # Llamar a la función correspondiente con todos los datos correctos
-                response = details["handler"](
-                    moodle_instance_name=moodle_instance["name"],
-                    **{details["key"]: entity_id},
-                    api_url=api_url,
-                    token=moodle_instance["api_key"],
-                    action=action
+        if details:
+            entity_id = kwargs.get(details["key"])
+
+            if not entity_id:
+                logs.append(f"Error: No se proporcionó '{details['key']}' en kwargs. Datos recibidos: {kwargs}")
+                return {"status": "error", "message": f"No se proporcionó '{details['key']}'", "logs": logs}
+
+            # Instancias con cola propia: se procesa en segundo plano con reparto justo
+            if moodle_instance.get("enqueue_webhooks"):
+                enqueue_instance_event(moodle_instance["name"], action, details["key"], entity_id, payload=request_data)
+                logs.append(f"Evento encolado en la cola de {moodle_instance['name']}.")
+                return {"status": "queued", "message": "Evento encolado para su procesamiento.", "logs": logs}
+
+            logs.append(
+                f"Llamando a {details['handler'].__name__} con: "
+                f"moodle_instance={moodle_instance['name']}, {details['key']}={entity_id}, action={action}"
+            )
+
+            response = run_moodle_action(moodle_instance, action, entity_id)
+
+            logs.append(f"Respuesta de {details['handler'].__name__}: {response}")
+
+            # Guardar el evento fallido para poder reprocesarlo cuando Moodle se recupere
+            if response.get("status") == "error":
+                if idempotency_key:
+                    release_event(idempotency_key)
+                record_failed_event(
+                    moodle_instance["name"], action, details["key"], entity_id,
+                    payload=request_data, error=response.get("message"),
                 )
 
-                logs.append(f"Respuesta de {details['handler'].__name__}: {response}")
-
-                return {**response, "logs": logs}
-
+            return {**response, "logs": logs}
 
         logs.append(f"[ERROR] Acción '{action}' no reconocida.")
         return {"status": "error", "message": f"Acción '{action}' no reconocida.", "logs": logs}
 
     except Exception as e:
         error_message = str(e)
+        if idempotency_key:
+            release_event(idempotency_key)
         frappe.log_error(message=f"Error en handle_moodle_data: {error_message}", title="Error en handle_moodle_data")
         logs.append(f"[ERROR] {error_message}")
         return {"status": "error", "message": "Hubo un error al manejar los datos.", "error": error_message, "logs": logs}
@@ -0,0 +1,257 @@
+import frappe
+import time
+from frappe.utils import now_datetime
+from moodle_integration.scripts.moodle_redis import get_redis, make_key
+
+# Tasa de errores: ventana deslizante de ERROR_BUCKETS cubos de ERROR_BUCKET_SECONDS
+ERROR_BUCKET_SECONDS = 60
+ERROR_BUCKETS = 10
+ERROR_MIN_EVENTS = 20
+ERROR_OPEN_RATE = 0.5
+ERROR_CLOSE_RATE = 0.1
+
+# Latencia: media y varianza con media móvil exponencial por instancia y wsfunction
+LATENCY_ALPHA = 0.05
+LATENCY_MIN_SAMPLES = 30
+LATENCY_SIGMAS = 4
+# Por debajo de este valor (segundos) un pico no se considera incidencia
+LATENCY_MIN_SECONDS = 2
+# Picos (o muestras normales) consecutivos para abrir (o resolver) la incidencia
+LATENCY_CONSECUTIVE = 3
+
+# Reducción de matriculados: fracción perdida en una sincronización sobre un mínimo de estudiantes
+ROSTER_DROP = 0.5
+ROSTER_MIN_STUDENTS = 10
+
+DETECTOR_TTL = 7 * 24 * 3600
+
+INCIDENT_TYPES = {
+    "error_rate": "Tasa de Errores",
+    "latency": "Latencia",
+    "roster": "Reducción de Matriculados",
+}
+
+# Cada detector devuelve {transición, valor, umbral}: la transición es "open" solo al cruzar
+# el umbral y "resolve" solo al volver a la normalidad, así que las alertas repetidas no llegan
+# a la base de datos. Todos hacen un número fijo de operaciones por evento.
+ERROR_RATE_LUA = """
+local now, failed, width, buckets = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local slot = math.floor(now / width)
+local i = slot % buckets
+if tonumber(redis.call('HGET', KEYS[1], 's' .. i) or -1) ~= slot then
+    redis.call('HSET', KEYS[1], 's' .. i, slot, 't' .. i, 0, 'e' .. i, 0)
+end
+redis.call('HINCRBY', KEYS[1], 't' .. i, 1)
+redis.call('HINCRBY', KEYS[1], 'e' .. i, failed)
+
+local total, errors = 0, 0
+for j = 0, buckets - 1 do
+    local bucket = redis.call('HMGET', KEYS[1], 's' .. j, 't' .. j, 'e' .. j)
+    if bucket[1] and tonumber(bucket[1]) > slot - buckets then
+        total = total + tonumber(bucket[2])
+        errors = errors + tonumber(bucket[3])
+    end
+end
+
+local rate = errors / total
+local open = redis.call('HGET', KEYS[1], 'open') == '1'
+local transition = ''
+if not open and total >= tonumber(ARGV[5]) and rate >= tonumber(ARGV[6]) then
+    redis.call('HSET', KEYS[1], 'open', 1)
+    transition = 'open'
+elseif open and rate <= tonumber(ARGV[7]) then
+    redis.call('HSET', KEYS[1], 'open', 0)
+    transition = 'resolve'
+end
+redis.call('EXPIRE', KEYS[1], ARGV[8])
+return {transition, tostring(rate), ARGV[6]}
+"""
+
+LATENCY_LUA = """
+local x = tonumber(ARGV[1])
+local state = redis.call('HMGET', KEYS[1], 'n', 'mean', 'var', 'spikes', 'normals', 'open')
+local n, mean, var = tonumber(state[1] or 0), tonumber(state[2] or x), tonumber(state[3] or 0)
+local spikes, normals, open = tonumber(state[4] or 0), tonumber(state[5] or 0), state[6] == '1'
+
+local threshold = mean + tonumber(ARGV[4]) * math.sqrt(var)
+local outlier = n >= tonumber(ARGV[3]) and x > threshold
+if outlier and x > tonumber(ARGV[5]) then
+    spikes, normals = spikes + 1, 0
+else
+    spikes, normals = 0, normals + 1
+end
+
+local transition = ''
+if not open and spikes >= tonumber(ARGV[6]) then
+    open, transition = true, 'open'
+elseif open and normals >= tonumber(ARGV[6]) then
+    open, transition = false, 'resolve'
+end
+
+-- Las muestras atípicas entran en la línea base recortadas al umbral: un salto sostenido no
+-- sube su propio umbral antes de abrir la incidencia, aunque acaba siendo la nueva normalidad
+local sample = outlier and threshold or x
+local alpha = tonumber(ARGV[2])
+local diff = sample - mean
+mean = mean + alpha * diff
+var = (1 - alpha) * (var + diff * alpha * diff)
+
+redis.call('HSET', KEYS[1], 'n', n + 1, 'mean', tostring(mean), 'var', tostring(var),
+    'spikes', spikes, 'normals', normals, 'open', open and 1 or 0)
+redis.call('EXPIRE', KEYS[1], ARGV[7])
+return {transition, tostring(x), tostring(threshold)}
+"""
+
+ROSTER_LUA = """
+local previous, current, drop = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'open', 'baseline')
+local transition = ''
+local baseline = tonumber(state[2] or previous)
+if state[1] ~= '1' and previous >= tonumber(ARGV[4]) and current < previous * (1 - drop) then
+    redis.call('HSET', KEYS[1], 'open', 1, 'baseline', previous)
+    transition, baseline = 'open', previous
+elseif state[1] == '1' and current >= baseline * (1 - drop) then
+    redis.call('HSET', KEYS[1], 'open', 0)
+    transition = 'resolve'
+end
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return {transition, tostring(current), tostring(baseline)}
+"""
+
+
+def _run_detector(lua, detector, key_parts, args):
+    key = ":".join(str(part) for part in (detector, *key_parts))
+    transition, value, threshold = get_redis().register_script(lua)(
+        keys=[make_key(f"moodle_anomaly:{key}")], args=args
+    )
+    transition = transition.decode() if isinstance(transition, bytes) else transition
+    return key, transition, float(value), float(threshold)
+
+
+def _notify(detector, key, transition, value, threshold, **fields):
+    """
+    Las incidencias se escriben en un trabajo aparte: el detector se llama desde los handlers,
+    cuya transacción se deshace justamente cuando fallan, y no debe añadirles escrituras.
+    """
+    if not transition:
+        return
+    frappe.enqueue(
+        "moodle_integration.scripts.moodle_anomaly.update_incident",
+        queue="short",
+        incident_key=key,
+        transition=transition,
+        values={
+            "incident_type": INCIDENT_TYPES[detector],
+            "incident_value": value,
+            "incident_threshold": threshold,
+            **fields,
+        },
+        detected_on=now_datetime(),
+    )
+
+
+def record_outcome(moodle_instance_name, subject, failed):
+    """
+    Resultado de una sincronización (handler) o de una llamada a Moodle (wsfunction).
+    Los errores del detector nunca deben romper la sincronización, así que se ignoran.
+    """
+    if not moodle_instance_name:
+        return
+    try:
+        key, transition, rate, threshold = _run_detector(
+            ERROR_RATE_LUA,
+            "error_rate",
+            (moodle_instance_name, subject),
+            [time.time(), int(bool(failed)), ERROR_BUCKET_SECONDS, ERROR_BUCKETS, ERROR_MIN_EVENTS,
+             ERROR_OPEN_RATE, ERROR_CLOSE_RATE, DETECTOR_TTL],
+        )
+        _notify(
+            "error_rate", key, transition, rate, threshold,
+            incident_instance=moodle_instance_name,
+            incident_subject=subject,
+            incident_details=f"Tasa de errores de {subject} en los últimos {ERROR_BUCKETS * ERROR_BUCKET_SECONDS // 60} minutos: {rate:.0%}.",
+        )
+    except Exception:
+        pass
+
+
+def record_latency(moodle_instance_name, wsfunction, seconds):
+    if not moodle_instance_name:
+        return
+    try:
+        key, transition, latency, threshold = _run_detector(
+            LATENCY_LUA,
+            "latency",
+            (moodle_instance_name, wsfunction),
+            [seconds, LATENCY_ALPHA, LATENCY_MIN_SAMPLES, LATENCY_SIGMAS, LATENCY_MIN_SECONDS,
+             LATENCY_CONSECUTIVE, DETECTOR_TTL],
+        )
+        _notify(
+            "latency", key, transition, latency, threshold,
+            incident_instance=moodle_instance_name,
+            incident_subject=wsfunction,
+            incident_details=f"{wsfunction} tardó {latency:.2f} s (umbral {threshold:.2f} s) en {LATENCY_CONSECUTIVE} llamadas seguidas.",
+        )
+    except Exception:
+        pass
+
+
+def record_roster(moodle_instance_name, course_name, previous, current):
+    """
+    Compara los estudiantes de un curso antes y después de sincronizarlo.
+    """
+    try:
+        key, transition, students, baseline = _run_detector(
+            ROSTER_LUA,
+            "roster",
+            (course_name,),
+            [previous, current, ROSTER_DROP, ROSTER_MIN_STUDENTS, DETECTOR_TTL],
+        )
+        _notify(
+            "roster", key, transition, students, baseline,
+            incident_instance=moodle_instance_name,
+            incident_subject=course_name,
+            incident_course=course_name,
+            incident_details=f"El curso {course_name} pasó de {int(baseline)} a {int(students)} estudiantes.",
+        )
+    except Exception:
+        pass
+
+
+def update_incident(incident_key, transition, values, detected_on):
+    """
+    Abre o resuelve la Moodle Incidents de una clave. Si ya hay una abierta (p. ej. porque el
+    estado del detector caducó en Redis) se cuenta como una detección más en lugar de duplicarla.
+    """
+    open_incident = frappe.db.get_value(
+        "Moodle Incidents", {"incident_key": incident_key, "incident_status": "Abierta"}, "name"
+    )
+
+    if transition == "resolve":
+        if open_incident:
+            frappe.db.set_value("Moodle Incidents", open_incident, {
+                "incident_status": "Resuelta",
+                "incident_resolved_on": detected_on,
+                "incident_value": values.get("incident_value"),
+            })
+        return
+
+    if open_incident:
+        incident_doc = frappe.get_doc("Moodle Incidents", open_incident)
+        incident_doc.update({
+            **values,
+            "incident_last_seen": detected_on,
+            "incident_occurrences": (incident_doc.incident_occurrences or 0) + 1,
+        })
+        incident_doc.save(ignore_permissions=True)
+        return
+
+    frappe.get_doc({
+        "doctype": "Moodle Incidents",
+        "incident_key": incident_key,
+        "incident_status": "Abierta",
+        "incident_opened_on": detected_on,
+        "incident_last_seen": detected_on,
+        "incident_occurrences": 1,
+        **values,
+    }).insert(ignore_permissions=True)
@@ -0,0 +1,138 @@
+import time
+
+import httpx
+import requests
+
+from moodle_integration.scripts.moodle_anomaly import record_latency, record_outcome
+from moodle_integration.scripts.moodle_circuit_breaker import MoodleCircuitBreaker
+from moodle_integration.scripts.moodle_metrics import inc, observe
+from moodle_integration.scripts.moodle_profiler import get_active_profiler
+from moodle_integration.scripts.moodle_sync_run import get_active_sync_run
+from moodle_integration.scripts.moodle_rate_limiter import MoodleRateLimiter
+from moodle_integration.scripts.moodle_response_cache import get_cached_response, set_cached_response
+
+
+def build_api_url(site_url):
+    moodle_api_url = site_url.rstrip("/")
+    if not moodle_api_url.startswith(("http://", "https://")):
+        moodle_api_url = f"https://{moodle_api_url}"
+    return f"{moodle_api_url}/webservice/rest/server.php"
+
+
+def _record_call(labels, elapsed, status, size=0):
+    observe("moodle_rest_duration_seconds", elapsed, labels)
+    inc("moodle_rest_requests_total", {**labels, "status": status})
+    record_outcome(labels["instance"], labels["wsfunction"], status == "network_error" or status.startswith("5"))
+    if status != "network_error":
+        record_latency(labels["instance"], labels["wsfunction"], elapsed)
+
+    profiler = get_active_profiler()
+    if profiler:
+        profiler.record_rest(labels["wsfunction"], elapsed, size, status)
+
+    run = get_active_sync_run()
+    if run:
+        run.record_rest(size)
+
+
+def _cached_response(body):
+    response = requests.Response()
+    response.status_code = 200
+    response._content = body
+    response.encoding = "utf-8"
+    return response
+
+
+def moodle_request(moodle_instance_name, api_url, params, timeout=30, use_cache=True, session=None, method="GET"):
+    """
+    Punto único de salida hacia la API REST de Moodle.
+    Todas las sincronizaciones pasan por aquí para respetar los límites de la instancia
+    y fallar al instante mientras su circuit breaker esté abierto. Las funciones de solo
+    lectura que cambian poco se sirven desde la caché compartida (ver moodle_response_cache).
+    Con `session` (requests.Session) se reutilizan las conexiones entre peticiones.
+    Con method="POST" los parámetros van en el cuerpo, para llamadas que no caben en la URL.
+    """
+    if use_cache:
+        body = get_cached_response(moodle_instance_name, params)
+        if body is not None:
+            return _cached_response(body)
+
+    breaker = MoodleCircuitBreaker(moodle_instance_name)
+    breaker.before_request()
+    limiter = MoodleRateLimiter(moodle_instance_name)
+
+    labels = {"instance": moodle_instance_name, "wsfunction": params.get("wsfunction")}
+
+    with limiter.slot():
+        start = time.monotonic()
+        try:
+            if method == "POST":
+                response = (session or requests).post(api_url, data=params, timeout=timeout)
+            else:
+                response = (session or requests).get(api_url, params=params, timeout=timeout)
+        except requests.RequestException:
+            elapsed = time.monotonic() - start
+            limiter.record_response(elapsed * 1000, failed=True)
+            breaker.record_failure()
+            _record_call(labels, elapsed, "network_error")
+            raise
+
+        elapsed = time.monotonic() - start
+        failed = response.status_code >= 500
+        limiter.record_response(elapsed * 1000, failed=failed)
+
+    _record_call(labels, elapsed, str(response.status_code), len(response.content))
+
+    if failed:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+    if use_cache and response.status_code == 200 and b'"exception"' not in response.content[:200]:
+        set_cached_response(moodle_instance_name, params, response.content)
+
+    return response
+
+
+async def moodle_request_async(client, moodle_instance_name, api_url, params, timeout=30):
+    """
+    Versión asíncrona de moodle_request para el motor de sincronización masiva.
+    `client` es un httpx.AsyncClient compartido; aplica los mismos límites, circuit breaker
+    y métricas. Devuelve el JSON ya decodificado.
+    """
+    breaker = MoodleCircuitBreaker(moodle_instance_name)
+    breaker.before_request()
+    limiter = MoodleRateLimiter(moodle_instance_name)
+
+    labels = {"instance": moodle_instance_name, "wsfunction": params.get("wsfunction")}
+
+    async with limiter.async_slot():
+        start = time.monotonic()
+        try:
+            response = await client.get(api_url, params=params, timeout=timeout)
+        except httpx.HTTPError:
+            elapsed = time.monotonic() - start
+            limiter.record_response(elapsed * 1000, failed=True)
+            breaker.record_failure()
+            _record_call(labels, elapsed, "network_error")
+            raise
+
+        elapsed = time.monotonic() - start
+        failed = response.status_code >= 500
+        limiter.record_response(elapsed * 1000, failed=failed)
+
+    _record_call(labels, elapsed, str(response.status_code), len(response.content))
+
+    if failed:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+    if response.status_code != 200:
+        raise ValueError(f"Error al consultar {params.get('wsfunction')}: {response.status_code}")
+
+    data = response.json()
+    # Moodle devuelve los errores de la API con código 200 y una clave `exception`
+    if isinstance(data, dict) and data.get("exception"):
+        raise ValueError(f"Error de Moodle en {params.get('wsfunction')}: {data.get('message')}")
+    return data
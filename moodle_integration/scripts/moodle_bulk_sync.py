@@ -0,0 +1,281 @@
+import asyncio
+import frappe
+import httpx
+from frappe.utils import cint
+from moodle_integration.scripts.moodle_api import build_api_url, moodle_request_async
+from moodle_integration.scripts.moodle_child_rows import insert_child_rows
+from moodle_integration.scripts.moodle_enrollment_counters import update_course_counters
+from moodle_integration.scripts.moodle_course_sync import (
+    get_course_fields,
+    get_group_fields,
+    get_participant_fields,
+    get_participant_row,
+    get_user_type,
+)
+from moodle_integration.scripts.moodle_metrics import track_sync
+from moodle_integration.scripts.moodle_sync_run import track_progress, track_total
+from moodle_integration.scripts.moodle_user_snapshot import get_user_snapshot
+
+DEFAULT_CONCURRENCY = 8
+# Cursos por llamada a core_course_get_courses
+COURSE_CHUNK_SIZE = 50
+# Cursos por lote de escritura (un commit por lote)
+WRITE_BATCH_SIZE = 25
+# Usuarios por paso de escritura: entre paso y paso el bucle atiende las descargas
+USER_WRITE_CHUNK = 200
+
+
+@frappe.whitelist()
+def bulk_sync_courses(moodle_instance, course_ids=None, concurrency=None):
+    """
+    Encola la resincronización masiva de cursos de una Moodle Instance.
+    Sin `course_ids` se sincronizan todos los cursos de la instancia.
+    """
+    frappe.only_for("System Manager")
+
+    if isinstance(course_ids, str):
+        course_ids = frappe.parse_json(course_ids)
+
+    frappe.enqueue(
+        "moodle_integration.scripts.moodle_bulk_sync.run_bulk_course_sync",
+        queue="long",
+        timeout=6 * 3600,
+        moodle_instance_name=moodle_instance,
+        course_ids=course_ids,
+        concurrency=cint(concurrency) or None,
+    )
+    return {"status": "success", "message": "Sincronización masiva de cursos encolada."}
+
+
+@track_sync("bulk_course_sync")
+def run_bulk_course_sync(moodle_instance_name, course_ids=None, concurrency=None):
+    instance = frappe.db.get_value(
+        "Moodle Instance", moodle_instance_name, ["name", "api_key", "site_url", "max_concurrent_requests"], as_dict=True
+    )
+    if not instance:
+        return {"status": "error", "message": f"No se encontró la Moodle Instance {moodle_instance_name}."}
+
+    engine = BulkCourseSync(instance, concurrency or instance.max_concurrent_requests or DEFAULT_CONCURRENCY)
+    summary = asyncio.run(engine.run(course_ids))
+
+    message = (
+        f"Cursos sincronizados: {summary['written']} de {summary['courses']}, "
+        f"con errores: {len(summary['errors'])}."
+    )
+    if summary["errors"]:
+        frappe.log_error("\n".join(summary["errors"]), f"Sincronización masiva de cursos - {instance.name}")
+    return {"status": "success", "message": message, **summary}
+
+
+class BulkCourseSync:
+    """
+    Descarga en paralelo (asyncio + httpx) cursos, grupos y participantes de una instancia,
+    con concurrencia acotada y respetando el limitador de la instancia, y entrega los
+    resultados a un CourseBatchWriter que los escribe por lotes.
+    """
+
+    def __init__(self, instance, concurrency):
+        self.instance = instance
+        self.api_url = build_api_url(instance.site_url)
+        self.concurrency = concurrency
+        self.writer = CourseBatchWriter(instance.name)
+        self.errors = []
+
+    def params(self, wsfunction, **extra):
+        return {
+            "wstoken": self.instance.api_key,
+            "wsfunction": wsfunction,
+            "moodlewsrestformat": "json",
+            **extra,
+        }
+
+    async def fetch(self, client, params):
+        return await moodle_request_async(client, self.instance.name, self.api_url, params)
+
+    async def fetch_courses(self, client, course_ids=None):
+        if not course_ids:
+            courses = await self.fetch(client, self.params("core_course_get_courses"))
+            # El curso de portada de Moodle no es un curso real
+            return [course for course in courses if course.get("format") != "site"]
+
+        chunks = [course_ids[i:i + COURSE_CHUNK_SIZE] for i in range(0, len(course_ids), COURSE_CHUNK_SIZE)]
+        results = await asyncio.gather(*(
+            self.fetch(client, self.params(
+                "core_course_get_courses",
+                **{f"options[ids][{i}]": course_id for i, course_id in enumerate(chunk)},
+            ))
+            for chunk in chunks
+        ))
+        return [course for chunk in results for course in chunk]
+
+    async def fetch_course_members(self, client, semaphore, course, queue):
+        async with semaphore:
+            try:
+                groups, participants = await asyncio.gather(
+                    self.fetch(client, self.params("core_group_get_course_groups", courseid=course["id"])),
+                    self.fetch(client, self.params("core_enrol_get_enrolled_users", courseid=course["id"])),
+                )
+            except Exception as e:
+                self.errors.append(f"Curso {course['id']}: {str(e)}")
+                track_progress(skipped=1)
+                return
+
+        await queue.put((course, groups or [], participants or []))
+
+    async def write_results(self, queue):
+        while (item := await queue.get()) is not None:
+            self.writer.add(*item)
+            if len(self.writer.pending) >= WRITE_BATCH_SIZE:
+                await self.flush_writer()
+        await self.flush_writer()
+
+    async def flush_writer(self):
+        # La escritura es síncrona: se hace por pasos acotados (un curso o un bloque de usuarios)
+        # devolviendo el control al bucle entre ellos, para que las descargas en curso no se
+        # detengan durante todo el lote
+        try:
+            for _ in self.writer.flush_steps():
+                await asyncio.sleep(0)
+        except Exception as e:
+            self.errors.append(f"Lote de escritura: {str(e)}")
+
+    async def run(self, course_ids=None):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # Cola acotada: si la escritura va por detrás, las descargas esperan
+        queue = asyncio.Queue(maxsize=self.concurrency * 4)
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+
+        async with httpx.AsyncClient(limits=limits) as client:
+            courses = await self.fetch_courses(client, course_ids)
+            track_total(len(courses))
+
+            writer_task = asyncio.create_task(self.write_results(queue))
+            await asyncio.gather(*(
+                self.fetch_course_members(client, semaphore, course, queue) for course in courses
+            ))
+            await queue.put(None)
+            await writer_task
+
+        return {"courses": len(courses), "written": self.writer.written, "errors": self.errors}
+
+
+class CourseBatchWriter:
+    """
+    Escribe lotes de cursos descargados reutilizando el mapeo de campos de process_moodle_course.
+    Las búsquedas de cursos, grupos y usuarios existentes se hacen con una consulta por lote
+    y cada usuario se guarda una sola vez por sincronización aunque esté en varios cursos.
+    """
+
+    def __init__(self, moodle_instance_name):
+        self.moodle_instance_name = moodle_instance_name
+        self.pending = []
+        self.written = 0
+
+    def add(self, course, groups, participants):
+        self.pending.append((course, groups, participants))
+
+    def flush_steps(self):
+        """
+        Escribe el lote pendiente en una sola transacción, cediendo (yield) tras cada bloque de
+        usuarios y cada curso para que quien lo consume pueda intercalar otro trabajo.
+        """
+        if not self.pending:
+            return
+
+        batch, self.pending = self.pending, []
+        try:
+            user_types = {}
+            for course, groups, participants in batch:
+                for participant in participants:
+                    user_types[participant.get("username")] = (participant, get_user_type(participant))
+            usernames, user_names = list(user_types), {}
+            for i in range(0, len(usernames), USER_WRITE_CHUNK):
+                user_names.update(self.write_users({
+                    username: user_types[username] for username in usernames[i:i + USER_WRITE_CHUNK]
+                }))
+                yield
+
+            course_names = self.get_existing_courses([str(course["id"]) for course, _, _ in batch])
+            existing_groups = self.get_existing_groups(list(course_names.values()))
+            for course, groups, participants in batch:
+                self.write_course(course, groups, participants, course_names, existing_groups, user_names)
+                yield
+
+            frappe.db.commit()
+        except Exception:
+            frappe.db.rollback()
+            track_progress(skipped=len(batch))
+            raise
+
+        self.written += len(batch)
+        track_progress(written=len(batch))
+
+    def write_users(self, user_types):
+        # La caché de la sincronización evita volver a guardar usuarios de lotes anteriores
+        return get_user_snapshot(self.moodle_instance_name).save_users(self.moodle_instance_name, {
+            username: get_participant_fields(participant, self.moodle_instance_name, user_type)
+            for username, (participant, user_type) in user_types.items()
+        })
+
+    def get_existing_courses(self, course_ids):
+        return dict(frappe.get_all(
+            "Moodle Course",
+            filters={"course_instance": self.moodle_instance_name, "course_code": ["in", course_ids]},
+            fields=["course_code", "name"],
+            as_list=True,
+        ))
+
+    def get_existing_groups(self, course_names):
+        existing_groups = {}
+        if course_names:
+            for group in frappe.get_all(
+                "Moodle Course Group",
+                filters={"group_course": ["in", course_names]},
+                fields=["name", "group_course", "group_moodle_id"],
+            ):
+                existing_groups[(group.group_course, group.group_moodle_id)] = group.name
+        return existing_groups
+
+    def write_course(self, course, groups, participants, course_names, existing_groups, user_names):
+        course_id = str(course["id"])
+        if course_id in course_names:
+            course_doc = frappe.get_doc("Moodle Course", course_names[course_id])
+        else:
+            course_doc = frappe.new_doc("Moodle Course")
+            course_doc.update(get_course_fields(course, course_id, self.moodle_instance_name))
+            course_doc.insert(ignore_permissions=True, set_name=f"{self.moodle_instance_name} {course_id}")
+
+        group_mapping = {}
+        for group in groups:
+            group_id = str(group["id"])
+            group_key = (course_doc.name, group_id)
+            group_doc = (
+                frappe.get_doc("Moodle Course Group", existing_groups[group_key])
+                if group_key in existing_groups
+                else frappe.new_doc("Moodle Course Group")
+            )
+            group_doc.update(get_group_fields(group, course_doc.name, self.moodle_instance_name))
+            group_doc.save(ignore_permissions=True)
+            group_mapping[group_id] = group_doc.name
+
+        course_doc.update({
+            **get_course_fields(course, course_id, self.moodle_instance_name),
+            "course_students": [],
+            "course_teachers": [],
+            "course_groups": [{"course_group": name} for name in dict.fromkeys(group_mapping.values())],
+        })
+        course_doc.save(ignore_permissions=True)
+
+        participant_rows = {"course_students": [], "course_teachers": []}
+        for participant in participants:
+            table_field, row = get_participant_row(
+                participant, user_names[participant.get("username")], get_user_type(participant), group_mapping
+            )
+            participant_rows[table_field].append(row)
+        insert_child_rows(course_doc, participant_rows)
+        update_course_counters(
+            course_doc.name,
+            len(participant_rows["course_students"]),
+            len(participant_rows["course_teachers"]),
+            len(course_doc.course_groups),
+        )
@@ -0,0 +1,252 @@
+import frappe
+from datetime import datetime, timedelta
+from frappe.utils import add_days, cint, convert_system_tz_to_utc, convert_utc_to_system_timezone, get_datetime, now_datetime
+from moodle_integration.scripts.moodle_api import build_api_url, moodle_request
+from moodle_integration.scripts.moodle_metrics import track_sync
+from moodle_integration.scripts.moodle_sync_run import track_progress, track_total
+
+# Tamaño de cada ventana de tiempo y de cada página de cursos por llamada
+WINDOW_DAYS = 14
+COURSE_PAGE_SIZE = 50
+# La sincronización periódica vuelve a revisar los últimos días por si hubo cambios tardíos
+LOOKBACK_DAYS = 7
+DEFAULT_HORIZON_DAYS = 120
+UPSERT_CHUNK_SIZE = 500
+
+EVENT_FIELDS = (
+    "event_name", "event_type", "event_module", "event_instance", "event_moodle_id", "event_start",
+    "event_end", "event_modified_on", "event_course", "event_group", "event_user", "event_url",
+    "event_description",
+)
+
+
+def _from_unix(timestamp):
+    if not timestamp:
+        return None
+    return convert_utc_to_system_timezone(datetime.utcfromtimestamp(timestamp)).replace(tzinfo=None)
+
+
+def _to_unix(value):
+    # Las fechas sin zona son de la zona horaria del sistema de Frappe, no de la del servidor
+    return int(convert_system_tz_to_utc(get_datetime(value)).timestamp())
+
+
+def sync_all_calendars():
+    """
+    Tarea programada: encola la sincronización incremental de cada instancia con calendario activo.
+    """
+    for moodle_instance_name in frappe.get_all("Moodle Instance", filters={"sync_calendar": 1}, pluck="name"):
+        frappe.enqueue(
+            "moodle_integration.scripts.moodle_calendar_sync.sync_calendar_events",
+            queue="long",
+            timeout=3600,
+            job_id=f"moodle_calendar_sync:{moodle_instance_name}",
+            deduplicate=True,
+            moodle_instance_name=moodle_instance_name,
+        )
+
+
+@frappe.whitelist()
+def sync_calendar(moodle_instance, from_date=None, to_date=None):
+    """
+    Encola la sincronización del calendario de una instancia, p. ej. de un curso académico completo.
+    """
+    frappe.only_for("System Manager")
+    frappe.enqueue(
+        "moodle_integration.scripts.moodle_calendar_sync.sync_calendar_events",
+        queue="long",
+        timeout=6 * 3600,
+        moodle_instance_name=moodle_instance,
+        from_date=from_date,
+        to_date=to_date,
+    )
+    return {"status": "success", "message": "Sincronización del calendario encolada."}
+
+
+@track_sync("calendar_sync")
+def sync_calendar_events(moodle_instance_name, from_date=None, to_date=None):
+    instance = frappe.db.get_value(
+        "Moodle Instance",
+        moodle_instance_name,
+        ["name", "api_key", "site_url", "calendar_horizon_days", "calendar_watermark"],
+        as_dict=True,
+    )
+    if not instance:
+        return {"status": "error", "message": f"No se encontró la Moodle Instance {moodle_instance_name}."}
+
+    start = get_datetime(from_date) if from_date else add_days(now_datetime(), -LOOKBACK_DAYS)
+    end = get_datetime(to_date) if to_date else add_days(now_datetime(), instance.calendar_horizon_days or DEFAULT_HORIZON_DAYS)
+
+    sync = CalendarSync(instance)
+    windows = []
+    while start < end:
+        windows.append((start, min(start + timedelta(days=WINDOW_DAYS), end)))
+        start = windows[-1][1]
+    track_total(len(windows) * max(len(sync.course_pages), 1))
+
+    for window_start, window_end in windows:
+        sync.sync_window(window_start, window_end)
+        frappe.db.commit()
+
+    if sync.watermark > cint(instance.calendar_watermark):
+        frappe.db.set_value("Moodle Instance", instance.name, "calendar_watermark", sync.watermark)
+
+    message = f"Eventos escritos: {sync.written}, sin cambios: {sync.unchanged}, eliminados: {sync.deleted}."
+    return {"status": "success", "message": message}
+
+
+class CalendarSync:
+    """
+    Descarga los eventos del calendario por ventanas de tiempo y páginas de cursos con
+    core_calendar_get_calendar_events y los inserta o actualiza en bloque. Solo se escriben
+    los eventos nuevos o modificados en Moodle después de la marca de agua de la instancia.
+
+    La API no permite pedir solo los eventos modificados desde una fecha, así que cada pasada
+    descarga todo el rango: la marca de agua ahorra escrituras, no llamadas a Moodle.
+    """
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.api_url = build_api_url(instance.site_url)
+        self.watermark = cint(instance.calendar_watermark)
+        self.previous_watermark = self.watermark
+        self.written = self.unchanged = self.deleted = 0
+
+        self.courses = dict(frappe.get_all(
+            "Moodle Course", filters={"course_instance": instance.name}, fields=["course_code", "name"], as_list=True
+        ))
+        course_ids = sorted(self.courses)
+        self.course_pages = [
+            course_ids[i:i + COURSE_PAGE_SIZE] for i in range(0, len(course_ids), COURSE_PAGE_SIZE)
+        ]
+        self.groups = dict(frappe.get_all(
+            "Moodle Course Group", filters={"group_instance": instance.name}, fields=["group_moodle_id", "name"], as_list=True
+        ))
+
+    def fetch_events(self, window_start, window_end, course_ids):
+        params = {
+            "wstoken": self.instance.api_key,
+            "wsfunction": "core_calendar_get_calendar_events",
+            "moodlewsrestformat": "json",
+            "options[userevents]": 1,
+            "options[siteevents]": 1,
+            "options[ignorehidden]": 1,
+            "options[timestart]": _to_unix(window_start),
+            "options[timeend]": _to_unix(window_end),
+            **{f"events[courseids][{i}]": course_id for i, course_id in enumerate(course_ids)},
+        }
+        response = moodle_request(self.instance.name, self.api_url, params, timeout=120)
+        if response.status_code != 200:
+            raise ValueError(f"Error al consultar eventos del calendario: {response.status_code}")
+        data = response.json()
+        if data.get("exception"):
+            raise ValueError(data.get("message") or data["exception"])
+        return data.get("events", [])
+
+    def sync_window(self, window_start, window_end):
+        events = {}
+        for course_ids in self.course_pages or [[]]:
+            for event in self.fetch_events(window_start, window_end, course_ids):
+                events[f"{self.instance.name} {event['id']}"] = event
+            track_progress(written=1)
+
+        existing = set(frappe.get_all(
+            "Moodle Event",
+            filters={"event_instance": self.instance.name, "event_start": ["between", [window_start, window_end]]},
+            pluck="name",
+        ))
+        changed = {}
+        for name, event in events.items():
+            modified = cint(event.get("timemodified"))
+            self.watermark = max(self.watermark, modified)
+            if name in existing and modified <= self.previous_watermark:
+                self.unchanged += 1
+            else:
+                changed[name] = event
+
+        user_ids = {str(event["userid"]) for event in changed.values() if event.get("eventtype") == "user" and event.get("userid")}
+        users = dict(frappe.get_all(
+            "Moodle User",
+            filters={"user_instance": self.instance.name, "user_id": ["in", list(user_ids)]},
+            fields=["user_id", "name"],
+            as_list=True,
+        )) if user_ids else {}
+        self.upsert([(name, self.get_event_fields(event, users)) for name, event in changed.items()])
+
+        # Eventos que estaban en la ventana y ya no existen en Moodle
+        vanished = list(existing - set(events))
+        if vanished:
+            frappe.db.delete("Moodle Event", {"name": ["in", vanished]})
+            self.deleted += len(vanished)
+
+    def get_event_fields(self, event, users):
+        start = _from_unix(event.get("timestart"))
+        return {
+            "event_name": event.get("name"),
+            "event_type": event.get("eventtype"),
+            "event_module": event.get("modulename"),
+            "event_instance": self.instance.name,
+            "event_moodle_id": str(event["id"]),
+            "event_start": start,
+            "event_end": start + timedelta(seconds=cint(event.get("timeduration"))) if start else None,
+            "event_modified_on": cint(event.get("timemodified")),
+            "event_course": self.courses.get(str(event.get("courseid"))),
+            "event_group": self.groups.get(str(event.get("groupid"))) if event.get("groupid") else None,
+            "event_user": users.get(str(event.get("userid"))) if event.get("eventtype") == "user" else None,
+            "event_url": event.get("url"),
+            "event_description": event.get("description"),
+        }
+
+    def upsert(self, rows):
+        """
+        INSERT ... ON DUPLICATE KEY UPDATE por bloques: el nombre del evento es
+        "{instancia} {id en Moodle}", así que un mismo evento siempre cae en la misma fila.
+        """
+        timestamp, user = now_datetime(), frappe.session.user
+        columns = ("name", "creation", "modified", "owner", "modified_by", "docstatus", "idx", *EVENT_FIELDS)
+        updates = ", ".join(f"`{column}` = VALUES(`{column}`)" for column in ("modified", "modified_by", *EVENT_FIELDS))
+
+        for i in range(0, len(rows), UPSERT_CHUNK_SIZE):
+            chunk = rows[i:i + UPSERT_CHUNK_SIZE]
+            placeholders = ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(chunk))
+            values = [
+                value
+                for name, fields in chunk
+                for value in (name, timestamp, timestamp, user, user, 0, 0, *(fields[field] for field in EVENT_FIELDS))
+            ]
+            frappe.db.sql(f"""
+                INSERT INTO `tabMoodle Event` ({", ".join(f"`{column}`" for column in columns)})
+                VALUES {placeholders}
+                ON DUPLICATE KEY UPDATE {updates}
+            """, values)
+            self.written += len(chunk)
+
+
+@frappe.whitelist()
+def get_deadlines(from_date, to_date, course=None, user=None, event_types=None):
+    """
+    Eventos del calendario en un rango de fechas, de un curso o de un usuario (sus eventos
+    personales y los de sus cursos), sin consultar Moodle.
+    """
+    frappe.has_permission("Moodle Event", "read", throw=True)
+
+    filters = {"event_start": ["between", [from_date, to_date]]}
+    if event_types:
+        filters["event_type"] = ["in", frappe.parse_json(event_types) if isinstance(event_types, str) else event_types]
+
+    or_filters = None
+    if course:
+        filters["event_course"] = course
+    elif user:
+        user_courses = frappe.get_all(
+            "Moodle User Course", filters={"parent": user, "parenttype": "Moodle User"}, pluck="user_course"
+        )
+        or_filters = {"event_user": user, "event_course": ["in", user_courses or [""]]}
+
+    return frappe.get_all(
+        "Moodle Event",
+        filters=filters,
+        or_filters=or_filters,
+        fields=["name", "event_name", "event_type", "event_module", "event_start", "event_end", "event_course", "event_user", "event_url"],
+        order_by="event_start asc",
+    )
@@ -0,0 +1,162 @@
+import frappe
+from moodle_integration.scripts.moodle_enrollment_counters import remove_category_counters, remove_course_counters
+from moodle_integration.scripts.moodle_gradebook import clear_gradebook_cache
+
+# Tablas hijas de Moodle Course
+COURSE_CHILD_TABLES = (
+    "Moodle Teachers Course",
+    "Moodle Students Course",
+    "Moodle Course Group Groups",
+    "Moodle Course Grade Item",
+)
+
+# Filas que quedan huérfanas cuando desaparece el documento al que apuntan:
+# (doctype, campo, doctype destino, parenttype de las filas hijas o None)
+ORPHAN_RULES = (
+    ("Moodle Course Group", "group_course", "Moodle Course", None),
+    ("Moodle Grade Item", "grade_item_course", "Moodle Course", None),
+    ("Moodle Student Grade", "grade_item", "Moodle Grade Item", None),
+    *((child, "parent", "Moodle Course", "Moodle Course") for child in COURSE_CHILD_TABLES),
+    ("Moodle Course Group Groups", "course_group", "Moodle Course Group", None),
+    ("Moodle User Course", "user_course", "Moodle Course", None),
+    ("Moodle Course Category Courses", "coursecat_course", "Moodle Course", None),
+    ("Moodle Course Category Subcategories", "coursecat_subcat", "Moodle Course Category", None),
+    ("Moodle Cohort Member", "member_cohort", "Moodle Cohort", None),
+    ("Moodle Course Completion", "completion_course", "Moodle Course", None),
+    ("Moodle Quiz", "quiz_course", "Moodle Course", None),
+    ("Moodle Quiz Attempt", "attempt_quiz", "Moodle Quiz", None),
+    ("Moodle Connection Rollup", "rollup_course", "Moodle Course", None),
+    ("Moodle Event", "event_course", "Moodle Course", None),
+    ("Moodle Event", "event_group", "Moodle Course Group", None),
+)
+ORPHAN_BATCH_SIZE = 1000
+
+
+def delete_courses(course_names):
+    """
+    Elimina cursos con sus grupos, filas hijas, calificaciones, cuestionarios, finalización, eventos y las filas
+    que los referencian desde usuarios y categorías, con una sentencia por tabla en lugar de
+    pasar por frappe.delete_doc documento a documento. Todo o nada: si algo falla se
+    deshace hasta el punto de guardado.
+    """
+    if not course_names:
+        return
+    courses = tuple(course_names)
+
+    frappe.db.savepoint("moodle_delete_courses")
+    try:
+        remove_course_counters(courses)
+        frappe.db.sql("""
+            DELETE FROM `tabMoodle Student Grade`
+            WHERE grade_item IN (
+                SELECT name FROM `tabMoodle Grade Item` WHERE grade_item_course IN %(courses)s
+            )
+        """, {"courses": courses})
+        frappe.db.delete("Moodle Grade Item", {"grade_item_course": ["in", courses]})
+
+        frappe.db.sql("""
+            DELETE FROM `tabMoodle Course Group Groups`
+            WHERE course_group IN (
+                SELECT name FROM `tabMoodle Course Group` WHERE group_course IN %(courses)s
+            )
+        """, {"courses": courses})
+        frappe.db.delete("Moodle Course Group", {"group_course": ["in", courses]})
+
+        for child_doctype in COURSE_CHILD_TABLES:
+            frappe.db.delete(child_doctype, {"parenttype": "Moodle Course", "parent": ["in", courses]})
+
+        frappe.db.delete("Moodle Course Completion", {"completion_course": ["in", courses]})
+        frappe.db.sql("""
+            DELETE FROM `tabMoodle Quiz Attempt`
+            WHERE attempt_quiz IN (
+                SELECT name FROM `tabMoodle Quiz` WHERE quiz_course IN %(courses)s
+            )
+        """, {"courses": courses})
+        frappe.db.delete("Moodle Quiz", {"quiz_course": ["in", courses]})
+        frappe.db.delete("Moodle Event", {"event_course": ["in", courses]})
+        frappe.db.delete("Moodle User Course", {"user_course": ["in", courses]})
+        frappe.db.delete("Moodle Course Category Courses", {"coursecat_course": ["in", courses]})
+        frappe.db.delete("Moodle Course", {"name": ["in", courses]})
+    except Exception:
+        frappe.db.rollback(save_point="moodle_delete_courses")
+        raise
+
+    clear_gradebook_cache(courses)
+
+
+def get_category_tree(category_name):
+    """
+    Devuelve la categoría y todas sus subcategorías, con una consulta por nivel.
+    """
+    tree, level = [category_name], [category_name]
+    while level:
+        level = frappe.get_all(
+            "Moodle Course Category",
+            filters={"coursecat_parent": ["in", level], "name": ["not in", tree]},
+            pluck="name",
+        )
+        tree.extend(level)
+    return tree
+
+
+def delete_category(category_name):
+    """
+    Elimina una categoría con todas sus subcategorías y las filas que las referencian.
+    Los cursos no se borran: en Moodle sus cursos se eliminan (y llega un delete_course por
+    cada uno) o se mueven a otra categoría antes de borrarla, así que solo se desvinculan.
+    """
+    categories = tuple(get_category_tree(category_name))
+
+    frappe.db.savepoint("moodle_delete_category")
+    try:
+        remove_category_counters(categories)
+        frappe.db.sql("""
+            UPDATE `tabMoodle Course` SET course_category = NULL
+            WHERE course_category IN %(categories)s
+        """, {"categories": categories})
+        frappe.db.delete("Moodle Course Category Subcategories", {"coursecat_subcat": ["in", categories]})
+        frappe.db.delete("Moodle Course Category Subcategories", {"parent": ["in", categories]})
+        frappe.db.delete("Moodle Course Category Courses", {"parent": ["in", categories]})
+        frappe.db.delete("Moodle Course Category", {"name": ["in", categories]})
+    except Exception:
+        frappe.db.rollback(save_point="moodle_delete_category")
+        raise
+
+    return categories
+
+
+def collect_orphans(batch_size=ORPHAN_BATCH_SIZE):
+    """
+    Tarea programada: elimina por lotes las filas que apuntan a cursos, grupos, categorías
+    o elementos de calificación que ya no existen (restos de borrados anteriores a la
+    eliminación en cascada). Se confirma cada lote para no bloquear las tablas.
+    """
+    summary = {}
+    for doctype, fieldname, target, parenttype in ORPHAN_RULES:
+        deleted = 0
+        while True:
+            names = frappe.db.sql(f"""
+                SELECT t.name FROM `tab{doctype}` t
+                LEFT JOIN `tab{target}` p ON p.name = t.`{fieldname}`
+                WHERE IFNULL(t.`{fieldname}`, '') != '' AND p.name IS NULL
+                {"AND t.parenttype = %(parenttype)s" if parenttype else ""}
+                LIMIT %(batch_size)s
+            """, {"parenttype": parenttype, "batch_size": batch_size}, pluck=True)
+            if not names:
+                break
+
+            frappe.db.delete(doctype, {"name": ["in", names]})
+            frappe.db.commit()
+            deleted += len(names)
+            if len(names) < batch_size:
+                break
+
+        if deleted:
+            summary[f"{doctype}.{fieldname}"] = deleted
+
+    if summary:
+        frappe.log_error(
+            "\n".join(f"{key}: {count}" for key, count in summary.items()),
+            "Limpieza de registros huérfanos de Moodle",
+        )
+    return summary
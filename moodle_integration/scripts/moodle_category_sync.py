@@ -1,12 +1,27 @@
 import frappe
-import requests
+from moodle_integration.scripts.moodle_api import moodle_request
+from moodle_integration.scripts.moodle_cascade_delete import delete_category
+from moodle_integration.scripts.moodle_metrics import track_sync
+from moodle_integration.scripts.moodle_sync_run import track_progress, track_total
 
 @frappe.whitelist(allow_guest=True)
-def process_moodle_category(moodle_instance_name, category_id, api_url, token):
+@track_sync("process_moodle_category")
+def process_moodle_category(moodle_instance_name, category_id=None, api_url=None, token=None, action=None, object_id=None):
+    # Los webhooks envían el ID de la categoría como object_id
+    category_id = category_id or object_id
     logs = []
     try:
         logs.append(f"Iniciando sincronización para la categoría {category_id} en {moodle_instance_name}.")
 
+        if action == "delete_category":
+            category_identifier = f"{moodle_instance_name} {category_id}"
+            if frappe.db.exists("Moodle Course Category", category_identifier):
+                deleted = delete_category(category_identifier)
+                logs.append(f"Categoría {category_identifier} eliminada junto con {len(deleted) - 1} subcategorías.")
+            else:
+                logs.append(f"La categoría {category_identifier} no existe en ERPNext, no es necesario eliminarla.")
+            return {"status": "success", "message": "Proceso de eliminación completado.", "logs": logs}
+
         # Paso 1: Obtener información de la categoría desde Moodle
         category_params = {
             "wstoken": token,
@@ -15,7 +30,7 @@ def process_moodle_category(moodle_instance_name, category_id, api_url, token):
             "criteria[0][key]": "id",
             "criteria[0][value]": category_id
         }
-        category_response = requests.get(api_url, params=category_params, timeout=30)
+        category_response = moodle_request(moodle_instance_name, api_url, category_params)
         if category_response.status_code != 200:
             raise ValueError(f"Error al consultar la categoría: {category_response.status_code}")
         category_data = category_response.json()
@@ -87,10 +102,11 @@ def process_moodle_category(moodle_instance_name, category_id, api_url, token):
             "criteria[0][key]": "parent",
             "criteria[0][value]": category_id
         }
-        subcategories_response = requests.get(api_url, params=subcategories_params, timeout=30)
+        subcategories_response = moodle_request(moodle_instance_name, api_url, subcategories_params)
         if subcategories_response.status_code != 200:
             raise ValueError(f"Error al consultar subcategorías: {subcategories_response.status_code}")
         subcategories_data = subcategories_response.json()
+        track_total(len(subcategories_data))
 
         for subcategory in subcategories_data:
             subcat_id = str(subcategory.get("id"))
@@ -118,8 +134,10 @@ def process_moodle_category(moodle_instance_name, category_id, api_url, token):
                 subcat_doc.save(ignore_permissions=True)
                 category_doc.append("coursecat_subcat", {"coursecat_subcat": subcat_doc.name})
                 logs.append(f"Subcategoría sincronizada: {subcat_name}.")
+                track_progress(written=1)
             else:
                 logs.append(f"Subcategoría {subcat_name} (ID: {subcat_id}) omitida: no puede asociarse a sí misma como padre.")
+                track_progress(skipped=1)
 
         category_doc.save(ignore_permissions=True)
         logs.append("Sincronización de subcategorías completada.")
@@ -133,10 +151,11 @@ def process_moodle_category(moodle_instance_name, category_id, api_url, token):
             "field": "category",
             "value": category_id
         }
-        courses_response = requests.get(api_url, params=courses_params, timeout=30)
+        courses_response = moodle_request(moodle_instance_name, api_url, courses_params)
         if courses_response.status_code != 200:
             raise ValueError(f"Error al consultar cursos: {courses_response.status_code}")
         courses_data = courses_response.json().get("courses", [])
+        track_total(len(courses_data))
 
         for course in courses_data:
             course_id = str(course.get("id"))
@@ -147,8 +166,10 @@ def process_moodle_category(moodle_instance_name, category_id, api_url, token):
                 course_doc.update({"course_category": category_doc.name})
                 course_doc.save(ignore_permissions=True)
                 logs.append(f"Curso actualizado: {course_doc.course_name}.")
+                track_progress(written=1)
             else:
                 logs.append(f"Curso con ID {course_id} no encontrado en ERPNext. Omitiendo.")
+                track_progress(skipped=1)
 
         logs.append("Sincronización completa para la categoría.")
         frappe.log_error("\n".join(logs), f"Sincronización de Categoría {category_id}")
@@ -0,0 +1,93 @@
+import frappe
+from frappe.model import no_value_fields
+from frappe.utils import now
+
+
+def validate_child_links(child_meta, rows):
+    """
+    Valida los campos Link de las filas con una consulta IN por doctype destino, en lugar
+    de una por fila como hace Document.save, y rellena los campos con fetch_from.
+    """
+    link_fields = {}
+    for df in child_meta.get_link_fields():
+        link_fields.setdefault(df.options, []).append(df)
+
+    for target_doctype, fields in link_fields.items():
+        values = {row[df.fieldname] for df in fields for row in rows if row.get(df.fieldname)}
+        if not values:
+            continue
+
+        fetch_fields = [
+            (df.fieldname, df.fetch_from.split(".", 1), df.fetch_if_empty)
+            for df in child_meta.fields
+            if df.fetch_from and df.fetch_from.split(".", 1)[0] in {link.fieldname for link in fields}
+        ]
+        found = {
+            target.name: target
+            for target in frappe.get_all(
+                target_doctype,
+                filters={"name": ["in", list(values)]},
+                fields=["name", *{source for _, (_, source), _ in fetch_fields}],
+            )
+        }
+
+        missing = values - set(found)
+        if missing:
+            frappe.throw(
+                f"No se encontró {target_doctype}: {', '.join(sorted(missing))}",
+                frappe.LinkValidationError,
+            )
+
+        for row in rows:
+            for fieldname, (link_fieldname, source), fetch_if_empty in fetch_fields:
+                target = found.get(row.get(link_fieldname))
+                if target and not (fetch_if_empty and row.get(fieldname)):
+                    row[fieldname] = target.get(source)
+
+
+def insert_child_rows(parent_doc, tables):
+    """
+    Sustituye las filas de las tablas hijas indicadas ({parentfield: [filas]}) de un documento
+    ya guardado con un INSERT masivo por tabla. Conserva el orden de las filas en `idx` y deja
+    las filas en parent_doc como si se hubiera guardado con save().
+    """
+    timestamp, user = now(), frappe.session.user
+
+    for parentfield, rows in tables.items():
+        child_doctype = parent_doc.meta.get_field(parentfield).options
+        child_meta = frappe.get_meta(child_doctype)
+        fieldnames = [df.fieldname for df in child_meta.fields if df.fieldtype not in no_value_fields]
+
+        # Como en save(), se ignoran las claves que no son campos de la tabla hija
+        rows = [{fieldname: row.get(fieldname) for fieldname in fieldnames} for row in rows]
+        validate_child_links(child_meta, rows)
+
+        for idx, row in enumerate(rows, start=1):
+            row.update({
+                "name": frappe.generate_hash(length=10),
+                "creation": timestamp,
+                "modified": timestamp,
+                "owner": user,
+                "modified_by": user,
+                "docstatus": 0,
+                "parent": parent_doc.name,
+                "parenttype": parent_doc.doctype,
+                "parentfield": parentfield,
+                "idx": idx,
+            })
+
+        frappe.db.delete(child_doctype, {
+            "parent": parent_doc.name,
+            "parenttype": parent_doc.doctype,
+            "parentfield": parentfield,
+        })
+        if rows:
+            columns = list(rows[0])
+            frappe.db.bulk_insert(child_doctype, columns, [[row[column] for column in columns] for row in rows])
+
+        parent_doc.set(parentfield, rows)
+
+    frappe.db.set_value(
+        parent_doc.doctype, parent_doc.name, {"modified": timestamp, "modified_by": user}, update_modified=False
+    )
+    parent_doc.modified, parent_doc.modified_by = timestamp, user
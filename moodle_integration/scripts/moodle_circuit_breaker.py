@@ -0,0 +1,67 @@
+import frappe
+from moodle_integration.scripts.moodle_redis import get_redis, make_key
+
+# Fallos consecutivos (dentro de la ventana) que abren el circuito
+FAILURE_THRESHOLD = 5
+FAILURE_WINDOW = 60
+# Tiempo que el circuito permanece abierto antes de dejar pasar una petición de prueba
+OPEN_SECONDS = 30
+PROBE_TIMEOUT = 35
+TRIPPED_TTL = 3600
+
+
+class MoodleCircuitOpen(Exception):
+    pass
+
+
+class MoodleCircuitBreaker:
+    """
+    Circuit breaker por Moodle Instance compartido entre workers.
+    Cerrado: las peticiones pasan normalmente. Abierto: fallan al instante sin tocar Moodle.
+    Semiabierto: pasado OPEN_SECONDS se deja pasar una única petición de prueba; si va bien
+    el circuito se cierra y si falla vuelve a abrirse.
+    """
+
+    def __init__(self, moodle_instance_name):
+        self.moodle_instance_name = moodle_instance_name
+        self.redis = get_redis()
+        prefix = f"moodle_cb:{moodle_instance_name}"
+        self.failures_key = make_key(f"{prefix}:failures")
+        self.open_key = make_key(f"{prefix}:open")
+        self.tripped_key = make_key(f"{prefix}:tripped")
+        self.probe_key = make_key(f"{prefix}:probe")
+
+    def is_open(self):
+        return bool(self.redis.exists(self.open_key))
+
+    def before_request(self):
+        if self.redis.exists(self.open_key):
+            raise MoodleCircuitOpen(
+                f"Moodle Instance {self.moodle_instance_name} no disponible (circuito abierto)."
+            )
+        if self.redis.exists(self.tripped_key) and not self.redis.set(
+            self.probe_key, 1, nx=True, ex=PROBE_TIMEOUT
+        ):
+            raise MoodleCircuitOpen(
+                f"Moodle Instance {self.moodle_instance_name} en recuperación, petición de prueba en curso."
+            )
+
+    def record_success(self):
+        self.redis.delete(self.failures_key, self.tripped_key, self.probe_key)
+
+    def record_failure(self):
+        failures = self.redis.incr(self.failures_key)
+        if failures == 1:
+            self.redis.expire(self.failures_key, FAILURE_WINDOW)
+
+        if failures >= FAILURE_THRESHOLD or self.redis.exists(self.tripped_key):
+            self.redis.set(self.open_key, 1, ex=OPEN_SECONDS)
+            self.redis.set(self.tripped_key, 1, ex=TRIPPED_TTL)
+            self.redis.delete(self.failures_key, self.probe_key)
+            frappe.log_error(
+                f"Circuito abierto para {self.moodle_instance_name} tras {failures} fallos.",
+                f"Circuit Breaker - {self.moodle_instance_name}",
+            )
+
+    def reset(self):
+        self.redis.delete(self.failures_key, self.open_key, self.tripped_key, self.probe_key)
@@ -0,0 +1,235 @@
+import frappe
+from frappe.utils import now_datetime
+from moodle_integration.scripts.moodle_api import build_api_url, moodle_request
+from moodle_integration.scripts.moodle_metrics import track_sync
+from moodle_integration.scripts.moodle_sync_run import track_progress, track_total
+
+# Cohortes por llamada a core_cohort_get_cohort_members
+COHORT_PAGE_SIZE = 20
+# Filas por sentencia al insertar o borrar miembros y al resolver sus Moodle User
+MEMBER_BATCH_SIZE = 1000
+
+
+def get_cohort_name(moodle_instance_name, cohort_id):
+    return f"{moodle_instance_name} {cohort_id}"
+
+
+def sync_all_cohorts():
+    """
+    Tarea programada: encola la sincronización de cohortes de cada instancia que la tenga activa.
+    """
+    for moodle_instance_name in frappe.get_all("Moodle Instance", filters={"sync_cohorts": 1}, pluck="name"):
+        frappe.enqueue(
+            "moodle_integration.scripts.moodle_cohort_sync.sync_instance_cohorts",
+            queue="long",
+            timeout=3600,
+            job_id=f"moodle_cohort_sync:{moodle_instance_name}",
+            deduplicate=True,
+            moodle_instance_name=moodle_instance_name,
+        )
+
+
+@frappe.whitelist()
+def sync_cohorts(moodle_instance):
+    frappe.only_for("System Manager")
+    frappe.enqueue(
+        "moodle_integration.scripts.moodle_cohort_sync.sync_instance_cohorts",
+        queue="long",
+        timeout=3600,
+        job_id=f"moodle_cohort_sync:{moodle_instance}",
+        deduplicate=True,
+        moodle_instance_name=moodle_instance,
+    )
+    return {"status": "success", "message": "Sincronización de cohortes encolada."}
+
+
+@track_sync("cohort_sync")
+def sync_instance_cohorts(moodle_instance_name):
+    """
+    Sincroniza todas las cohortes de la instancia y sus miembros, y elimina las que ya no existen.
+    """
+    instance = frappe.db.get_value("Moodle Instance", moodle_instance_name, ["name", "api_key", "site_url"], as_dict=True)
+    if not instance:
+        return {"status": "error", "message": f"No se encontró la Moodle Instance {moodle_instance_name}."}
+
+    sync = CohortSync(instance.name, build_api_url(instance.site_url), instance.api_key)
+    cohorts = sync.fetch_cohorts()
+    track_total(len(cohorts))
+
+    cohort_names = sync.upsert_cohorts(cohorts)
+    frappe.db.commit()
+    sync.sync_members(cohort_names)
+
+    vanished = set(frappe.get_all("Moodle Cohort", filters={"cohort_instance": instance.name}, pluck="name")) - set(cohort_names.values())
+    delete_cohorts(vanished)
+    frappe.db.commit()
+
+    message = (
+        f"Cohortes sincronizadas: {len(cohort_names)}, eliminadas: {len(vanished)}, "
+        f"miembros añadidos: {sync.added}, quitados: {sync.removed}."
+    )
+    return {"status": "success", "message": message}
+
+
+@track_sync("process_moodle_cohort")
+def process_moodle_cohort(moodle_instance_name, cohort_id=None, api_url=None, token=None, action=None):
+    """
+    Sincroniza una cohorte y sus miembros a partir de un webhook (create_cohort, update_cohort
+    o delete_cohort). Los cambios de miembros llegan como update_cohort.
+    """
+    cohort_name = get_cohort_name(moodle_instance_name, cohort_id)
+    logs = [f"Iniciando {action} para la cohorte con ID {cohort_id} en {moodle_instance_name}."]
+
+    try:
+        if action == "delete_cohort":
+            delete_cohorts([cohort_name])
+            logs.append(f"Cohorte {cohort_name} eliminada con sus miembros.")
+            return {"status": "success", "message": "Proceso de eliminación completado.", "logs": logs}
+
+        sync = CohortSync(moodle_instance_name, api_url, token)
+        cohorts = sync.fetch_cohorts([cohort_id])
+        if not cohorts:
+            raise ValueError(f"No se encontró ninguna cohorte con ID {cohort_id}")
+
+        sync.sync_members(sync.upsert_cohorts(cohorts))
+        logs.append(f"Miembros añadidos: {sync.added}, quitados: {sync.removed}.")
+        return {"status": "success", "message": "Sincronización completada.", "logs": logs}
+
+    except Exception as e:
+        logs.append(f"[ERROR] {str(e)}")
+        return {"status": "error", "message": str(e), "logs": logs}
+
+
+def delete_cohorts(cohort_names):
+    if not cohort_names:
+        return
+    cohorts = list(cohort_names)
+    frappe.db.delete("Moodle Cohort Member", {"member_cohort": ["in", cohorts]})
+    frappe.db.delete("Moodle Cohort", {"name": ["in", cohorts]})
+
+
+class CohortSync:
+    """
+    Sincroniza cohortes y sus miembros. Los miembros se aplican como diferencia de conjuntos
+    entre los IDs de Moodle y los guardados: solo se insertan las altas y se borran las bajas,
+    en bloque, así que una cohorte de decenas de miles de miembros sin cambios no escribe nada.
+    """
+
+    def __init__(self, moodle_instance_name, api_url, token):
+        self.moodle_instance_name = moodle_instance_name
+        self.api_url = api_url
+        self.token = token
+        self.added = self.removed = 0
+
+    def call(self, wsfunction, params):
+        response = moodle_request(
+            self.moodle_instance_name,
+            self.api_url,
+            {"wstoken": self.token, "wsfunction": wsfunction, "moodlewsrestformat": "json", **params},
+            timeout=120,
+        )
+        if response.status_code != 200:
+            raise ValueError(f"Error al consultar {wsfunction}: {response.status_code}")
+        data = response.json()
+        if isinstance(data, dict) and data.get("exception"):
+            raise ValueError(data.get("message") or data["exception"])
+        return data
+
+    def fetch_cohorts(self, cohort_ids=None):
+        # Sin cohortids Moodle devuelve todas las cohortes del sitio
+        return self.call(
+            "core_cohort_get_cohorts",
+            {f"cohortids[{i}]": cohort_id for i, cohort_id in enumerate(cohort_ids or [])},
+        )
+
+    def upsert_cohorts(self, cohorts):
+        """
+        Crea o actualiza las Moodle Cohort y devuelve {id en Moodle: nombre}.
+        """
+        existing = set(frappe.get_all(
+            "Moodle Cohort", filters={"cohort_instance": self.moodle_instance_name}, pluck="name"
+        ))
+        cohort_names = {}
+        for cohort in cohorts:
+            cohort_id = str(cohort["id"])
+            name = get_cohort_name(self.moodle_instance_name, cohort_id)
+            values = {
+                "cohort_name": cohort.get("name"),
+                "cohort_idnumber": cohort.get("idnumber"),
+                "cohort_moodle_id": cohort_id,
+                "cohort_instance": self.moodle_instance_name,
+                "cohort_context": str(cohort.get("contextid") or ""),
+                "cohort_visible": 1 if cohort.get("visible", 1) else 0,
+                "cohort_description": cohort.get("description"),
+            }
+            if name in existing:
+                frappe.db.set_value("Moodle Cohort", name, values)
+            else:
+                cohort_doc = frappe.get_doc({"doctype": "Moodle Cohort", **values})
+                cohort_doc.insert(ignore_permissions=True, set_name=name)
+            cohort_names[cohort_id] = name
+        return cohort_names
+
+    def sync_members(self, cohort_names):
+        cohort_ids = sorted(cohort_names)
+        for i in range(0, len(cohort_ids), COHORT_PAGE_SIZE):
+            page = cohort_ids[i:i + COHORT_PAGE_SIZE]
+            members = self.call(
+                "core_cohort_get_cohort_members",
+                {f"cohortids[{j}]": cohort_id for j, cohort_id in enumerate(page)},
+            )
+            for entry in members:
+                cohort_name = cohort_names.get(str(entry["cohortid"]))
+                if cohort_name:
+                    self.apply_member_diff(cohort_name, {str(user_id) for user_id in entry.get("userids", [])})
+                    # Una cohorte por transacción: si algo falla, las ya confirmadas no se repiten
+                    frappe.db.commit()
+                    track_progress(written=1)
+
+    def apply_member_diff(self, cohort_name, remote_ids):
+        current_ids = set(frappe.get_all(
+            "Moodle Cohort Member", filters={"member_cohort": cohort_name}, pluck="member_moodle_id"
+        ))
+        to_add = sorted(remote_ids - current_ids)
+        to_remove = sorted(current_ids - remote_ids)
+
+        for i in range(0, len(to_remove), MEMBER_BATCH_SIZE):
+            frappe.db.delete("Moodle Cohort Member", {
+                "member_cohort": cohort_name,
+                "member_moodle_id": ["in", to_remove[i:i + MEMBER_BATCH_SIZE]],
+            })
+
+        timestamp, user = now_datetime(), frappe.session.user
+        for i in range(0, len(to_add), MEMBER_BATCH_SIZE):
+            chunk = to_add[i:i + MEMBER_BATCH_SIZE]
+            users = dict(frappe.get_all(
+                "Moodle User",
+                filters={"user_instance": self.moodle_instance_name, "user_id": ["in", chunk]},
+                fields=["user_id", "name"],
+                as_list=True,
+            ))
+            frappe.db.bulk_insert(
+                "Moodle Cohort Member",
+                ["name", "creation", "modified", "owner", "modified_by", "member_cohort", "member_user", "member_moodle_id"],
+                [
+                    (f"{cohort_name} {user_id}", timestamp, timestamp, user, user, cohort_name, users.get(user_id), user_id)
+                    for user_id in chunk
+                ],
+            )
+
+        # Miembros que entraron antes de que su Moodle User se sincronizara
+        frappe.db.sql("""
+            UPDATE `tabMoodle Cohort Member` m
+            INNER JOIN `tabMoodle User` u ON u.user_instance = %(instance)s AND u.user_id = m.member_moodle_id
+            SET m.member_user = u.name
+            WHERE m.member_cohort = %(cohort)s AND m.member_user IS NULL
+        """, {"instance": self.moodle_instance_name, "cohort": cohort_name})
+
+        frappe.db.set_value(
+            "Moodle Cohort",
+            cohort_name,
+            {"cohort_members_count": len(remote_ids), "cohort_synced_on": timestamp},
+            update_modified=False,
+        )
+        self.added += len(to_add)
+        self.removed += len(to_remove)
@@ -0,0 +1,270 @@
+import asyncio
+import frappe
+import httpx
+from datetime import datetime
+from frappe.utils import cint, convert_utc_to_system_timezone, now_datetime
+from moodle_integration.scripts.moodle_api import build_api_url, moodle_request_async
+from moodle_integration.scripts.moodle_metrics import track_sync
+from moodle_integration.scripts.moodle_sync_run import track_progress, track_total
+
+DEFAULT_CONCURRENCY = 8
+UPSERT_CHUNK_SIZE = 500
+
+COMPLETION_FIELDS = (
+    "completion_course", "completion_user", "completion_moodle_user_id", "completion_completed",
+    "completion_completed_on", "completion_progress", "completion_activities_done",
+    "completion_activities_total", "completion_states",
+)
+# Campos que deciden si una fila ha cambiado
+COMPARED_FIELDS = ("completion_user", "completion_completed", "completion_states")
+
+
+def _from_unix(timestamp):
+    if not timestamp:
+        return None
+    return convert_utc_to_system_timezone(datetime.utcfromtimestamp(timestamp)).replace(tzinfo=None)
+
+
+def sync_all_completions():
+    """
+    Tarea programada: encola la sincronización de finalización de cada instancia que la tenga activa.
+    """
+    for moodle_instance_name in frappe.get_all("Moodle Instance", filters={"sync_completions": 1}, pluck="name"):
+        frappe.enqueue(
+            "moodle_integration.scripts.moodle_completion_sync.run_completion_sync",
+            queue="long",
+            timeout=6 * 3600,
+            job_id=f"moodle_completion_sync:{moodle_instance_name}",
+            deduplicate=True,
+            moodle_instance_name=moodle_instance_name,
+        )
+
+
+@frappe.whitelist()
+def sync_completions(moodle_instance, course_ids=None, concurrency=None):
+    """
+    Encola la sincronización de finalización de cursos y actividades de una Moodle Instance.
+    Sin `course_ids` se sincronizan todos sus cursos.
+    """
+    frappe.only_for("System Manager")
+
+    if isinstance(course_ids, str):
+        course_ids = frappe.parse_json(course_ids)
+
+    frappe.enqueue(
+        "moodle_integration.scripts.moodle_completion_sync.run_completion_sync",
+        queue="long",
+        timeout=6 * 3600,
+        moodle_instance_name=moodle_instance,
+        course_ids=course_ids,
+        concurrency=cint(concurrency) or None,
+    )
+    return {"status": "success", "message": "Sincronización de finalización encolada."}
+
+
+@track_sync("completion_sync")
+def run_completion_sync(moodle_instance_name, course_ids=None, concurrency=None):
+    instance = frappe.db.get_value(
+        "Moodle Instance", moodle_instance_name, ["name", "api_key", "site_url", "max_concurrent_requests"], as_dict=True
+    )
+    if not instance:
+        return {"status": "error", "message": f"No se encontró la Moodle Instance {moodle_instance_name}."}
+
+    filters = {"course_instance": instance.name}
+    if course_ids:
+        filters["course_code"] = ["in", [str(course_id) for course_id in course_ids]]
+    courses = frappe.get_all(
+        "Moodle Course", filters=filters, fields=["name", "course_code", "course_completion_activities"]
+    )
+    track_total(len(courses))
+
+    sync = CompletionSync(instance, concurrency or instance.max_concurrent_requests or DEFAULT_CONCURRENCY)
+    asyncio.run(sync.run(courses))
+
+    message = (
+        f"Cursos: {len(courses)}, filas escritas: {sync.written}, sin cambios: {sync.unchanged}, "
+        f"con errores: {len(sync.errors)}."
+    )
+    if sync.errors:
+        frappe.log_error("\n".join(sync.errors), f"Sincronización de finalización - {instance.name}")
+    return {"status": "success", "message": message}
+
+
+class CompletionSync:
+    """
+    Descarga por curso la finalización del curso y de sus actividades de cada estudiante,
+    con concurrencia acotada, y guarda una sola fila por (curso, estudiante) con los estados
+    de todas las actividades codificados en una cadena. Solo se escriben las filas que cambian.
+    """
+
+    def __init__(self, instance, concurrency):
+        self.instance = instance
+        self.api_url = build_api_url(instance.site_url)
+        self.concurrency = concurrency
+        self.written = self.unchanged = 0
+        self.errors = []
+
+    def params(self, wsfunction, **extra):
+        return {
+            "wstoken": self.instance.api_key,
+            "wsfunction": wsfunction,
+            "moodlewsrestformat": "json",
+            **extra,
+        }
+
+    async def fetch_student(self, client, semaphore, course, user_id):
+        async with semaphore:
+            activities = await moodle_request_async(
+                client, self.instance.name, self.api_url,
+                self.params("core_completion_get_activities_completion_status", courseid=course.course_code, userid=user_id),
+            )
+            try:
+                course_status = await moodle_request_async(
+                    client, self.instance.name, self.api_url,
+                    self.params("core_completion_get_course_completion_status", courseid=course.course_code, userid=user_id),
+                )
+            except ValueError:
+                # Cursos sin criterios de finalización: Moodle responde con una excepción
+                course_status = None
+        return user_id, activities.get("statuses", []), course_status
+
+    async def run(self, courses):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+
+        async with httpx.AsyncClient(limits=limits) as client:
+            for course in courses:
+                students = dict(frappe.db.sql("""
+                    SELECT mu.user_id, mu.name
+                    FROM `tabMoodle Students Course` row
+                    INNER JOIN `tabMoodle User` mu ON mu.name = row.user_student
+                    WHERE row.parent = %s AND row.parenttype = 'Moodle Course' AND IFNULL(mu.user_id, '') != ''
+                """, (course.name,)))
+
+                results = await asyncio.gather(
+                    *(self.fetch_student(client, semaphore, course, user_id) for user_id in students),
+                    return_exceptions=True,
+                )
+                failed = [result for result in results if isinstance(result, Exception)]
+                if failed:
+                    self.errors.append(f"Curso {course.name}: {len(failed)} estudiantes con errores ({failed[0]}).")
+
+                try:
+                    self.write_course(course, students, [result for result in results if not isinstance(result, Exception)])
+                    frappe.db.commit()
+                    track_progress(written=1)
+                except Exception as e:
+                    frappe.db.rollback()
+                    self.errors.append(f"Curso {course.name}: {str(e)}")
+                    track_progress(skipped=1)
+
+    def write_course(self, course, students, results):
+        # Orden de las actividades: el guardado en el curso, con las nuevas al final, para que
+        # los estados ya guardados no se desplacen cuando se añade una actividad
+        cmids = [cmid for cmid in (course.course_completion_activities or "").split(",") if cmid]
+        known = set(cmids)
+        for _, statuses, _ in results:
+            for status in statuses:
+                if str(status["cmid"]) not in known:
+                    known.add(str(status["cmid"]))
+                    cmids.append(str(status["cmid"]))
+
+        existing = {
+            row.name: row
+            for row in frappe.get_all(
+                "Moodle Course Completion",
+                filters={"completion_course": course.name},
+                fields=["name", "completion_moodle_user_id", "completion_completed_on", *COMPARED_FIELDS],
+            )
+        }
+
+        rows = []
+        for user_id, statuses, course_status in results:
+            name = f"{course.name} {user_id}"
+            fields = self.get_completion_fields(course, cmids, students[user_id], user_id, statuses, course_status, existing.get(name))
+            previous = existing.get(name)
+            if previous and all(previous.get(field) == fields[field] for field in COMPARED_FIELDS):
+                self.unchanged += 1
+            else:
+                rows.append((name, fields))
+        self.upsert(rows)
+
+        # Estudiantes que ya no están matriculados en el curso
+        enrolled = {str(user_id) for user_id in students}
+        gone = [name for name, row in existing.items() if row.completion_moodle_user_id not in enrolled]
+        if gone:
+            frappe.db.delete("Moodle Course Completion", {"name": ["in", gone]})
+
+        activities = ",".join(cmids)
+        if activities != (course.course_completion_activities or ""):
+            frappe.db.set_value("Moodle Course", course.name, "course_completion_activities", activities, update_modified=False)
+
+    def get_completion_fields(self, course, cmids, user_name, user_id, statuses, course_status, previous):
+        states = {str(status["cmid"]): cint(status.get("state")) for status in statuses}
+        encoded = "".join(str(states.get(cmid, 0)) for cmid in cmids)
+        done = sum(1 for state in states.values() if state in (1, 2))
+
+        if course_status is not None:
+            completion = course_status.get("completionstatus", {})
+            completed = 1 if completion.get("completed") else 0
+            completed_on = _from_unix(max(
+                (cint(item.get("timecompleted")) for item in completion.get("completions", [])), default=0
+            )) if completed else None
+        else:
+            # Sin respuesta del curso se conserva lo que hubiera
+            completed = previous.completion_completed if previous else 0
+            completed_on = previous.completion_completed_on if previous else None
+
+        return {
+            "completion_course": course.name,
+            "completion_user": user_name,
+            "completion_moodle_user_id": str(user_id),
+            "completion_completed": completed,
+            "completion_completed_on": completed_on,
+            "completion_progress": round(done * 100 / len(states), 2) if states else 0,
+            "completion_activities_done": done,
+            "completion_activities_total": len(states),
+            "completion_states": encoded,
+        }
+
+    def upsert(self, rows):
+        timestamp, user = now_datetime(), frappe.session.user
+        columns = ("name", "creation", "modified", "owner", "modified_by", "docstatus", "idx", *COMPLETION_FIELDS)
+        updates = ", ".join(f"`{column}` = VALUES(`{column}`)" for column in ("modified", "modified_by", *COMPLETION_FIELDS))
+
+        for i in range(0, len(rows), UPSERT_CHUNK_SIZE):
+            chunk = rows[i:i + UPSERT_CHUNK_SIZE]
+            placeholders = ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(chunk))
+            values = [
+                value
+                for name, fields in chunk
+                for value in (name, timestamp, timestamp, user, user, 0, 0, *(fields[field] for field in COMPLETION_FIELDS))
+            ]
+            frappe.db.sql(f"""
+                INSERT INTO `tabMoodle Course Completion` ({", ".join(f"`{column}`" for column in columns)})
+                VALUES {placeholders}
+                ON DUPLICATE KEY UPDATE {updates}
+            """, values)
+            self.written += len(chunk)
+
+
+@frappe.whitelist()
+def get_activity_completion(course, cmid):
+    """
+    Estado de una actividad para todos los estudiantes del curso, leído de la cadena de
+    estados con SUBSTRING sin expandirla en filas.
+    """
+    frappe.has_permission("Moodle Course", "read", course, throw=True)
+
+    activities = (frappe.db.get_value("Moodle Course", course, "course_completion_activities") or "").split(",")
+    if str(cmid) not in activities:
+        return []
+    position = activities.index(str(cmid)) + 1
+
+    return frappe.db.sql("""
+        SELECT completion_user AS user, completion_moodle_user_id AS moodle_user_id,
+            CAST(SUBSTRING(completion_states, %(position)s, 1) AS UNSIGNED) AS state
+        FROM `tabMoodle Course Completion`
+        WHERE completion_course = %(course)s
+        ORDER BY completion_user
+    """, {"course": course, "position": position}, as_dict=True)
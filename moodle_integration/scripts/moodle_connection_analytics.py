@@ -0,0 +1,173 @@
+import frappe
+from datetime import timedelta
+from frappe.utils import add_days, get_datetime, now_datetime
+
+# Eventos recibidos con retraso que aún se tienen en cuenta al consolidar
+LATE_EVENTS_HOURS = 1
+# Los eventos sin consolidar se conservan siempre; los consolidados solo este tiempo
+RAW_RETENTION_DAYS = 90
+# Los totales por hora se reducen a los diarios pasado este tiempo
+HOURLY_RETENTION_DAYS = 400
+DELETE_BATCH_SIZE = 10000
+
+# Inicio del periodo de cada evento según la granularidad
+PERIODS = {
+    "Hora": "DATE_FORMAT(e.connection_time, '%%Y-%%m-%%d %%H:00:00')",
+    "Día": "DATE_FORMAT(e.connection_time, '%%Y-%%m-%%d 00:00:00')",
+}
+
+
+def _hour_start(value):
+    return get_datetime(value).replace(minute=0, second=0, microsecond=0)
+
+
+def record_connection(moodle_instance_name, user_name, timestamp):
+    """
+    Añade un evento de conexión: una fila mínima con un INSERT directo, sin pasar por el ORM.
+    """
+    frappe.db.sql("""
+        INSERT INTO `tabMoodle Connection Event`
+            (creation, modified, owner, modified_by, docstatus, idx, connection_instance, connection_user, connection_time)
+        VALUES (%(now)s, %(now)s, %(user)s, %(user)s, 0, 0, %(instance)s, %(user_name)s, %(timestamp)s)
+    """, {
+        "now": timestamp,
+        "user": frappe.session.user,
+        "instance": moodle_instance_name,
+        "user_name": user_name,
+        "timestamp": timestamp,
+    })
+
+
+def _day_start(value):
+    return get_datetime(value).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def rollup_connections():
+    """
+    Tarea programada (cada hora): consolida en totales por hora las horas completas desde la
+    última consolidación de cada instancia, de la instancia y de cada curso. Los totales por día
+    solo se calculan cuando el día termina (y se repasan con los eventos tardíos de la primera
+    hora siguiente), así que cada ejecución recorre solo los periodos que han cambiado; el día
+    en curso se consulta en los totales por hora.
+    """
+    end = _hour_start(now_datetime())
+    for instance in frappe.get_all("Moodle Instance", fields=["name", "connection_rollup_watermark"]):
+        if instance.connection_rollup_watermark:
+            start = get_datetime(instance.connection_rollup_watermark) - timedelta(hours=LATE_EVENTS_HOURS)
+        else:
+            first_event = frappe.db.sql("""
+                SELECT MIN(connection_time) FROM `tabMoodle Connection Event`
+                WHERE connection_instance = %s
+            """, (instance.name,))[0][0]
+            if not first_event:
+                continue
+            start = _hour_start(first_event)
+
+        if start >= end:
+            continue
+
+        rollup_period(instance.name, "Hora", start, end)
+        # Los usuarios distintos de un día no se pueden sumar desde las horas: se calcula el día
+        # entero, pero solo el de los días terminados que tocan este rango
+        if _day_start(end) > _day_start(start):
+            rollup_period(instance.name, "Día", _day_start(start), _day_start(end))
+        frappe.db.set_value("Moodle Instance", instance.name, "connection_rollup_watermark", end, update_modified=False)
+        frappe.db.commit()
+
+
+def rollup_period(moodle_instance_name, granularity, start, end):
+    """
+    Recalcula los totales de los periodos entre `start` y `end` con un INSERT ... SELECT agrupado
+    por instancia y otro por curso (estudiantes matriculados que se conectaron). El nombre de cada
+    fila sale de su clave, así que recalcular un periodo lo sobrescribe.
+    """
+    period = PERIODS[granularity]
+    for course, group_by, join in (
+        ("NULL", f"e.connection_instance, {period}", ""),
+        (
+            "sc.parent",
+            f"e.connection_instance, sc.parent, {period}",
+            "INNER JOIN `tabMoodle Students Course` sc ON sc.user_student = e.connection_user AND sc.parenttype = 'Moodle Course'",
+        ),
+    ):
+        frappe.db.sql(f"""
+            INSERT INTO `tabMoodle Connection Rollup`
+                (name, creation, modified, owner, modified_by, docstatus, idx, rollup_instance, rollup_course,
+                rollup_granularity, rollup_period, rollup_active_users, rollup_connections)
+            SELECT
+                CONCAT_WS('|', e.connection_instance, {course}, %(granularity)s, {period}),
+                %(now)s, %(now)s, %(user)s, %(user)s, 0, 0, e.connection_instance, {course},
+                %(granularity)s, {period}, COUNT(DISTINCT e.connection_user), COUNT(*)
+            FROM `tabMoodle Connection Event` e
+            {join}
+            WHERE e.connection_instance = %(instance)s
+                AND e.connection_time >= %(start)s AND e.connection_time < %(end)s
+            GROUP BY {group_by}
+            ON DUPLICATE KEY UPDATE
+                modified = VALUES(modified),
+                rollup_active_users = VALUES(rollup_active_users),
+                rollup_connections = VALUES(rollup_connections)
+        """, {
+            "granularity": granularity,
+            "now": now_datetime(),
+            "user": frappe.session.user,
+            "instance": moodle_instance_name,
+            "start": start,
+            "end": end,
+        })
+
+
+def downsample_connections():
+    """
+    Tarea programada (diaria): borra por lotes los eventos ya consolidados con más de
+    RAW_RETENTION_DAYS días y los totales por hora con más de HOURLY_RETENTION_DAYS, de
+    modo que lo antiguo queda solo en los totales diarios.
+    """
+    raw_cutoff = add_days(now_datetime(), -RAW_RETENTION_DAYS)
+    for instance in frappe.get_all(
+        "Moodle Instance", filters={"connection_rollup_watermark": ["is", "set"]}, fields=["name", "connection_rollup_watermark"]
+    ):
+        cutoff = min(raw_cutoff, get_datetime(instance.connection_rollup_watermark) - timedelta(hours=LATE_EVENTS_HOURS))
+        _delete_in_batches("Moodle Connection Event", """
+            SELECT name FROM `tabMoodle Connection Event`
+            WHERE connection_instance = %(instance)s AND connection_time < %(cutoff)s
+            LIMIT %(batch_size)s
+        """, {"instance": instance.name, "cutoff": cutoff})
+
+    _delete_in_batches("Moodle Connection Rollup", """
+        SELECT name FROM `tabMoodle Connection Rollup`
+        WHERE rollup_granularity = 'Hora' AND rollup_period < %(cutoff)s
+        LIMIT %(batch_size)s
+    """, {"cutoff": add_days(now_datetime(), -HOURLY_RETENTION_DAYS)})
+
+
+def _delete_in_batches(doctype, query, values):
+    # Un commit por lote para no mantener bloqueadas las tablas durante todo el borrado
+    while True:
+        names = frappe.db.sql(query, {**values, "batch_size": DELETE_BATCH_SIZE}, pluck=True)
+        if not names:
+            break
+        frappe.db.delete(doctype, {"name": ["in", names]})
+        frappe.db.commit()
+        if len(names) < DELETE_BATCH_SIZE:
+            break
+
+
+@frappe.whitelist()
+def get_active_users(moodle_instance, from_date, to_date, course=None, granularity="Día"):
+    """
+    Usuarios activos y conexiones por periodo, de la instancia o de un curso, leídos de los totales.
+    """
+    frappe.has_permission("Moodle Connection Rollup", "read", throw=True)
+
+    return frappe.get_all(
+        "Moodle Connection Rollup",
+        filters={
+            "rollup_instance": moodle_instance,
+            "rollup_course": course or ["is", "not set"],
+            "rollup_granularity": granularity,
+            "rollup_period": ["between", [from_date, to_date]],
+        },
+        fields=["rollup_period", "rollup_active_users", "rollup_connections"],
+        order_by="rollup_period asc",
+    )
@@ -1,8 +1,91 @@
 import frappe
-import requests
+from moodle_integration.scripts.moodle_anomaly import record_roster
+from moodle_integration.scripts.moodle_api import moodle_request
+from moodle_integration.scripts.moodle_cascade_delete import delete_courses
+from moodle_integration.scripts.moodle_child_rows import insert_child_rows
+from moodle_integration.scripts.moodle_enrollment_counters import update_course_counters
+from moodle_integration.scripts.moodle_metrics import track_sync
+from moodle_integration.scripts.moodle_sync_run import track_progress, track_total
+from moodle_integration.scripts.moodle_user_snapshot import get_user_snapshot
 from datetime import datetime
 
+
+def convert_unix_to_date(unix_timestamp):
+    return datetime.utcfromtimestamp(unix_timestamp).strftime('%Y-%m-%d') if unix_timestamp else None
+
+
+def get_course_fields(course_data, course_id, moodle_instance_name):
+    """
+    Campos del Moodle Course a partir de la respuesta de core_course_get_courses.
+    """
+    return {
+        "course_name": course_data.get("fullname"),
+        "course_code": course_id,
+        "course_instance": moodle_instance_name,
+        "course_start_date": convert_unix_to_date(course_data.get("startdate")),
+        "course_end_date": convert_unix_to_date(course_data.get("enddate")),
+    }
+
+
+def get_group_fields(group, course_name, moodle_instance_name):
+    return {
+        "group_name": group["name"],
+        "group_instance": moodle_instance_name,
+        "group_course": course_name,
+        "group_moodle_id": str(group["id"]),
+    }
+
+
+def get_user_type(participant):
+    """
+    Define user_type basado en roles de Moodle.
+    """
+    user_roles = [role["shortname"] for role in participant.get("roles", [])]
+    if "editingteacher" in user_roles:
+        return "Profesor Editor"
+    elif "teacher" in user_roles:
+        return "Profesor"
+    return "Estudiante"
+
+
+def get_participant_fields(participant, moodle_instance_name, user_type):
+    """
+    Campos del Moodle User a partir de un participante de core_enrol_get_enrolled_users.
+    """
+    return {
+        "user_id": participant.get("id"),
+        "moodle_user_id": participant.get("username"),
+        "user_name": participant.get("firstname"),
+        "user_surname": participant.get("lastname"),
+        "user_fullname": f"{participant.get('firstname')} {participant.get('lastname')}",
+        "user_email": participant.get("email"),
+        "user_dni": participant.get("idnumber"),
+        "user_phone": participant.get("phone"),
+        "user_instance": moodle_instance_name,
+        "user_type": user_type
+    }
+
+
+def get_participant_row(participant, user_name, user_type, group_mapping):
+    """
+    Devuelve la tabla hija del curso (estudiantes o profesores) y la fila del participante,
+    vinculada al primer grupo de Moodle que exista en group_mapping.
+    """
+    for group in participant.get("groups", []):
+        group_id = str(group["id"])
+        if group_id in group_mapping:
+            last_group_name = group_mapping[group_id]
+            break
+    else:
+        last_group_name = None
+
+    if user_type == "Estudiante":
+        return "course_students", {"user_student": user_name, "user_group": last_group_name}
+    return "course_teachers", {"user_teacher": user_name, "user_group": last_group_name}
+
+
 @frappe.whitelist(allow_guest=True)
+@track_sync("process_moodle_course")
 def process_moodle_course(moodle_instance_name, course_id, api_url, token, action):
     """
     Sincroniza un curso de Moodle con Frappe basado en su ID único de Moodle (course_id).
@@ -18,8 +101,8 @@ def process_moodle_course(moodle_instance_name, course_id, api_url, token, actio
         # Manejo de eliminación de curso
         if action == "delete_course":
             if frappe.db.exists("Moodle Course", {"name": course_identifier}):
-                frappe.delete_doc("Moodle Course", course_identifier)
-                logs.append(f"Curso {course_identifier} eliminado en ERPNext.")
+                delete_courses([course_identifier])
+                logs.append(f"Curso {course_identifier} eliminado en ERPNext con sus grupos y calificaciones.")
             else:
                 logs.append(f"El curso {course_identifier} no existe en ERPNext, no es necesario eliminarlo.")
 
@@ -29,15 +112,12 @@ def process_moodle_course(moodle_instance_name, course_id, api_url, token, actio
         def fetch_data(api_params, description):
             logs.append(f"\n[{description}] Consultando datos:")
             logs.append(f"  Parámetros: {api_params}")
-            response = requests.get(api_url, params=api_params, timeout=30)
+            response = moodle_request(moodle_instance_name, api_url, api_params)
             if response.status_code != 200:
                 logs.append(f"  Error en la consulta: {response.text}")
                 raise ValueError(f"Error al consultar {description}: {response.status_code}")
             return response.json()
 
-        def convert_unix_to_date(unix_timestamp):
-            return datetime.utcfromtimestamp(unix_timestamp).strftime('%Y-%m-%d') if unix_timestamp else None
-
         # Paso 1: Obtener datos del curso desde Moodle
         course_params = {
             "wstoken": token,
@@ -47,9 +127,6 @@ def process_moodle_course(moodle_instance_name, course_id, api_url, token, actio
         }
         course_data = fetch_data(course_params, "curso")[0]
 
-        course_start_date = convert_unix_to_date(course_data.get("startdate"))
-        course_end_date = convert_unix_to_date(course_data.get("enddate"))
-
         # Verificar si el curso ya existe en ERPNext
         course_exists = frappe.db.exists("Moodle Course", {"name": course_identifier})
 
@@ -64,12 +141,9 @@ def process_moodle_course(moodle_instance_name, course_id, api_url, token, actio
             f"{'Actualizando' if course_exists else 'Creando'} curso en ERPNext: {course_identifier}."
         )
 
+        previous_students = len(course_doc.get("course_students") or [])
         course_doc.update({
-            "course_name": course_data.get("fullname"),
-            "course_code": course_id,
-            "course_instance": moodle_instance_name,
-            "course_start_date": course_start_date,
-            "course_end_date": course_end_date,
+            **get_course_fields(course_data, course_id, moodle_instance_name),
             "course_students": [],
             "course_teachers": [],
             "course_groups": [],
@@ -86,6 +160,7 @@ def process_moodle_course(moodle_instance_name, course_id, api_url, token, actio
         }
         groups = fetch_data(group_params, "grupos")
         group_mapping = {}
+        track_total(len(groups))
 
         for group in groups:
             group_id, group_name = str(group["id"]), group["name"]
@@ -96,15 +171,11 @@ def process_moodle_course(moodle_instance_name, course_id, api_url, token, actio
                 if frappe.db.exists("Moodle Course Group", {"name": group_identifier})
                 else frappe.new_doc("Moodle Course Group")
             )
-            group_doc.update({
-                "group_name": group_name,
-                "group_instance": moodle_instance_name,
-                "group_course": course_doc.name,
-                "group_moodle_id": group_id,
-            })
+            group_doc.update(get_group_fields(group, course_doc.name, moodle_instance_name))
             group_doc.save(ignore_permissions=True)
 
             group_mapping[group_id] = group_doc.name
+            track_progress(written=1)
             if group_doc.name not in [row.course_group for row in course_doc.get("course_groups", [])]:
                 course_doc.append("course_groups", {"course_group": group_doc.name})
 
@@ -123,55 +194,34 @@ def process_moodle_course(moodle_instance_name, course_id, api_url, token, actio
         if not participants:
             logs.append(f"[ADVERTENCIA] No se encontraron participantes en el curso {course_id}.")
         else:
-            for participant in participants:
-                user_identifier = f"{moodle_instance_name} {participant.get('username')}"
-                user_doc = (
-                    frappe.get_doc("Moodle User", user_identifier)
-                    if frappe.db.exists("Moodle User", {"name": user_identifier})
-                    else frappe.new_doc("Moodle User")
+            track_total(len(participants))
+            # Cada usuario se guarda como mucho una vez por sincronización aunque esté en varios cursos
+            user_types = {participant.get("username"): get_user_type(participant) for participant in participants}
+            user_names = get_user_snapshot(moodle_instance_name).save_users(moodle_instance_name, {
+                participant.get("username"): get_participant_fields(
+                    participant, moodle_instance_name, user_types[participant.get("username")]
                 )
+                for participant in participants
+            })
 
-                # Definir user_type basado en roles de Moodle
-                user_roles = [role["shortname"] for role in participant.get("roles", [])]
-                if "editingteacher" in user_roles:
-                    user_type = "Profesor Editor"
-                elif "teacher" in user_roles:
-                    user_type = "Profesor"
-                else:
-                    user_type = "Estudiante"
-
-                user_doc.update({
-                    "user_id": participant.get("id"),
-                    "moodle_user_id": participant.get("username"),
-                    "user_name": participant.get("firstname"),
-                    "user_surname": participant.get("lastname"),
-                    "user_fullname": f"{participant.get('firstname')} {participant.get('lastname')}",
-                    "user_email": participant.get("email"),
-                    "user_dni": participant.get("idnumber"),
-                    "user_phone": participant.get("phone"),
-                    "user_instance": moodle_instance_name,
-                    "user_type": user_type
-                })
-
-                user_doc.save(ignore_permissions=True)
-
+            participant_rows = {"course_students": [], "course_teachers": []}
+            for participant in participants:
                 # Vincular usuario a grupos en Moodle
-                for group in participant.get("groups", []):
-                    group_id = str(group["id"])
-                    if group_id in group_mapping:
-                        last_group_name = group_mapping[group_id]
-                        break
-                else:
-                    last_group_name = None
-
-                course_doc.append(
-                    "course_students" if user_type == "Estudiante" else "course_teachers",
-                    {"user_student" if user_type == "Estudiante" else "user_teacher": user_doc.name, "user_group": last_group_name}
-                )
-
-            course_doc.save(ignore_permissions=True)
+                username = participant.get("username")
+                table_field, row = get_participant_row(participant, user_names[username], user_types[username], group_mapping)
+                participant_rows[table_field].append(row)
+                track_progress(written=1)
+
+            # Las filas se insertan en bloque: con miles de participantes validar cada Link
+            # por separado en course_doc.save() era el mayor coste de la sincronización
+            insert_child_rows(course_doc, participant_rows)
             logs.append("Participantes vinculados correctamente.")
 
+        students = len(participant_rows["course_students"]) if participants else 0
+        teachers = len(participant_rows["course_teachers"]) if participants else 0
+        update_course_counters(course_doc.name, students, teachers, len(course_doc.get("course_groups") or []))
+        record_roster(moodle_instance_name, course_doc.name, previous_students, students)
+
         return {"status": "success", "message": "Sincronización completada.", "logs": logs}
 
     except Exception as e:
@@ -0,0 +1,135 @@
+import frappe
+import json
+import time
+from frappe.utils import now_datetime
+from moodle_integration.scripts.moodle_circuit_breaker import MoodleCircuitBreaker
+
+
+def record_failed_event(moodle_instance_name, action, entity_key, entity_id, payload=None, error=None):
+    """
+    Guarda un evento de Moodle que no se pudo sincronizar en Moodle Failed Event.
+    Si ya hay un evento pendiente para la misma entidad se reutiliza (gana la última acción),
+    de forma que al reprocesar cada entidad se sincroniza una sola vez.
+    """
+    values = {
+        "failed_action": action,
+        "failed_last_attempt": now_datetime(),
+        "failed_error": error,
+        "failed_payload": json.dumps(payload, default=str) if payload else None,
+    }
+
+    existing = frappe.db.get_value(
+        "Moodle Failed Event",
+        {
+            "failed_instance": moodle_instance_name,
+            "failed_entity_key": entity_key,
+            "failed_entity_id": str(entity_id),
+            "failed_status": "Pendiente",
+        },
+        ["name", "failed_attempts"],
+        as_dict=True,
+    )
+
+    if existing:
+        values["failed_attempts"] = (existing.failed_attempts or 0) + 1
+        frappe.db.set_value("Moodle Failed Event", existing.name, values)
+        return existing.name
+
+    failed_event = frappe.get_doc({
+        "doctype": "Moodle Failed Event",
+        "failed_instance": moodle_instance_name,
+        "failed_entity_key": entity_key,
+        "failed_entity_id": str(entity_id),
+        "failed_status": "Pendiente",
+        "failed_attempts": 1,
+        **values,
+    })
+    failed_event.insert(ignore_permissions=True)
+    return failed_event.name
+
+
+@frappe.whitelist()
+def replay_failed_events(moodle_instance=None, limit=500, requests_per_second=2):
+    """
+    Encola el reprocesamiento de los eventos pendientes, opcionalmente de una sola instancia.
+    `requests_per_second` limita cuántos eventos se reprocesan por segundo.
+    """
+    frappe.only_for("System Manager")
+
+    frappe.enqueue(
+        "moodle_integration.scripts.moodle_dead_letter.process_failed_events",
+        queue="long",
+        timeout=3600,
+        moodle_instance=moodle_instance,
+        limit=int(limit),
+        requests_per_second=float(requests_per_second),
+    )
+    return {"status": "success", "message": "Reprocesamiento de eventos fallidos encolado."}
+
+
+def process_failed_events(moodle_instance=None, limit=500, requests_per_second=2):
+    from moodle_integration.scripts.handle_moodle_data import get_action_handler, run_moodle_action
+
+    filters = {"failed_status": "Pendiente"}
+    if moodle_instance:
+        filters["failed_instance"] = moodle_instance
+
+    events = frappe.get_all(
+        "Moodle Failed Event",
+        filters=filters,
+        fields=["name", "failed_instance", "failed_action", "failed_entity_id", "failed_attempts"],
+        order_by="modified asc",
+        limit=limit,
+    )
+
+    interval = 1 / requests_per_second if requests_per_second else 0
+    instances = {}
+    summary = {"replayed": 0, "failed": 0, "skipped": 0}
+
+    for event in events:
+        if event.failed_instance not in instances:
+            instances[event.failed_instance] = frappe.db.get_value(
+                "Moodle Instance", event.failed_instance, ["name", "api_key", "site_url"], as_dict=True
+            )
+        instance = instances[event.failed_instance]
+
+        # Mientras el circuito siga abierto no tiene sentido volver a intentarlo
+        if not instance or MoodleCircuitBreaker(instance.name).is_open():
+            summary["skipped"] += 1
+            continue
+
+        if not get_action_handler(event.failed_action):
+            frappe.db.set_value("Moodle Failed Event", event.name, "failed_status", "Descartado")
+            summary["skipped"] += 1
+            continue
+
+        start = time.monotonic()
+        response = run_moodle_action(instance, event.failed_action, event.failed_entity_id)
+
+        # "deferred": otro worker está sincronizando la entidad y la repetirá al terminar
+        if response.get("status") in ("success", "deferred"):
+            frappe.db.set_value("Moodle Failed Event", event.name, {
+                "failed_status": "Reprocesado",
+                "failed_last_attempt": now_datetime(),
+            })
+            summary["replayed"] += 1
+        else:
+            frappe.db.set_value("Moodle Failed Event", event.name, {
+                "failed_attempts": (event.failed_attempts or 0) + 1,
+                "failed_last_attempt": now_datetime(),
+                "failed_error": response.get("message"),
+            })
+            summary["failed"] += 1
+
+        # Confirmar cada evento para no repetir trabajo si el job se interrumpe
+        frappe.db.commit()
+
+        elapsed = time.monotonic() - start
+        if interval > elapsed:
+            time.sleep(interval - elapsed)
+
+    frappe.log_error(
+        f"Eventos reprocesados: {summary['replayed']}, fallidos: {summary['failed']}, omitidos: {summary['skipped']}.",
+        "Reprocesamiento de Eventos Fallidos",
+    )
+    return summary
@@ -0,0 +1,196 @@
+import frappe
+
+# Contadores de cada curso y tabla hija de la que salen
+COURSE_COUNTERS = {
+    "course_students_count": "Moodle Students Course",
+    "course_teachers_count": "Moodle Teachers Course",
+    "course_groups_count": "Moodle Course Group Groups",
+}
+# Contadores de cada categoría (suma de sus cursos y de los de todas sus subcategorías)
+# y contador del curso que aporta cada uno; None cuenta el propio curso
+CATEGORY_COUNTERS = {
+    "coursecat_courses_count": None,
+    "coursecat_students_count": "course_students_count",
+    "coursecat_teachers_count": "course_teachers_count",
+    "coursecat_groups_count": "course_groups_count",
+}
+# Campos que solo escribe este módulo: los controladores los releen antes de guardar
+COURSE_PROTECTED_FIELDS = (*COURSE_COUNTERS, "course_counters_category")
+CATEGORY_PROTECTED_FIELDS = tuple(CATEGORY_COUNTERS)
+
+
+def _category_values(course_counts):
+    return {
+        field: course_counts[source] or 0 if source else 1
+        for field, source in CATEGORY_COUNTERS.items()
+    }
+
+
+def get_category_ancestors(category_name):
+    """
+    La categoría y todas sus categorías padre, hasta la raíz.
+    """
+    ancestors, current = [], category_name
+    while current and current not in ancestors:
+        ancestors.append(current)
+        current = frappe.db.get_value("Moodle Course Category", current, "coursecat_parent")
+    return ancestors
+
+
+def add_to_categories(category_name, deltas):
+    """
+    Suma los incrementos a la categoría y a todos sus ancestros con una sola sentencia.
+    """
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if not category_name or not deltas:
+        return
+
+    assignments = ", ".join(f"`{field}` = IFNULL(`{field}`, 0) + %({field})s" for field in deltas)
+    frappe.db.sql(f"""
+        UPDATE `tabMoodle Course Category`
+        SET {assignments}
+        WHERE name IN %(categories)s
+    """, {**deltas, "categories": tuple(get_category_ancestors(category_name))})
+
+
+def update_course_counters(course_name, students=None, teachers=None, groups=None):
+    """
+    Guarda los totales de un curso (los que se omiten no cambian) y propaga a su categoría y
+    sus ancestros solo la diferencia. Si el curso cambió de categoría desde la última vez, sus
+    totales se restan de la anterior y se suman a la nueva.
+    """
+    course = frappe.db.get_value(
+        "Moodle Course",
+        course_name,
+        ["course_category", "course_counters_category", *COURSE_COUNTERS],
+        as_dict=True,
+        for_update=True,
+    )
+    if not course:
+        return
+
+    counts = {field: course[field] or 0 for field in COURSE_COUNTERS}
+    for field, value in zip(COURSE_COUNTERS, (students, teachers, groups)):
+        if value is not None:
+            counts[field] = value
+
+    old_values, new_values = _category_values(course), _category_values(counts)
+    if course.course_counters_category == course.course_category:
+        add_to_categories(course.course_category, {
+            field: new_values[field] - old_values[field] for field in CATEGORY_COUNTERS
+        })
+    else:
+        add_to_categories(course.course_counters_category, {field: -value for field, value in old_values.items()})
+        add_to_categories(course.course_category, new_values)
+
+    frappe.db.set_value(
+        "Moodle Course",
+        course_name,
+        {**counts, "course_counters_category": course.course_category},
+        update_modified=False,
+    )
+
+
+def remove_course_counters(course_names):
+    """
+    Resta de sus categorías los totales de cursos que se van a eliminar, con una sentencia por categoría.
+    """
+    if not course_names:
+        return
+
+    deltas = {}
+    for course in frappe.get_all(
+        "Moodle Course",
+        filters={"name": ["in", list(course_names)], "course_counters_category": ["is", "set"]},
+        fields=["course_counters_category", *COURSE_COUNTERS],
+    ):
+        category_deltas = deltas.setdefault(course.course_counters_category, dict.fromkeys(CATEGORY_COUNTERS, 0))
+        for field, value in _category_values(course).items():
+            category_deltas[field] -= value
+
+    for category_name, category_deltas in deltas.items():
+        add_to_categories(category_name, category_deltas)
+
+
+def move_category_counters(category_name, old_parent, new_parent):
+    """
+    Una categoría que cambia de padre se lleva sus totales (con los de sus subcategorías).
+    """
+    totals = frappe.db.get_value("Moodle Course Category", category_name, CATEGORY_PROTECTED_FIELDS, as_dict=True)
+    if not totals:
+        return
+    add_to_categories(old_parent, {field: -(value or 0) for field, value in totals.items()})
+    add_to_categories(new_parent, {field: value or 0 for field, value in totals.items()})
+
+
+def remove_category_counters(category_names):
+    """
+    Se llama antes de eliminar una categoría con sus subcategorías (la primera de la lista):
+    resta sus totales de los ancestros que quedan y deja sus cursos sin contabilizar.
+    """
+    root = frappe.db.get_value(
+        "Moodle Course Category", category_names[0], ["coursecat_parent", *CATEGORY_PROTECTED_FIELDS], as_dict=True
+    )
+    if root and root.coursecat_parent not in category_names:
+        add_to_categories(root.coursecat_parent, {field: -(root[field] or 0) for field in CATEGORY_PROTECTED_FIELDS})
+
+    frappe.db.sql("""
+        UPDATE `tabMoodle Course` SET course_counters_category = NULL
+        WHERE course_counters_category IN %(categories)s
+    """, {"categories": tuple(category_names)})
+
+
+def verify_enrollment_counters():
+    """
+    Tarea programada: recalcula todos los totales desde las tablas hijas con una consulta
+    agrupada por tabla y corrige los que se hayan desviado de los mantenidos de forma incremental.
+    """
+    actual = {}
+    for field, child_doctype in COURSE_COUNTERS.items():
+        for course_name, count in frappe.db.sql(f"""
+            SELECT parent, COUNT(*) FROM `tab{child_doctype}`
+            WHERE parenttype = 'Moodle Course'
+            GROUP BY parent
+        """):
+            actual.setdefault(course_name, {})[field] = count
+
+    parents = dict(frappe.get_all("Moodle Course Category", fields=["name", "coursecat_parent"], as_list=True))
+    expected_categories = {name: dict.fromkeys(CATEGORY_COUNTERS, 0) for name in parents}
+    fixed_courses = fixed_categories = 0
+
+    for course in frappe.get_all(
+        "Moodle Course", fields=["name", "course_category", "course_counters_category", *COURSE_COUNTERS]
+    ):
+        counts = {field: actual.get(course.name, {}).get(field, 0) for field in COURSE_COUNTERS}
+        if course.course_counters_category != course.course_category or any(
+            (course[field] or 0) != counts[field] for field in COURSE_COUNTERS
+        ):
+            frappe.db.set_value(
+                "Moodle Course",
+                course.name,
+                {**counts, "course_counters_category": course.course_category},
+                update_modified=False,
+            )
+            fixed_courses += 1
+
+        ancestors, current = [], course.course_category
+        while current in parents and current not in ancestors:
+            ancestors.append(current)
+            current = parents[current]
+        for category_name in ancestors:
+            for field, value in _category_values(counts).items():
+                expected_categories[category_name][field] += value
+
+    for category in frappe.get_all("Moodle Course Category", fields=["name", *CATEGORY_COUNTERS]):
+        expected = expected_categories[category.name]
+        if any((category[field] or 0) != expected[field] for field in CATEGORY_COUNTERS):
+            frappe.db.set_value("Moodle Course Category", category.name, expected, update_modified=False)
+            fixed_categories += 1
+
+    frappe.db.commit()
+    if fixed_courses or fixed_categories:
+        frappe.log_error(
+            f"Totales corregidos: {fixed_courses} cursos y {fixed_categories} categorías.",
+            "Verificación de totales de matriculación de Moodle",
+        )
+    return {"courses": fixed_courses, "categories": fixed_categories}
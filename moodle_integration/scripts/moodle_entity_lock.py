@@ -0,0 +1,66 @@
+import uuid
+from moodle_integration.scripts.moodle_redis import decode, get_redis, make_key
+
+# Duración máxima del bloqueo; si el worker muere, el bloqueo caduca solo
+LOCK_TTL = 900
+
+# Toma el bloqueo o, si otro worker lo tiene, deja la acción pendiente en la misma operación,
+# para que el dueño no pueda liberarlo entre medias sin verla
+ACQUIRE_LUA = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[3]) then
+    return 1
+end
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+return 0
+"""
+
+# Si el bloqueo sigue siendo nuestro, recoge la acción pendiente y lo libera; con ARGV[2] = '1'
+# y una acción pendiente lo conserva (renovado) para que el dueño la ejecute
+RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return false
+end
+local action = redis.call('GET', KEYS[2])
+redis.call('DEL', KEYS[2])
+if action and ARGV[2] == '1' then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    return action
+end
+redis.call('DEL', KEYS[1])
+return action
+"""
+
+
+class EntityLock:
+    """
+    Bloqueo distribuido por (instancia, tipo de entidad, id) para que dos workers no
+    sincronicen a la vez el mismo curso, usuario o categoría. Quien no consigue el bloqueo
+    marca la entidad como sucia y quien lo tiene vuelve a sincronizarla al terminar.
+    """
+
+    def __init__(self, moodle_instance_name, entity_type, entity_id):
+        self.redis = get_redis()
+        prefix = f"moodle_lock:{moodle_instance_name}:{entity_type}:{entity_id}"
+        self.lock_key = make_key(prefix)
+        self.dirty_key = make_key(f"{prefix}:dirty")
+        self.token = uuid.uuid4().hex
+
+    def acquire(self, action):
+        """
+        Devuelve True si se consiguió el bloqueo; si no, `action` queda como pendiente (se
+        guarda la última acción recibida, que es la que se repetirá).
+        """
+        acquired = self.redis.register_script(ACQUIRE_LUA)(
+            keys=[self.lock_key, self.dirty_key], args=[self.token, action, LOCK_TTL]
+        )
+        return bool(int(acquired))
+
+    def release(self, keep_if_dirty=False):
+        """
+        Libera el bloqueo y devuelve la acción pendiente, si la hay. Con `keep_if_dirty` el
+        bloqueo solo se libera cuando no queda nada pendiente.
+        """
+        action = self.redis.register_script(RELEASE_LUA)(
+            keys=[self.lock_key, self.dirty_key], args=[self.token, 1 if keep_if_dirty else 0, LOCK_TTL]
+        )
+        return decode(action)
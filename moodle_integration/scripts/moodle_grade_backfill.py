@@ -0,0 +1,261 @@
+import frappe
+import multiprocessing
+import os
+import requests
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from frappe.utils import cint, now_datetime
+from moodle_integration.scripts.moodle_api import build_api_url, moodle_request
+from moodle_integration.scripts.moodle_gradebook import clear_gradebook_cache
+from moodle_integration.scripts.moodle_metrics import track_sync
+from moodle_integration.scripts.moodle_sync_run import track_progress, track_total
+
+DEFAULT_PROCESSES = 4
+# Filas por INSERT al escribir las notas de un curso
+GRADE_BATCH_SIZE = 1000
+# Elementos de Moodle que no son actividades calificables (totales de curso y de categoría)
+SKIPPED_ITEM_TYPES = ("course", "category")
+
+
+@frappe.whitelist()
+def backfill_grades(moodle_instance, course_ids=None, processes=None, restart=False, retry_failed=False):
+    """
+    Encola la carga masiva de calificaciones de una Moodle Instance.
+    Si una carga anterior se interrumpió, se reanuda omitiendo los cursos ya confirmados,
+    salvo con `restart`. Con `retry_failed` solo se cargan los cursos que fallaron.
+    """
+    frappe.only_for("System Manager")
+
+    if isinstance(course_ids, str):
+        course_ids = frappe.parse_json(course_ids)
+
+    frappe.enqueue(
+        "moodle_integration.scripts.moodle_grade_backfill.run_grade_backfill",
+        queue="long",
+        timeout=12 * 3600,
+        moodle_instance_name=moodle_instance,
+        course_ids=course_ids,
+        processes=cint(processes) or None,
+        restart=cint(restart),
+        retry_failed=cint(retry_failed),
+    )
+    return {"status": "success", "message": "Carga masiva de calificaciones encolada."}
+
+
+@track_sync("grade_backfill")
+def run_grade_backfill(moodle_instance_name, course_ids=None, processes=None, restart=False, retry_failed=False):
+    """
+    Reparte los cursos de la instancia entre un pool de procesos: el parseo de las respuestas
+    y la construcción de filas usan CPU y en un solo proceso se serializan con las esperas a
+    Moodle. Cada curso se confirma por separado junto con su marca `course_grades_synced_on`,
+    que es el punto de control para reanudar.
+
+    Al terminar una pasada, con o sin errores, el punto de control se borra y los cursos que
+    fallaron se guardan en `grade_backfill_failed`: un curso que falla siempre no impide que
+    las siguientes pasadas refresquen los demás.
+    """
+    instance = frappe.db.get_value(
+        "Moodle Instance",
+        moodle_instance_name,
+        ["name", "api_key", "site_url", "grade_backfill_started", "grade_backfill_failed"],
+        as_dict=True,
+    )
+    if not instance:
+        return {"status": "error", "message": f"No se encontró la Moodle Instance {moodle_instance_name}."}
+
+    failed_before = [name for name in (instance.grade_backfill_failed or "").splitlines() if name]
+    filters = {"course_instance": instance.name}
+    if retry_failed:
+        if not failed_before:
+            return {"status": "success", "message": "No hay cursos con errores que reintentar."}
+        # El reintento no toca el punto de control de la pasada
+        filters["name"] = ["in", failed_before]
+        started = now_datetime()
+    else:
+        started = None if restart else instance.grade_backfill_started
+        if not started:
+            started = now_datetime()
+            frappe.db.set_value("Moodle Instance", instance.name, "grade_backfill_started", started)
+            frappe.db.commit()
+
+    if course_ids:
+        filters["course_code"] = ["in", [str(course_id) for course_id in course_ids]]
+    courses = [
+        course for course in frappe.get_all(
+            "Moodle Course", filters=filters, fields=["name", "course_code", "course_grades_synced_on"]
+        )
+        if not course.course_grades_synced_on or course.course_grades_synced_on < started
+    ]
+    track_total(len(courses))
+
+    summary = {"courses": len(courses), "written": 0, "grades": 0, "errors": []}
+    failed = set()
+    api_url = build_api_url(instance.site_url)
+
+    # spawn: los procesos no deben heredar las conexiones a la base de datos y Redis del worker
+    with ProcessPoolExecutor(
+        max_workers=processes or DEFAULT_PROCESSES,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(frappe.local.site, os.path.abspath(frappe.local.sites_path)),
+    ) as executor:
+        futures = [
+            executor.submit(_backfill_course, instance.name, course.name, course.course_code, api_url, instance.api_key)
+            for course in courses
+        ]
+        for future in as_completed(futures):
+            course_name, grades, error = future.result()
+            if error:
+                summary["errors"].append(f"{course_name}: {error}")
+                failed.add(course_name)
+                track_progress(skipped=1)
+            else:
+                summary["written"] += 1
+                summary["grades"] += grades
+                track_progress(written=1)
+
+    # Fallidos: los de esta pasada más los anteriores que no se han vuelto a intentar
+    attempted = {course.name for course in courses}
+    values = {"grade_backfill_failed": "\n".join(sorted((set(failed_before) - attempted) | failed))}
+    if not retry_failed:
+        values["grade_backfill_started"] = None
+    frappe.db.set_value("Moodle Instance", instance.name, values)
+    frappe.db.commit()
+
+    if summary["errors"]:
+        frappe.log_error("\n".join(summary["errors"]), f"Carga masiva de calificaciones - {instance.name}")
+
+    message = (
+        f"Cursos con calificaciones cargadas: {summary['written']} de {summary['courses']}, "
+        f"calificaciones: {summary['grades']}, con errores: {len(summary['errors'])}."
+    )
+    return {"status": "success", "message": message, **summary}
+
+
+def _init_worker(site, sites_path):
+    # Cada proceso tiene su propia conexión a la base de datos y su propia sesión HTTP
+    frappe.init(site=site, sites_path=sites_path)
+    frappe.connect()
+    frappe.local.moodle_backfill_session = requests.Session()
+
+
+def _backfill_course(moodle_instance_name, course_name, course_id, api_url, token):
+    try:
+        grades = GradeBackfillWriter(moodle_instance_name, course_name).write(
+            fetch_course_grades(moodle_instance_name, course_id, api_url, token)
+        )
+        frappe.db.commit()
+    except Exception as e:
+        frappe.db.rollback()
+        return course_name, 0, str(e)
+
+    clear_gradebook_cache([course_name])
+    return course_name, grades, None
+
+
+def fetch_course_grades(moodle_instance_name, course_id, api_url, token):
+    response = moodle_request(
+        moodle_instance_name,
+        api_url,
+        {
+            "wstoken": token,
+            "wsfunction": "gradereport_user_get_grade_items",
+            "moodlewsrestformat": "json",
+            "courseid": course_id,
+        },
+        timeout=120,
+        session=getattr(frappe.local, "moodle_backfill_session", None),
+    )
+    if response.status_code != 200:
+        raise ValueError(f"Error al consultar calificaciones: {response.status_code}")
+    data = response.json()
+    if isinstance(data, dict) and data.get("exception"):
+        raise ValueError(data.get("message") or data["exception"])
+    return data.get("usergrades", [])
+
+
+class GradeBackfillWriter:
+    """
+    Escribe las calificaciones de un curso: un upsert de sus Moodle Grade Item y la
+    sustitución de sus Moodle Student Grade con INSERT por lotes.
+    """
+
+    def __init__(self, moodle_instance_name, course_name):
+        self.moodle_instance_name = moodle_instance_name
+        self.course_name = course_name
+
+    def write(self, usergrades):
+        items = {}
+        for usergrade in usergrades:
+            for item in usergrade.get("gradeitems", []):
+                if item.get("itemtype") not in SKIPPED_ITEM_TYPES:
+                    items.setdefault(str(item["id"]), item)
+
+        item_names = self.write_items(items)
+        user_names = dict(frappe.get_all(
+            "Moodle User",
+            filters={
+                "user_instance": self.moodle_instance_name,
+                "user_id": ["in", [str(usergrade["userid"]) for usergrade in usergrades]],
+            },
+            fields=["user_id", "name"],
+            as_list=True,
+        )) if usergrades else {}
+
+        timestamp, user = now_datetime(), frappe.session.user
+        rows = [
+            (
+                frappe.generate_hash(length=10), timestamp, timestamp, user, user,
+                user_names[str(usergrade["userid"])], item_names[str(item["id"])],
+                item["graderaw"], item.get("feedback"),
+            )
+            for usergrade in usergrades
+            if str(usergrade["userid"]) in user_names
+            for item in usergrade.get("gradeitems", [])
+            if str(item["id"]) in item_names and item.get("graderaw") is not None
+        ]
+
+        if item_names:
+            frappe.db.delete("Moodle Student Grade", {"grade_item": ["in", list(item_names.values())]})
+        if rows:
+            frappe.db.bulk_insert(
+                "Moodle Student Grade",
+                ["name", "creation", "modified", "owner", "modified_by", "grade_student", "grade_item", "grade", "grade_feedback"],
+                rows,
+                chunk_size=GRADE_BATCH_SIZE,
+            )
+
+        frappe.db.set_value(
+            "Moodle Course", self.course_name, "course_grades_synced_on", timestamp, update_modified=False
+        )
+        return len(rows)
+
+    def write_items(self, items):
+        existing = dict(frappe.get_all(
+            "Moodle Grade Item",
+            filters={"grade_item_course": self.course_name, "grade_item_moodle_id": ["in", list(items)]},
+            fields=["grade_item_moodle_id", "name"],
+            as_list=True,
+        )) if items else {}
+
+        item_names = {}
+        for moodle_id, item in items.items():
+            values = {
+                "grade_item_name": item.get("itemname"),
+                "grade_item_max_grade": item.get("grademax"),
+                "grade_item_min_grade": item.get("grademin"),
+                "grade_item_weight": item.get("weightraw"),
+                "grade_item_category": str(item.get("categoryid") or ""),
+            }
+            if moodle_id in existing:
+                frappe.db.set_value("Moodle Grade Item", existing[moodle_id], values)
+                item_names[moodle_id] = existing[moodle_id]
+            else:
+                item_doc = frappe.get_doc({
+                    "doctype": "Moodle Grade Item",
+                    "grade_item_course": self.course_name,
+                    "grade_item_moodle_id": moodle_id,
+                    **values,
+                })
+                item_doc.insert(ignore_permissions=True)
+                item_names[moodle_id] = item_doc.name
+        return item_names
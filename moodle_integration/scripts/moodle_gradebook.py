@@ -0,0 +1,194 @@
+import csv
+import frappe
+import io
+import numpy as np
+import warnings
+
+# Nota total (sobre 100) por debajo de la cual un estudiante se considera en riesgo
+AT_RISK_TOTAL = 50
+# Fracción del peso del curso sin calificar a partir de la cual también se considera en riesgo
+AT_RISK_MISSING_WEIGHT = 0.5
+PERCENTILES = (10, 25, 50, 75, 90)
+HISTOGRAM_BINS = 10
+GRADEBOOK_CACHE_TTL = 24 * 3600
+
+
+def _cache_key(course_name):
+    return f"moodle_gradebook:{course_name}"
+
+
+def clear_gradebook_cache(course_names):
+    """
+    Se llama cada vez que una sincronización de notas toca los cursos indicados.
+    """
+    for course_name in course_names:
+        frappe.cache().delete_value(_cache_key(course_name))
+
+
+def _to_list(array, decimals=2):
+    # NaN (sin calificar) se exporta como None
+    return np.where(np.isnan(array), None, np.round(array, decimals)).tolist()
+
+
+def load_gradebook(course_name):
+    """
+    Carga las notas del curso como matriz estudiantes × Moodle Grade Item (NaN sin calificar)
+    con dos consultas, en lugar de recorrer los Moodle Student Grade uno a uno.
+    """
+    items = frappe.get_all(
+        "Moodle Grade Item",
+        filters={"grade_item_course": course_name},
+        fields=["name", "grade_item_name", "grade_item_min_grade", "grade_item_max_grade", "grade_item_weight"],
+        order_by="creation asc",
+    )
+    grades = frappe.db.sql("""
+        SELECT g.grade_student, g.grade_item, g.grade
+        FROM `tabMoodle Student Grade` g
+        INNER JOIN `tabMoodle Grade Item` i ON i.name = g.grade_item
+        WHERE i.grade_item_course = %s AND g.grade IS NOT NULL
+    """, (course_name,))
+
+    # Los estudiantes matriculados sin ninguna nota también cuentan (y suelen estar en riesgo)
+    enrolled = frappe.get_all(
+        "Moodle Students Course",
+        filters={"parent": course_name, "parenttype": "Moodle Course"},
+        pluck="user_student",
+    )
+    students = sorted(set(filter(None, enrolled)) | {student for student, _, _ in grades})
+
+    student_index = {student: i for i, student in enumerate(students)}
+    item_index = {item.name: j for j, item in enumerate(items)}
+    matrix = np.full((len(students), len(items)), np.nan)
+    cells = [
+        (student_index[student], item_index[item], grade)
+        for student, item, grade in grades
+        if item in item_index
+    ]
+    if cells:
+        rows, cols, values = zip(*cells)
+        matrix[list(rows), list(cols)] = values
+
+    return students, items, matrix
+
+
+def compute_gradebook(students, items, matrix):
+    """
+    Totales ponderados, distribuciones por elemento, percentiles y alertas de riesgo,
+    todo con operaciones vectorizadas sobre la matriz.
+    """
+    min_grades = np.array([item.grade_item_min_grade or 0 for item in items], dtype=float)
+    max_grades = np.array([item.grade_item_max_grade or 0 for item in items], dtype=float)
+    weights = np.array([item.grade_item_weight or 0 for item in items], dtype=float)
+    if items and not weights.any():
+        # Sin pesos configurados todos los elementos pesan lo mismo
+        weights = np.ones(len(items))
+
+    ranges = max_grades - min_grades
+    with np.errstate(invalid="ignore", divide="ignore"):
+        normalized = np.clip((matrix - min_grades) / np.where(ranges > 0, ranges, np.nan), 0, 1)
+
+    graded = ~np.isnan(normalized)
+    graded_weight = graded @ weights
+    with np.errstate(invalid="ignore", divide="ignore"):
+        totals = np.nan_to_num(normalized) @ weights * 100 / np.where(graded_weight > 0, graded_weight, np.nan)
+        missing_weight = 1 - graded_weight / weights.sum() if items else np.ones(len(students))
+
+    valid_totals = np.sort(totals[~np.isnan(totals)])
+    percentile_ranks = np.where(
+        np.isnan(totals),
+        np.nan,
+        np.searchsorted(valid_totals, np.nan_to_num(totals), side="right") * 100 / max(len(valid_totals), 1),
+    )
+
+    low_total = np.nan_to_num(totals, nan=0) < AT_RISK_TOTAL
+    missing_grades = missing_weight >= AT_RISK_MISSING_WEIGHT
+
+    # Histograma de cada elemento sobre la nota normalizada, en una sola pasada
+    histogram = np.zeros((len(items), HISTOGRAM_BINS), dtype=int)
+    student_rows, item_cols = np.nonzero(graded)
+    bins = np.minimum((normalized[student_rows, item_cols] * HISTOGRAM_BINS).astype(int), HISTOGRAM_BINS - 1)
+    np.add.at(histogram, (item_cols, bins), 1)
+
+    # Elementos sin ninguna nota dan NaN; no es un error
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        item_percentiles = np.nanpercentile(matrix, PERCENTILES, axis=0) if students else np.full((len(PERCENTILES), len(items)), np.nan)
+        item_means = np.nanmean(matrix, axis=0) if students else np.full(len(items), np.nan)
+        item_stds = np.nanstd(matrix, axis=0) if students else np.full(len(items), np.nan)
+        total_percentiles = np.percentile(valid_totals, PERCENTILES) if len(valid_totals) else np.full(len(PERCENTILES), np.nan)
+
+    return {
+        "students": students,
+        "items": [
+            {"name": item.name, "label": item.grade_item_name, "weight": float(weight)}
+            for item, weight in zip(items, weights)
+        ],
+        "matrix": _to_list(matrix),
+        "totals": _to_list(totals),
+        "percentile_ranks": _to_list(percentile_ranks, 1),
+        "at_risk": [
+            {"student": student, "low_total": bool(low), "missing_grades": bool(missing)}
+            for student, low, missing in zip(students, low_total, missing_grades)
+            if low or missing
+        ],
+        "item_stats": [
+            {
+                "item": item.name,
+                "graded": int(count),
+                "mean": mean,
+                "std": std,
+                "percentiles": dict(zip(PERCENTILES, percentiles)),
+                "histogram": hist.tolist(),
+            }
+            for item, count, mean, std, percentiles, hist in zip(
+                items,
+                graded.sum(axis=0),
+                _to_list(item_means),
+                _to_list(item_stds),
+                _to_list(item_percentiles.T),
+                histogram,
+            )
+        ],
+        "total_percentiles": dict(zip(PERCENTILES, _to_list(total_percentiles))),
+    }
+
+
+def get_gradebook(course_name):
+    """
+    Libro de calificaciones del curso, cacheado hasta que una sincronización de notas lo toque.
+    """
+    cache = frappe.cache()
+    gradebook = cache.get_value(_cache_key(course_name))
+    if gradebook:
+        return gradebook
+
+    gradebook = compute_gradebook(*load_gradebook(course_name))
+    cache.set_value(_cache_key(course_name), gradebook, expires_in_sec=GRADEBOOK_CACHE_TTL)
+    return gradebook
+
+
+@frappe.whitelist()
+def get_course_gradebook(course):
+    frappe.has_permission("Moodle Course", "read", course, throw=True)
+    return get_gradebook(course)
+
+
+@frappe.whitelist()
+def download_course_gradebook(course):
+    """
+    Exporta la matriz de notas del curso en CSV, con el total ponderado y el percentil.
+    """
+    frappe.has_permission("Moodle Course", "read", course, throw=True)
+    gradebook = get_gradebook(course)
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["Estudiante", *(item["label"] for item in gradebook["items"]), "Total", "Percentil"])
+    for student, grades, total, rank in zip(
+        gradebook["students"], gradebook["matrix"], gradebook["totals"], gradebook["percentile_ranks"]
+    ):
+        writer.writerow([student, *grades, total, rank])
+
+    frappe.response["filename"] = f"{course}-calificaciones.csv"
+    frappe.response["filecontent"] = output.getvalue()
+    frappe.response["type"] = "download"
@@ -0,0 +1,63 @@
+import frappe
+import hashlib
+import time
+from moodle_integration.scripts.moodle_redis import get_redis, make_key
+
+# Ventana en segundos durante la que un reintento de Moodle se considera duplicado
+IDEMPOTENCY_TTL = 3600
+
+# Un conjunto por ventana; se consulta también el de la ventana anterior para que una
+# clave vista justo antes del cambio de ventana siga contando como duplicada
+CLAIM_LUA = """
+if redis.call('SISMEMBER', KEYS[2], ARGV[1]) == 1 then
+    return 0
+end
+local added = redis.call('SADD', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return added
+"""
+
+
+def get_idempotency_key(request_data, entity_id=None):
+    """
+    Clave del evento: la cabecera Idempotency-Key o el event_id enviado por Moodle y, si no
+    hay, la acción, la entidad y la marca de tiempo del evento. Sin ninguna de ellas no hay
+    forma de distinguir un reintento de un evento nuevo y se devuelve None.
+    """
+    key = frappe.get_request_header("Idempotency-Key") or request_data.get("event_id")
+    if not key:
+        timestamp = request_data.get("timecreated") or request_data.get("timestamp")
+        if not timestamp:
+            return None
+        key = f"{request_data.get('action')}|{entity_id}|{timestamp}"
+    return f"{request_data.get('moodle_url')}|{key}"
+
+
+def _member(idempotency_key):
+    # Se guardan 16 bytes por evento en lugar de la clave completa
+    return hashlib.blake2b(idempotency_key.encode(), digest_size=16).digest()
+
+
+def _window_keys(now=None):
+    window = int((now or time.time()) // IDEMPOTENCY_TTL)
+    return [make_key(f"moodle_webhook_seen:{window}"), make_key(f"moodle_webhook_seen:{window - 1}")]
+
+
+def claim_event(idempotency_key):
+    """
+    Registra el evento y devuelve False si ya se había recibido dentro de la ventana.
+    """
+    return bool(get_redis().register_script(CLAIM_LUA)(
+        keys=_window_keys(), args=[_member(idempotency_key), IDEMPOTENCY_TTL * 2]
+    ))
+
+
+def release_event(idempotency_key):
+    """
+    Olvida un evento cuyo procesamiento falló para que el reintento de Moodle sí se procese.
+    """
+    member = _member(idempotency_key)
+    pipe = get_redis().pipeline(transaction=False)
+    for key in _window_keys():
+        pipe.srem(key, member)
+    pipe.execute()
@@ -0,0 +1,197 @@
+import frappe
+from frappe.utils import now_datetime
+from moodle_integration.scripts.moodle_api import build_api_url, moodle_request
+from moodle_integration.scripts.moodle_metrics import track_sync
+from moodle_integration.scripts.moodle_sync_run import track_progress, track_total
+
+# Mensajes por llamada a core_message_send_instant_messages. Los parámetros van por POST,
+# pero Moodle sigue limitando el número de variables por petición (max_input_vars, 1000
+# por defecto): cada mensaje usa cuatro (touserid, text, textformat y clientmsgid), así que
+# un lote son 4 * 100 + 3 = 403 variables
+MESSAGE_BATCH_SIZE = 100
+
+RECIPIENT_TABLES = {
+    "Estudiantes": [("Moodle Students Course", "user_student")],
+    "Profesores": [("Moodle Teachers Course", "user_teacher")],
+    "Todos": [("Moodle Students Course", "user_student"), ("Moodle Teachers Course", "user_teacher")],
+}
+
+
+@frappe.whitelist()
+def send_comms(comms):
+    """
+    Crea los destinatarios de la comunicación (si aún no existen) y encola su envío.
+    Si un envío anterior se interrumpió, se reanuda con los destinatarios no enviados.
+    """
+    comms_doc = frappe.get_doc("Moodle Comms", comms)
+    comms_doc.check_permission("write")
+
+    if not frappe.db.exists("Moodle Comms Recipient", {"recipient_comms": comms_doc.name}):
+        create_recipients(comms_doc)
+
+    comms_doc.db_set("comms_status", "En Cola")
+    frappe.enqueue(
+        "moodle_integration.scripts.moodle_messaging.process_comms",
+        queue="long",
+        timeout=6 * 3600,
+        job_id=f"moodle_comms:{comms_doc.name}",
+        deduplicate=True,
+        comms=comms_doc.name,
+    )
+    return {"status": "success", "message": "Envío de la comunicación encolado."}
+
+
+def create_recipients(comms_doc):
+    if not comms_doc.comms_course:
+        frappe.throw("Indica el curso cuyos participantes recibirán la comunicación.")
+
+    users = {}
+    for table, fieldname in RECIPIENT_TABLES[comms_doc.comms_recipient_type or "Estudiantes"]:
+        for user_name, moodle_id in frappe.db.sql(f"""
+            SELECT mu.name, mu.user_id
+            FROM `tab{table}` row
+            INNER JOIN `tabMoodle User` mu ON mu.name = row.`{fieldname}`
+            WHERE row.parent = %s AND row.parenttype = 'Moodle Course'
+            ORDER BY row.idx
+        """, (comms_doc.comms_course,)):
+            users.setdefault(user_name, moodle_id)
+
+    timestamp, user = now_datetime(), frappe.session.user
+    frappe.db.bulk_insert(
+        "Moodle Comms Recipient",
+        ["name", "creation", "modified", "owner", "modified_by", "recipient_comms", "recipient_user", "recipient_moodle_id", "recipient_status"],
+        [
+            (frappe.generate_hash(length=10), timestamp, timestamp, user, user, comms_doc.name, user_name, moodle_id, "Pendiente")
+            for user_name, moodle_id in users.items()
+        ],
+    )
+    comms_doc.db_set("comms_total", len(users))
+
+
+@track_sync("send_comms")
+def process_comms(comms):
+    comms_doc = frappe.get_doc("Moodle Comms", comms)
+    instance = frappe.db.get_value(
+        "Moodle Instance", comms_doc.comms_instance, ["name", "api_key", "site_url"], as_dict=True
+    )
+    sender = CommsSender(comms_doc, instance)
+    comms_doc.db_set("comms_status", "Enviando")
+    frappe.db.commit()
+
+    # Los que quedaron "Enviando" por una interrupción se reintentan: Moodle no permite
+    # saber si llegaron a enviarse y es preferible un duplicado a un mensaje perdido
+    frappe.db.sql("""
+        UPDATE `tabMoodle Comms Recipient` SET recipient_status = 'Pendiente'
+        WHERE recipient_comms = %s AND recipient_status = 'Enviando'
+    """, (comms_doc.name,))
+    track_total(frappe.db.count("Moodle Comms Recipient", {"recipient_comms": comms_doc.name, "recipient_status": "Pendiente"}))
+
+    while batch := frappe.get_all(
+        "Moodle Comms Recipient",
+        filters={"recipient_comms": comms_doc.name, "recipient_status": "Pendiente"},
+        fields=["name", "recipient_moodle_id"],
+        order_by="creation asc, name asc",
+        limit=MESSAGE_BATCH_SIZE,
+    ):
+        sender.send_batch(batch)
+
+    counts = sender.update_counts()
+    comms_doc.db_set("comms_status", "Enviado con Errores" if counts["Error"] else "Enviado")
+    message = f"Mensajes enviados: {counts['Enviado']}, con errores: {counts['Error']}."
+    return {"status": "success", "message": message}
+
+
+class CommsSender:
+    """
+    Envía una comunicación por lotes con core_message_send_instant_messages, a través del
+    limitador de la instancia, y registra el estado de cada destinatario con una sentencia por lote.
+    """
+
+    def __init__(self, comms_doc, instance):
+        self.comms_doc = comms_doc
+        self.instance = instance
+        self.api_url = build_api_url(instance.site_url)
+
+    def send_batch(self, batch):
+        names = [recipient.name for recipient in batch]
+        set_status(names, "Enviando")
+        # Confirmar antes de llamar a Moodle: si el proceso muere se sabe qué lote estaba en vuelo
+        frappe.db.commit()
+
+        params = {
+            "wstoken": self.instance.api_key,
+            "wsfunction": "core_message_send_instant_messages",
+            "moodlewsrestformat": "json",
+        }
+        for i, recipient in enumerate(batch):
+            params[f"messages[{i}][touserid]"] = recipient.recipient_moodle_id
+            params[f"messages[{i}][text]"] = self.comms_doc.comms_message
+            params[f"messages[{i}][textformat]"] = 1
+            params[f"messages[{i}][clientmsgid]"] = recipient.name
+
+        try:
+            response = moodle_request(
+                self.instance.name, self.api_url, params, timeout=120, use_cache=False, method="POST"
+            )
+            results = response.json() if response.status_code == 200 else None
+            if not isinstance(results, list):
+                raise ValueError((results or {}).get("message") or f"Respuesta inesperada de Moodle: {response.status_code}")
+        except Exception:
+            # El lote queda "Enviando" y se reintenta al reanudar el envío con send_comms
+            frappe.db.set_value("Moodle Comms", self.comms_doc.name, "comms_status", "Borrador")
+            frappe.db.commit()
+            raise
+
+        # Cada resultado trae el clientmsgid enviado; sin él solo se emparejan por posición
+        # si Moodle devolvió uno por mensaje. Los que se quedan sin resultado cuentan como error
+        by_client_id = {result.get("clientmsgid"): result for result in results if result.get("clientmsgid")}
+        sent, errors = {}, {}
+        for i, recipient in enumerate(batch):
+            result = by_client_id.get(recipient.name) or (results[i] if len(results) == len(batch) else None)
+            if result is None:
+                errors[recipient.name] = "Moodle no devolvió resultado para este mensaje"
+            elif result.get("msgid", -1) != -1:
+                sent[recipient.name] = str(result["msgid"])
+            else:
+                errors[recipient.name] = result.get("errormessage") or "Error desconocido"
+
+        set_status(list(sent), "Enviado", message_ids=sent)
+        set_status(list(errors), "Error", errors=errors)
+        self.update_counts()
+        frappe.db.commit()
+        track_progress(written=len(sent), skipped=len(errors))
+
+    def update_counts(self):
+        counts = dict.fromkeys(("Enviado", "Error"), 0)
+        counts.update(dict(frappe.db.sql("""
+            SELECT recipient_status, COUNT(*) FROM `tabMoodle Comms Recipient`
+            WHERE recipient_comms = %s GROUP BY recipient_status
+        """, (self.comms_doc.name,))))
+        self.comms_doc.db_set({"comms_sent": counts["Enviado"], "comms_failed": counts["Error"]})
+        return counts
+
+
+def set_status(names, status, message_ids=None, errors=None):
+    """
+    Actualiza el estado de varios destinatarios en una sola sentencia, con el id de mensaje
+    o el error de cada uno mediante CASE.
+    """
+    if not names:
+        return
+
+    values = {"names": tuple(names), "status": status, "modified": now_datetime()}
+    assignments = ["recipient_status = %(status)s", "modified = %(modified)s"]
+    for fieldname, per_name in (("recipient_message_id", message_ids), ("recipient_error", errors)):
+        if not per_name:
+            continue
+        cases = []
+        for i, name in enumerate(names):
+            values[f"{fieldname}_name_{i}"], values[f"{fieldname}_value_{i}"] = name, per_name.get(name)
+            cases.append(f"WHEN %({fieldname}_name_{i})s THEN %({fieldname}_value_{i})s")
+        assignments.append(f"{fieldname} = CASE name {' '.join(cases)} END")
+
+    frappe.db.sql(f"""
+        UPDATE `tabMoodle Comms Recipient`
+        SET {", ".join(assignments)}
+        WHERE name IN %(names)s
+    """, values)
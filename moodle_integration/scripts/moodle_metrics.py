@@ -0,0 +1,247 @@
+import frappe
+import functools
+import hmac
+import time
+from contextlib import contextmanager, nullcontext
+from werkzeug.wrappers import Response
+from moodle_integration.scripts.moodle_anomaly import record_outcome
+from moodle_integration.scripts.moodle_redis import decode, get_redis, make_key
+from moodle_integration.scripts.moodle_profiler import SyncProfiler, get_active_profiler, should_profile
+from moodle_integration.scripts.moodle_sync_run import SyncRunTracker, get_active_sync_run
+
+# Métricas expuestas: nombre -> (tipo, ayuda)
+METRICS = {
+    "moodle_webhooks_received_total": ("counter", "Webhooks recibidos de Moodle por acción."),
+    "moodle_webhooks_duplicate_total": ("counter", "Reintentos de webhooks ya recibidos descartados por acción."),
+    "moodle_webhooks_rejected_total": ("counter", "Webhooks rechazados antes de procesarse por endpoint y motivo."),
+    "moodle_sync_total": ("counter", "Sincronizaciones ejecutadas por handler y resultado."),
+    "moodle_sync_duration_seconds": ("histogram", "Duración de las sincronizaciones por handler."),
+    "moodle_sync_db_queries": ("histogram", "Consultas SQL ejecutadas por sincronización."),
+    "moodle_rest_requests_total": ("counter", "Peticiones a la API REST de Moodle por wsfunction y resultado."),
+    "moodle_rest_duration_seconds": ("histogram", "Latencia de la API REST de Moodle por wsfunction."),
+    "moodle_scheduler_wait_seconds": ("histogram", "Tiempo de espera en la cola de la instancia hasta su procesamiento."),
+    "moodle_rest_cache_total": ("counter", "Aciertos y fallos de la caché de respuestas de Moodle por wsfunction."),
+}
+
+BUCKETS = {
+    "moodle_sync_duration_seconds": (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+    "moodle_sync_db_queries": (10, 50, 100, 250, 500, 1000, 5000, 10000),
+    "moodle_rest_duration_seconds": (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    "moodle_scheduler_wait_seconds": (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900),
+}
+
+# Argumentos con los que los handlers reciben el ID de la entidad sincronizada
+ENTITY_KEYS = ("course_id", "user_id", "category_id", "cohort_id", "object_id")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _metric_key(name):
+    return make_key(f"moodle_metrics:{name}")
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return ",".join(f'{key}="{_escape_label(value)}"' for key, value in sorted(labels.items()))
+
+
+def inc(name, labels=None, value=1):
+    """
+    Incrementa un contador compartido por todos los workers.
+    Las métricas nunca deben romper una sincronización, así que los errores se ignoran.
+    """
+    try:
+        get_redis().hincrbyfloat(_metric_key(name), _format_labels(labels), value)
+    except Exception:
+        pass
+
+
+def observe(name, value, labels=None):
+    """
+    Registra una observación en un histograma: un campo por bucket más `sum` y `count`,
+    escritos en una sola ida y vuelta a Redis.
+    """
+    try:
+        key = _metric_key(name)
+        label_str = _format_labels(labels)
+        bucket = next((str(le) for le in BUCKETS[name] if value <= le), "+Inf")
+
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.hincrby(key, f"{label_str}|{bucket}", 1)
+        pipe.hincrbyfloat(key, f"{label_str}|sum", value)
+        pipe.hincrby(key, f"{label_str}|count", 1)
+        pipe.execute()
+    except Exception:
+        pass
+
+
+@contextmanager
+def count_queries():
+    """
+    Cuenta las consultas que pasan por frappe.db.sql mientras dura el bloque.
+    """
+    counter = {"queries": 0}
+    db = frappe.db
+    original_sql = db.sql
+
+    def counting_sql(*args, **kwargs):
+        counter["queries"] += 1
+        return original_sql(*args, **kwargs)
+
+    db.sql = counting_sql
+    try:
+        yield counter
+    finally:
+        db.sql = original_sql
+
+
+def track_sync(handler_name):
+    """
+    Decorador para los handlers de `scripts/`: registra duración, consultas SQL y
+    resultado (`status` del dict devuelto) de cada sincronización, la guarda como
+    Moodle Sync Run y la perfila si así se ha pedido (ver moodle_profiler.should_profile).
+    Si ya hay una sincronización en curso (handler anidado) se contabiliza en ella.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            status, message = "error", None
+            moodle_instance_name = kwargs.get("moodle_instance_name")
+            entity_id = next((kwargs[key] for key in ENTITY_KEYS if kwargs.get(key)), None)
+
+            run = None
+            if not get_active_sync_run():
+                run = SyncRunTracker(handler_name, moodle_instance_name, entity_id)
+
+            profiler = None
+            if not get_active_profiler() and should_profile(moodle_instance_name):
+                profiler = SyncProfiler(handler_name, moodle_instance_name, entity_id)
+
+            with count_queries() as counter, (run or nullcontext()):
+                try:
+                    if profiler:
+                        with profiler.profile():
+                            response = fn(*args, **kwargs)
+                    else:
+                        response = fn(*args, **kwargs)
+                    if isinstance(response, dict):
+                        status = response.get("status") or status
+                        message = response.get("message")
+                    return response
+                finally:
+                    labels = {"handler": handler_name}
+                    observe("moodle_sync_duration_seconds", time.monotonic() - start, labels)
+                    observe("moodle_sync_db_queries", counter["queries"], labels)
+                    inc("moodle_sync_total", {**labels, "status": status})
+                    record_outcome(moodle_instance_name, handler_name, status == "error")
+                    profile_name = profiler.save(status) if profiler else None
+                    if run:
+                        run.finish(status, message, profile_name)
+        return wrapper
+    return decorator
+
+
+def _format_value(value):
+    # Valores exactos: con :g un contador por encima de 999999 se redondea a 6 cifras y
+    # parece congelado entre scrapes, así que rate() lo lee como 0
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _render_histogram(name, fields, lines):
+    series = {}
+    for field, value in fields.items():
+        label_str, _, suffix = field.rpartition("|")
+        series.setdefault(label_str, {})[suffix] = float(value)
+
+    for label_str, values in sorted(series.items()):
+        prefix = f"{label_str}," if label_str else ""
+        cumulative = 0
+        for le in [str(le) for le in BUCKETS[name]] + ["+Inf"]:
+            cumulative += values.get(le, 0)
+            lines.append(f'{name}_bucket{{{prefix}le="{le}"}} {_format_value(cumulative)}')
+        labels = f"{{{label_str}}}" if label_str else ""
+        lines.append(f"{name}_sum{labels} {_format_value(values.get('sum', 0))}")
+        lines.append(f"{name}_count{labels} {_format_value(values.get('count', 0))}")
+
+
+def _collect_gauges(lines):
+    """
+    Métricas que se calculan en el momento del scrape: profundidad de colas y eventos fallidos.
+    """
+    from frappe.utils.background_jobs import get_queues
+    from moodle_integration.scripts.moodle_response_cache import get_cache_size
+    from moodle_integration.scripts.moodle_scheduler import get_backlog_stats
+
+    lines.append("# HELP moodle_queue_depth Trabajos pendientes en cada cola de RQ.")
+    lines.append("# TYPE moodle_queue_depth gauge")
+    for queue in get_queues():
+        lines.append(f'moodle_queue_depth{{{_format_labels({"queue": queue.name})}}} {queue.count}')
+
+    backlog_stats = get_backlog_stats()
+    lines.append("# HELP moodle_instance_backlog Eventos en la cola propia de cada instancia por carril.")
+    lines.append("# TYPE moodle_instance_backlog gauge")
+    for instance, lane, backlog, _ in backlog_stats:
+        lines.append(f'moodle_instance_backlog{{{_format_labels({"instance": instance, "lane": lane})}}} {backlog}')
+    lines.append("# HELP moodle_instance_inflight Trabajos en curso de cada instancia por carril.")
+    lines.append("# TYPE moodle_instance_inflight gauge")
+    for instance, lane, _, inflight in backlog_stats:
+        lines.append(f'moodle_instance_inflight{{{_format_labels({"instance": instance, "lane": lane})}}} {inflight}')
+
+    lines.append("# HELP moodle_rest_cache_entries Respuestas de Moodle en la caché compartida.")
+    lines.append("# TYPE moodle_rest_cache_entries gauge")
+    lines.append(f"moodle_rest_cache_entries {get_cache_size()}")
+
+    pending = frappe.db.sql("""
+        SELECT failed_instance, COUNT(*)
+        FROM `tabMoodle Failed Event`
+        WHERE failed_status = 'Pendiente'
+        GROUP BY failed_instance
+    """)
+    lines.append("# HELP moodle_failed_events_pending Eventos pendientes de reprocesar por instancia.")
+    lines.append("# TYPE moodle_failed_events_pending gauge")
+    for instance, count in pending:
+        lines.append(f'moodle_failed_events_pending{{{_format_labels({"instance": instance})}}} {count}')
+
+
+def render_metrics():
+    redis_client = get_redis()
+    lines = []
+
+    for name, (metric_type, help_text) in METRICS.items():
+        fields = {
+            decode(field): value
+            for field, value in redis_client.hgetall(_metric_key(name)).items()
+        }
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        if metric_type == "histogram":
+            _render_histogram(name, fields, lines)
+        else:
+            for label_str, value in sorted(fields.items()):
+                labels = f"{{{label_str}}}" if label_str else ""
+                lines.append(f"{name}{labels} {_format_value(value)}")
+
+    _collect_gauges(lines)
+    return "\n".join(lines) + "\n"
+
+
+@frappe.whitelist(allow_guest=True)
+def metrics():
+    """
+    Endpoint de métricas en formato texto de Prometheus.
+    Requiere `Authorization: Bearer <moodle_metrics_token>` (site_config) o un System Manager.
+    """
+    token = frappe.conf.get("moodle_metrics_token")
+    auth_header = frappe.get_request_header("Authorization") or ""
+
+    if not (token and hmac.compare_digest(auth_header.encode(), f"Bearer {token}".encode())) and "System Manager" not in frappe.get_roles():
+        raise frappe.PermissionError
+
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
@@ -0,0 +1,134 @@
+import cProfile
+import frappe
+import io
+import json
+import pstats
+import time
+from contextlib import contextmanager
+
+PROFILE_HEADER = "X-Moodle-Profile"
+# Límites para que el informe guardado sea compacto
+TOP_SQL = 25
+TOP_FUNCTIONS = 40
+MAX_QUERY_LENGTH = 500
+
+
+def _can_request_profile():
+    # La cabecera solo vale en una sesión de System Manager o en un webhook con firma verificada:
+    # cualquiera puede enviarla a los endpoints públicos y el perfilado no es gratis
+    if getattr(frappe.local, "moodle_webhook_signed", False):
+        return True
+    return frappe.session.user != "Guest" and "System Manager" in frappe.get_roles()
+
+
+def should_profile(moodle_instance_name=None):
+    """
+    El perfilado se activa con la cabecera `X-Moodle-Profile: 1` en una petición autenticada
+    (ver _can_request_profile) o con la casilla `profile_syncs` de la Moodle Instance.
+    """
+    # Los trabajos en segundo plano no tienen petición: solo cuenta la casilla de la instancia
+    request = getattr(frappe.local, "request", None)
+    if request and frappe.get_request_header(PROFILE_HEADER) in ("1", "true") and _can_request_profile():
+        return True
+    if moodle_instance_name:
+        return bool(frappe.get_cached_value("Moodle Instance", moodle_instance_name, "profile_syncs"))
+    return False
+
+
+def get_active_profiler():
+    return getattr(frappe.local, "moodle_sync_profiler", None)
+
+
+class SyncProfiler:
+    """
+    Recoge las consultas SQL, las llamadas a Moodle y un perfil de cProfile de una sincronización
+    y lo guarda como un Moodle Sync Profile.
+    """
+
+    def __init__(self, handler_name, moodle_instance_name=None, entity_id=None):
+        self.handler_name = handler_name
+        self.moodle_instance_name = moodle_instance_name
+        self.entity_id = entity_id
+        self.queries = {}
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.rest_calls = []
+        self.duration = 0.0
+        self.stats = None
+
+    def record_sql(self, query, elapsed):
+        self.sql_count += 1
+        self.sql_time += elapsed
+        key = " ".join(str(query).split())[:MAX_QUERY_LENGTH]
+        entry = self.queries.setdefault(key, {"count": 0, "time": 0.0, "max": 0.0})
+        entry["count"] += 1
+        entry["time"] += elapsed
+        entry["max"] = max(entry["max"], elapsed)
+
+    def record_rest(self, wsfunction, elapsed, size, status):
+        self.rest_calls.append({
+            "wsfunction": wsfunction,
+            "time": round(elapsed, 4),
+            "bytes": size,
+            "status": status,
+        })
+
+    @contextmanager
+    def profile(self):
+        db = frappe.db
+        original_sql = db.sql
+
+        def timed_sql(query, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original_sql(query, *args, **kwargs)
+            finally:
+                self.record_sql(query, time.perf_counter() - start)
+
+        profiler = cProfile.Profile()
+        frappe.local.moodle_sync_profiler = self
+        db.sql = timed_sql
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            yield self
+        finally:
+            profiler.disable()
+            self.duration = time.perf_counter() - start
+            db.sql = original_sql
+            frappe.local.moodle_sync_profiler = None
+            self.stats = profiler
+
+    def _cpu_report(self):
+        output = io.StringIO()
+        pstats.Stats(self.stats, stream=output).strip_dirs().sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        return output.getvalue()
+
+    def build_report(self):
+        slowest = sorted(self.queries.items(), key=lambda item: item[1]["time"], reverse=True)[:TOP_SQL]
+        return {
+            "sql": [
+                {"query": query, "count": data["count"], "time": round(data["time"], 4), "max": round(data["max"], 4)}
+                for query, data in slowest
+            ],
+            "rest": self.rest_calls,
+            "cpu": self._cpu_report() if self.stats else "",
+        }
+
+    def save(self, status=None):
+        profile_doc = frappe.get_doc({
+            "doctype": "Moodle Sync Profile",
+            "profile_handler": self.handler_name,
+            "profile_instance": self.moodle_instance_name,
+            "profile_entity_id": self.entity_id,
+            "profile_status": status,
+            "profile_duration": round(self.duration, 4),
+            "profile_sql_count": self.sql_count,
+            "profile_sql_time": round(self.sql_time, 4),
+            "profile_rest_count": len(self.rest_calls),
+            "profile_rest_time": round(sum(call["time"] for call in self.rest_calls), 4),
+            "profile_rest_bytes": sum(call["bytes"] for call in self.rest_calls),
+            "profile_report": json.dumps(self.build_report(), indent=1),
+        })
+        profile_doc.insert(ignore_permissions=True)
+        return profile_doc.name
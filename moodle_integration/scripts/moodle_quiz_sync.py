@@ -0,0 +1,342 @@
+import asyncio
+import frappe
+import httpx
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from frappe.utils import cint, convert_utc_to_system_timezone, flt, now_datetime
+from moodle_integration.scripts.moodle_api import build_api_url, moodle_request_async
+from moodle_integration.scripts.moodle_metrics import track_sync
+from moodle_integration.scripts.moodle_sync_run import track_progress, track_total
+
+DEFAULT_CONCURRENCY = 8
+# Cursos por llamada a mod_quiz_get_quizzes_by_courses
+COURSE_CHUNK_SIZE = 50
+# Estudiantes consultados a la vez dentro de un cuestionario
+STUDENT_PAGE_SIZE = 200
+UPSERT_CHUNK_SIZE = 500
+# Margen tras el cierre de un cuestionario para los intentos que se envían fuera de plazo
+CLOSED_GRACE_SECONDS = 24 * 3600
+
+ATTEMPT_FIELDS = (
+    "attempt_quiz", "attempt_user", "attempt_moodle_user_id", "attempt_moodle_id", "attempt_number",
+    "attempt_state", "attempt_started", "attempt_finished", "attempt_sum_grades", "attempt_grade",
+)
+
+
+def _from_unix(timestamp):
+    if not timestamp:
+        return None
+    return convert_utc_to_system_timezone(datetime.utcfromtimestamp(timestamp)).replace(tzinfo=None)
+
+
+def sync_all_quizzes():
+    """
+    Tarea programada: encola la ingesta de intentos de cada instancia que la tenga activa.
+    """
+    for moodle_instance_name in frappe.get_all("Moodle Instance", filters={"sync_quizzes": 1}, pluck="name"):
+        frappe.enqueue(
+            "moodle_integration.scripts.moodle_quiz_sync.run_quiz_sync",
+            queue="long",
+            timeout=6 * 3600,
+            job_id=f"moodle_quiz_sync:{moodle_instance_name}",
+            deduplicate=True,
+            moodle_instance_name=moodle_instance_name,
+        )
+
+
+@frappe.whitelist()
+def sync_quizzes(moodle_instance, course_ids=None, concurrency=None):
+    """
+    Encola la ingesta de cuestionarios e intentos de una Moodle Instance.
+    Sin `course_ids` se recorren todos sus cursos.
+    """
+    frappe.only_for("System Manager")
+
+    if isinstance(course_ids, str):
+        course_ids = frappe.parse_json(course_ids)
+
+    frappe.enqueue(
+        "moodle_integration.scripts.moodle_quiz_sync.run_quiz_sync",
+        queue="long",
+        timeout=6 * 3600,
+        moodle_instance_name=moodle_instance,
+        course_ids=course_ids,
+        concurrency=cint(concurrency) or None,
+    )
+    return {"status": "success", "message": "Ingesta de cuestionarios encolada."}
+
+
+@track_sync("quiz_sync")
+def run_quiz_sync(moodle_instance_name, course_ids=None, concurrency=None):
+    instance = frappe.db.get_value(
+        "Moodle Instance", moodle_instance_name, ["name", "api_key", "site_url", "max_concurrent_requests"], as_dict=True
+    )
+    if not instance:
+        return {"status": "error", "message": f"No se encontró la Moodle Instance {moodle_instance_name}."}
+
+    filters = {"course_instance": instance.name}
+    if course_ids:
+        filters["course_code"] = ["in", [str(course_id) for course_id in course_ids]]
+    courses = dict(frappe.get_all("Moodle Course", filters=filters, fields=["course_code", "name"], as_list=True))
+
+    sync = QuizAttemptSync(instance, concurrency or instance.max_concurrent_requests or DEFAULT_CONCURRENCY)
+    asyncio.run(sync.run(courses))
+
+    message = (
+        f"Cuestionarios: {sync.quizzes}, omitidos por estar cerrados: {sync.closed}, "
+        f"intentos nuevos: {sync.written}, con errores: {len(sync.errors)}."
+    )
+    if sync.errors:
+        frappe.log_error("\n".join(sync.errors), f"Ingesta de cuestionarios - {instance.name}")
+    return {"status": "success", "message": message}
+
+
+class QuizAttemptSync:
+    """
+    Ingesta en streaming de intentos de cuestionario: los cuestionarios se descargan por lotes
+    de cursos, los intentos de varios cuestionarios en paralelo con concurrencia acotada
+    (recorriendo sus estudiantes por páginas) y un escritor los va insertando cuestionario a
+    cuestionario. Cada intento se guarda como "{instancia} {id del intento}", así que repetir
+    una ingesta no duplica filas.
+
+    Moodle no permite filtrar intentos por fecha, así que la marca de agua de cada cuestionario
+    (hora de Moodle en que empezó su última descarga completa) sirve para no volver a escribir
+    los intentos terminados antes y para no consultar siquiera los cuestionarios que ya estaban
+    cerrados (con su margen) en esa descarga. Las ampliaciones de plazo por usuario no se
+    tienen en cuenta.
+    """
+
+    def __init__(self, instance, concurrency):
+        self.instance = instance
+        self.api_url = build_api_url(instance.site_url)
+        self.concurrency = concurrency
+        self.quizzes = self.closed = self.written = 0
+        self.errors = []
+        self.students = {}
+        # Hora de Moodle (UNIX) de la última respuesta recibida, leída de su cabecera Date
+        self.server_time = None
+
+    async def read_server_time(self, response):
+        date = response.headers.get("date")
+        if date:
+            self.server_time = int(parsedate_to_datetime(date).timestamp())
+
+    def params(self, wsfunction, **extra):
+        return {
+            "wstoken": self.instance.api_key,
+            "wsfunction": wsfunction,
+            "moodlewsrestformat": "json",
+            **extra,
+        }
+
+    async def fetch(self, client, params):
+        return await moodle_request_async(client, self.instance.name, self.api_url, params)
+
+    async def fetch_quizzes(self, client, course_ids):
+        chunks = [course_ids[i:i + COURSE_CHUNK_SIZE] for i in range(0, len(course_ids), COURSE_CHUNK_SIZE)]
+        results = await asyncio.gather(*(
+            self.fetch(client, self.params(
+                "mod_quiz_get_quizzes_by_courses",
+                **{f"courseids[{i}]": course_id for i, course_id in enumerate(chunk)},
+            ))
+            for chunk in chunks
+        ))
+        return [quiz for result in results for quiz in result.get("quizzes", [])]
+
+    def get_students(self, course_name):
+        if course_name not in self.students:
+            self.students[course_name] = dict(frappe.db.sql("""
+                SELECT mu.user_id, mu.name
+                FROM `tabMoodle Students Course` row
+                INNER JOIN `tabMoodle User` mu ON mu.name = row.user_student
+                WHERE row.parent = %s AND row.parenttype = 'Moodle Course' AND IFNULL(mu.user_id, '') != ''
+            """, (course_name,)))
+        return self.students[course_name]
+
+    async def fetch_user_attempts(self, client, semaphore, quiz_id, user_id):
+        async with semaphore:
+            result = await self.fetch(client, self.params(
+                "mod_quiz_get_user_attempts", quizid=quiz_id, userid=user_id, status="finished"
+            ))
+        return result.get("attempts", [])
+
+    async def fetch_quiz_attempts(self, client, semaphore, quiz, students, queue):
+        # Los intentos que terminen mientras se recorren los estudiantes quedan después de esta
+        # hora: la marca de agua no pasa de ella para recogerlos en la próxima ingesta
+        started = self.server_time
+        attempts, failed = [], 0
+        user_ids = list(students)
+        for i in range(0, len(user_ids), STUDENT_PAGE_SIZE):
+            results = await asyncio.gather(
+                *(self.fetch_user_attempts(client, semaphore, quiz["id"], user_id) for user_id in user_ids[i:i + STUDENT_PAGE_SIZE]),
+                return_exceptions=True,
+            )
+            for result in results:
+                if isinstance(result, Exception):
+                    failed += 1
+                else:
+                    attempts.extend(result)
+
+        if failed:
+            self.errors.append(f"Cuestionario {quiz['id']}: {failed} estudiantes con errores.")
+        await queue.put((quiz, attempts, None if failed else started))
+
+    async def write_results(self, queue, writer):
+        while (item := await queue.get()) is not None:
+            quiz, attempts, started = item
+            try:
+                self.written += writer.write(quiz, attempts, started)
+                frappe.db.commit()
+                track_progress(written=1)
+            except Exception as e:
+                frappe.db.rollback()
+                self.errors.append(f"Cuestionario {quiz['id']}: {str(e)}")
+                track_progress(skipped=1)
+
+    async def run(self, courses):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # Cola acotada: si la escritura va por detrás, las descargas esperan
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        writer = QuizAttemptWriter(self.instance.name, courses)
+
+        async with httpx.AsyncClient(limits=limits, event_hooks={"response": [self.read_server_time]}) as client:
+            quizzes = await self.fetch_quizzes(client, sorted(courses))
+            watermarks = writer.upsert_quizzes(quizzes)
+            frappe.db.commit()
+            self.quizzes = len(quizzes)
+
+            pending = []
+            for quiz in quizzes:
+                watermark = watermarks.get(str(quiz["id"]), 0)
+                # Cerrado (con su margen) antes de la última descarga completa: no puede tener intentos nuevos
+                if watermark and quiz.get("timeclose") and quiz["timeclose"] + CLOSED_GRACE_SECONDS < watermark:
+                    self.closed += 1
+                elif str(quiz.get("course")) in courses:
+                    pending.append(quiz)
+            track_total(len(pending))
+
+            writer_task = asyncio.create_task(self.write_results(queue, writer))
+            await asyncio.gather(*(
+                self.fetch_quiz_attempts(client, semaphore, quiz, self.get_students(courses[str(quiz["course"])]), queue)
+                for quiz in pending
+            ))
+            await queue.put(None)
+            await writer_task
+
+
+class QuizAttemptWriter:
+    """
+    Guarda los cuestionarios y los intentos terminados desde su marca de agua con INSERT en bloque.
+    """
+
+    def __init__(self, moodle_instance_name, courses):
+        self.moodle_instance_name = moodle_instance_name
+        self.courses = courses
+
+    def get_quiz_name(self, quiz_id):
+        return f"{self.moodle_instance_name} {quiz_id}"
+
+    def upsert_quizzes(self, quizzes):
+        """
+        Crea o actualiza las Moodle Quiz y devuelve la marca de agua de cada una por ID de Moodle.
+        """
+        existing = {
+            quiz.name: quiz
+            for quiz in frappe.get_all(
+                "Moodle Quiz",
+                filters={"quiz_instance": self.moodle_instance_name},
+                fields=["name", "quiz_attempts_watermark"],
+            )
+        }
+        watermarks = {}
+        for quiz in quizzes:
+            name = self.get_quiz_name(quiz["id"])
+            values = {
+                "quiz_name": quiz.get("name"),
+                "quiz_course": self.courses.get(str(quiz.get("course"))),
+                "quiz_instance": self.moodle_instance_name,
+                "quiz_moodle_id": str(quiz["id"]),
+                "quiz_course_module": str(quiz.get("coursemodule") or ""),
+                "quiz_max_grade": flt(quiz.get("grade")),
+                "quiz_sum_grades": flt(quiz.get("sumgrades")),
+                "quiz_open": _from_unix(quiz.get("timeopen")),
+                "quiz_close": _from_unix(quiz.get("timeclose")),
+            }
+            if name in existing:
+                frappe.db.set_value("Moodle Quiz", name, values)
+                watermarks[str(quiz["id"])] = cint(existing[name].quiz_attempts_watermark)
+            else:
+                frappe.get_doc({"doctype": "Moodle Quiz", **values}).insert(ignore_permissions=True, set_name=name)
+                watermarks[str(quiz["id"])] = 0
+        return watermarks
+
+    def write(self, quiz, attempts, started=None):
+        """
+        Guarda los intentos terminados desde la marca de agua (incluido el mismo segundo: las filas
+        se sobrescriben por nombre) y, si la descarga fue completa, avanza la marca hasta `started`.
+        """
+        quiz_name = self.get_quiz_name(quiz["id"])
+        watermark = cint(frappe.db.get_value("Moodle Quiz", quiz_name, "quiz_attempts_watermark"))
+        new_attempts = [attempt for attempt in attempts if cint(attempt.get("timefinish")) >= watermark]
+        if new_attempts:
+            self.write_attempts(quiz, quiz_name, new_attempts)
+
+        # Con estudiantes fallidos la marca no avanza: sus intentos se recogerán en la próxima ingesta
+        if started and started > watermark:
+            frappe.db.set_value("Moodle Quiz", quiz_name, "quiz_attempts_watermark", started, update_modified=False)
+        return len(new_attempts)
+
+    def write_attempts(self, quiz, quiz_name, new_attempts):
+        users = self.get_users({str(attempt["userid"]) for attempt in new_attempts})
+        sum_grades, max_grade = flt(quiz.get("sumgrades")), flt(quiz.get("grade"))
+        rows = [
+            (
+                f"{self.moodle_instance_name} {attempt['id']}",
+                {
+                    "attempt_quiz": quiz_name,
+                    "attempt_user": users.get(str(attempt["userid"])),
+                    "attempt_moodle_user_id": str(attempt["userid"]),
+                    "attempt_moodle_id": str(attempt["id"]),
+                    "attempt_number": cint(attempt.get("attempt")),
+                    "attempt_state": attempt.get("state"),
+                    "attempt_started": _from_unix(attempt.get("timestart")),
+                    "attempt_finished": _from_unix(attempt.get("timefinish")),
+                    "attempt_sum_grades": attempt.get("sumgrades"),
+                    # Los puntos del intento se escalan a la calificación máxima del cuestionario
+                    "attempt_grade": (
+                        round(flt(attempt["sumgrades"]) * max_grade / sum_grades, 5)
+                        if attempt.get("sumgrades") is not None and sum_grades else None
+                    ),
+                },
+            )
+            for attempt in new_attempts
+        ]
+        self.upsert(rows)
+
+    def get_users(self, user_ids):
+        return dict(frappe.get_all(
+            "Moodle User",
+            filters={"user_instance": self.moodle_instance_name, "user_id": ["in", list(user_ids)]},
+            fields=["user_id", "name"],
+            as_list=True,
+        ))
+
+    def upsert(self, rows):
+        timestamp, user = now_datetime(), frappe.session.user
+        columns = ("name", "creation", "modified", "owner", "modified_by", "docstatus", "idx", *ATTEMPT_FIELDS)
+        updates = ", ".join(f"`{column}` = VALUES(`{column}`)" for column in ("modified", "modified_by", *ATTEMPT_FIELDS))
+
+        for i in range(0, len(rows), UPSERT_CHUNK_SIZE):
+            chunk = rows[i:i + UPSERT_CHUNK_SIZE]
+            placeholders = ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(chunk))
+            values = [
+                value
+                for name, fields in chunk
+                for value in (name, timestamp, timestamp, user, user, 0, 0, *(fields[field] for field in ATTEMPT_FIELDS))
+            ]
+            frappe.db.sql(f"""
+                INSERT INTO `tabMoodle Quiz Attempt` ({", ".join(f"`{column}`" for column in columns)})
+                VALUES {placeholders}
+                ON DUPLICATE KEY UPDATE {updates}
+            """, values)
@@ -0,0 +1,206 @@
+import asyncio
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+
+import frappe
+
+from moodle_integration.scripts.moodle_redis import get_redis, make_key
+
+# Valores por defecto si la Moodle Instance no define sus propios límites
+DEFAULT_MAX_CONCURRENT_REQUESTS = 4
+DEFAULT_MAX_REQUESTS_PER_SECOND = 10
+DEFAULT_TARGET_LATENCY_MS = 2000
+DEFAULT_ACQUIRE_TIMEOUT = 60
+
+# Tiempo máximo que una petición puede mantener su plaza antes de darse por perdida
+LEASE_TTL_MS = 120000
+LIMITS_CACHE_TTL = 300
+
+TOKEN_TIMEOUT_MESSAGE = "Límite de peticiones por segundo alcanzado para {}."
+SLOT_TIMEOUT_MESSAGE = "Demasiadas peticiones simultáneas a {}."
+
+# Token bucket: devuelve 0 si se consume un token o los ms a esperar hasta el siguiente
+TOKEN_BUCKET_LUA = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+local rate = tonumber(ARGV[1])
+local capacity = math.max(rate, 1)
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate / 1000)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity * 1000 / rate) + 1000)
+return wait
+"""
+
+# Semáforo distribuido: reserva una plaza si hay hueco según el límite adaptativo actual
+ACQUIRE_SLOT_LUA = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local limit = tonumber(redis.call('GET', KEYS[2]) or ARGV[2])
+if redis.call('ZCARD', KEYS[1]) < math.max(1, math.floor(limit)) then
+    redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[1])
+    redis.call('PEXPIRE', KEYS[1], tonumber(ARGV[3]))
+    return 1
+end
+return 0
+"""
+
+# AIMD: suma 1/limit por respuesta rápida y divide a la mitad ante respuestas lentas o errores
+ADJUST_LIMIT_LUA = """
+local max_limit = tonumber(ARGV[1])
+local limit = tonumber(redis.call('GET', KEYS[1]) or ARGV[1])
+if ARGV[2] == '1' then
+    if redis.call('SET', KEYS[2], '1', 'NX', 'PX', tonumber(ARGV[3])) then
+        limit = math.max(1, limit / 2)
+    end
+else
+    limit = math.min(max_limit, limit + 1 / limit)
+end
+redis.call('SET', KEYS[1], tostring(limit), 'EX', 3600)
+return tostring(limit)
+"""
+
+
+class MoodleRateLimitTimeout(Exception):
+    pass
+
+
+def get_instance_limits(moodle_instance_name):
+    """
+    Devuelve los límites configurados en la Moodle Instance, cacheados unos minutos
+    para no consultar la base de datos en cada petición.
+    """
+    cache = frappe.cache()
+    cache_key = f"moodle_rl_limits:{moodle_instance_name}"
+    limits = cache.get_value(cache_key)
+    if limits:
+        return limits
+
+    values = frappe.db.get_value(
+        "Moodle Instance",
+        moodle_instance_name,
+        ["max_concurrent_requests", "max_requests_per_second", "target_latency_ms"],
+        as_dict=True,
+    ) or {}
+    limits = {
+        "max_concurrent_requests": values.get("max_concurrent_requests") or DEFAULT_MAX_CONCURRENT_REQUESTS,
+        "max_requests_per_second": values.get("max_requests_per_second") or DEFAULT_MAX_REQUESTS_PER_SECOND,
+        "target_latency_ms": values.get("target_latency_ms") or DEFAULT_TARGET_LATENCY_MS,
+    }
+    cache.set_value(cache_key, limits, expires_in_sec=LIMITS_CACHE_TTL)
+    return limits
+
+
+def clear_instance_limits(moodle_instance_name):
+    frappe.cache().delete_value(f"moodle_rl_limits:{moodle_instance_name}")
+
+
+class MoodleRateLimiter:
+    """
+    Limitador compartido entre workers (vía Redis) para una Moodle Instance.
+    Combina un máximo de peticiones simultáneas, que se ajusta con AIMD según la latencia
+    observada, y un token bucket de peticiones por segundo.
+    """
+
+    def __init__(self, moodle_instance_name):
+        self.moodle_instance_name = moodle_instance_name
+        self.limits = get_instance_limits(moodle_instance_name)
+        self.redis = get_redis()
+        prefix = f"moodle_rl:{moodle_instance_name}"
+        self.bucket_key = make_key(f"{prefix}:bucket")
+        self.inflight_key = make_key(f"{prefix}:inflight")
+        self.limit_key = make_key(f"{prefix}:limit")
+        self.backoff_key = make_key(f"{prefix}:backoff")
+
+    def _take_token(self):
+        script = self.redis.register_script(TOKEN_BUCKET_LUA)
+        return int(script(keys=[self.bucket_key], args=[self.limits["max_requests_per_second"]]))
+
+    def _try_acquire_slot(self, lease_id):
+        script = self.redis.register_script(ACQUIRE_SLOT_LUA)
+        return bool(int(script(
+            keys=[self.inflight_key, self.limit_key],
+            args=[lease_id, self.limits["max_concurrent_requests"], LEASE_TTL_MS],
+        )))
+
+    def _check_deadline(self, deadline, wait, message):
+        if time.monotonic() + wait > deadline:
+            raise MoodleRateLimitTimeout(message.format(self.moodle_instance_name))
+
+    def _wait_for_token(self, deadline):
+        while wait_ms := self._take_token():
+            self._check_deadline(deadline, wait_ms / 1000, TOKEN_TIMEOUT_MESSAGE)
+            time.sleep(wait_ms / 1000)
+
+    def _acquire_slot(self, lease_id, deadline):
+        delay = 0.01
+        while not self._try_acquire_slot(lease_id):
+            self._check_deadline(deadline, delay, SLOT_TIMEOUT_MESSAGE)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+    async def _async_wait_for_token(self, deadline):
+        while wait_ms := self._take_token():
+            self._check_deadline(deadline, wait_ms / 1000, TOKEN_TIMEOUT_MESSAGE)
+            await asyncio.sleep(wait_ms / 1000)
+
+    async def _async_acquire_slot(self, lease_id, deadline):
+        delay = 0.01
+        while not self._try_acquire_slot(lease_id):
+            self._check_deadline(deadline, delay, SLOT_TIMEOUT_MESSAGE)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+    def _release_slot(self, lease_id):
+        self.redis.zrem(self.inflight_key, lease_id)
+
+    def record_response(self, elapsed_ms, failed=False):
+        """
+        Ajusta el límite de concurrencia: aumento aditivo si Moodle responde dentro de la
+        latencia objetivo, reducción multiplicativa (como mucho una vez por ventana) si no.
+        """
+        congested = failed or elapsed_ms > self.limits["target_latency_ms"]
+        script = self.redis.register_script(ADJUST_LIMIT_LUA)
+        return float(script(
+            keys=[self.limit_key, self.backoff_key],
+            args=[
+                self.limits["max_concurrent_requests"],
+                "1" if congested else "0",
+                max(int(self.limits["target_latency_ms"]), 1000),
+            ],
+        ))
+
+    @contextmanager
+    def slot(self, acquire_timeout=DEFAULT_ACQUIRE_TIMEOUT):
+        deadline = time.monotonic() + acquire_timeout
+        lease_id = uuid.uuid4().hex
+        self._acquire_slot(lease_id, deadline)
+        try:
+            self._wait_for_token(deadline)
+            yield self
+        finally:
+            self._release_slot(lease_id)
+
+    @asynccontextmanager
+    async def async_slot(self, acquire_timeout=DEFAULT_ACQUIRE_TIMEOUT):
+        """
+        Igual que slot() pero esperando con asyncio.sleep, para el motor de sincronización masiva.
+        """
+        deadline = time.monotonic() + acquire_timeout
+        lease_id = uuid.uuid4().hex
+        await self._async_acquire_slot(lease_id, deadline)
+        try:
+            await self._async_wait_for_token(deadline)
+            yield self
+        finally:
+            self._release_slot(lease_id)
@@ -0,0 +1,23 @@
+import frappe
+import redis
+
+
+def get_redis():
+    """
+    Cliente Redis que comparte el pool de conexiones de frappe.cache() pero sin su envoltorio
+    (que añade prefijos a las claves y serializa con pickle). Se usa para contadores,
+    hashes y scripts Lua cuyas claves se construyen con make_key().
+    """
+    client = getattr(frappe.local, "moodle_redis", None)
+    if client is None:
+        client = redis.Redis(connection_pool=frappe.cache().connection_pool)
+        frappe.local.moodle_redis = client
+    return client
+
+
+def make_key(key):
+    return frappe.cache().make_key(key)
+
+
+def decode(value):
+    return value.decode() if isinstance(value, bytes) else value
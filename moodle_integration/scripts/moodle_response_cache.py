@@ -0,0 +1,136 @@
+import frappe
+import hashlib
+import json
+import time
+from moodle_integration.scripts.moodle_metrics import inc
+from moodle_integration.scripts.moodle_redis import decode, get_redis, make_key
+
+# wsfunction -> TTL en segundos. Solo se cachean respuestas de estas funciones
+CACHEABLE_FUNCTIONS = {
+    "core_group_get_course_groups": 300,
+    "core_course_get_categories": 900,
+    "local_wsgetroles_get_roles": 3600,
+}
+# Límites de tamaño: entradas totales (se expulsan las menos usadas) y bytes por respuesta
+MAX_ENTRIES = 5000
+MAX_RESPONSE_BYTES = 512 * 1024
+
+INDEX_KEY = "moodle_rest_cache:index"
+
+
+def _cache_key(moodle_instance_name, params):
+    # El token no forma parte de la clave: la instancia ya identifica las credenciales
+    relevant = sorted((k, str(v)) for k, v in params.items() if k != "wstoken")
+    digest = hashlib.sha1(json.dumps(relevant).encode()).hexdigest()
+    return make_key(f"moodle_rest_cache:{moodle_instance_name}:{params.get('wsfunction')}:{digest}")
+
+
+def _tag_key(moodle_instance_name, tag):
+    return make_key(f"moodle_rest_cache:tag:{moodle_instance_name}:{tag}")
+
+
+def get_tags(params):
+    """
+    Etiquetas de invalidación de una respuesta según la función y sus parámetros.
+    """
+    wsfunction = params.get("wsfunction")
+    if wsfunction == "core_group_get_course_groups":
+        return [f"course:{params.get('courseid')}"]
+    if wsfunction == "core_course_get_categories":
+        return ["categories"]
+    if wsfunction == "local_wsgetroles_get_roles":
+        return ["roles"]
+    return []
+
+
+def get_cached_response(moodle_instance_name, params):
+    wsfunction = params.get("wsfunction")
+    if wsfunction not in CACHEABLE_FUNCTIONS:
+        return None
+
+    redis_client = get_redis()
+    key = _cache_key(moodle_instance_name, params)
+    body = redis_client.get(key)
+
+    labels = {"instance": moodle_instance_name, "wsfunction": wsfunction}
+    if body is None:
+        inc("moodle_rest_cache_total", {**labels, "result": "miss"})
+        return None
+
+    redis_client.zadd(make_key(INDEX_KEY), {key: time.time()})
+    inc("moodle_rest_cache_total", {**labels, "result": "hit"})
+    return body
+
+
+def set_cached_response(moodle_instance_name, params, body):
+    wsfunction = params.get("wsfunction")
+    ttl = CACHEABLE_FUNCTIONS.get(wsfunction)
+    if not ttl or len(body) > MAX_RESPONSE_BYTES:
+        return
+
+    redis_client = get_redis()
+    key = _cache_key(moodle_instance_name, params)
+    index_key = make_key(INDEX_KEY)
+
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.set(key, body, ex=ttl)
+    pipe.zadd(index_key, {key: time.time()})
+    for tag in get_tags(params):
+        pipe.sadd(_tag_key(moodle_instance_name, tag), key)
+        pipe.expire(_tag_key(moodle_instance_name, tag), max(CACHEABLE_FUNCTIONS.values()))
+    pipe.execute()
+
+    # Expulsar las entradas usadas hace más tiempo si se supera el máximo
+    overflow = redis_client.zcard(index_key) - MAX_ENTRIES
+    if overflow > 0:
+        evicted = [key for key, _ in redis_client.zpopmin(index_key, overflow)]
+        if evicted:
+            redis_client.delete(*evicted)
+
+
+def invalidate_moodle_cache(moodle_instance_name, tags):
+    """
+    Borra las respuestas cacheadas con alguna de las etiquetas indicadas.
+    """
+    redis_client = get_redis()
+    for tag in tags:
+        tag_key = _tag_key(moodle_instance_name, tag)
+        keys = list(redis_client.smembers(tag_key))
+        if keys:
+            redis_client.delete(*keys)
+            redis_client.zrem(make_key(INDEX_KEY), *keys)
+        redis_client.delete(tag_key)
+
+
+def get_invalidation_tags(action, payload):
+    """
+    Etiquetas a invalidar cuando llega un webhook, con el curso tomado del propio evento
+    (`course_id` en los de curso, `courseid` en los de grupo). Los eventos de matriculación
+    no invalidan los grupos del curso, que es justo lo que se quiere aprovechar en sus ráfagas.
+    """
+    if "group" in action or action in ("update_course", "delete_course"):
+        course_id = payload.get("course_id") or payload.get("courseid")
+        return [f"course:{course_id}"] if course_id else []
+    if action.endswith("_category"):
+        return ["categories"]
+    if action.endswith("_role"):
+        return ["roles"]
+    return []
+
+
+@frappe.whitelist()
+def clear_moodle_cache(moodle_instance=None):
+    frappe.only_for("System Manager")
+
+    redis_client = get_redis()
+    index_key = make_key(INDEX_KEY)
+    prefix = decode(make_key(f"moodle_rest_cache:{moodle_instance}:" if moodle_instance else "moodle_rest_cache:"))
+    keys = [key for key in redis_client.zrange(index_key, 0, -1) if decode(key).startswith(prefix)]
+    if keys:
+        redis_client.delete(*keys)
+        redis_client.zrem(index_key, *keys)
+    return {"status": "success", "message": f"Entradas eliminadas: {len(keys)}."}
+
+
+def get_cache_size():
+    return get_redis().zcard(make_key(INDEX_KEY))
@@ -1,8 +1,11 @@
 import frappe
-import requests
+from moodle_integration.scripts.moodle_api import moodle_request
+from moodle_integration.scripts.moodle_metrics import track_sync
+from moodle_integration.scripts.moodle_sync_run import track_progress, track_total
 from urllib.parse import unquote, urlparse
 
 @frappe.whitelist(allow_guest=True)
+@track_sync("sync_roles")
 def sync_roles(moodle_url):
     """
     Sincroniza roles desde una instancia de Moodle al Doctype Moodle User Role.
@@ -46,7 +49,7 @@ def sync_roles(moodle_url):
         }
 
         # Solicitar roles desde Moodle
-        response = requests.get(api_url, params=role_params, timeout=10)
+        response = moodle_request(moodle_instance["name"], api_url, role_params, timeout=10)
         if response.status_code != 200:
             logs.append(f"Error al consultar roles en Moodle: {response.status_code}")
             frappe.log_error("\n".join(logs), "Error en Sincronización de Roles")
@@ -54,6 +57,7 @@ def sync_roles(moodle_url):
 
         roles_data = response.json()
         logs.append(f"Roles obtenidos desde Moodle: {roles_data}")
+        track_total(len(roles_data))
 
         # Sincronizar roles en el Doctype Moodle User Role
         for role in roles_data:
@@ -65,6 +69,7 @@ def sync_roles(moodle_url):
             # Validar datos mínimos
             if not role_id or not role_shortname:
                 logs.append(f"Rol ignorado: ID {role_id} no tiene datos mínimos requeridos.")
+                track_progress(skipped=1)
                 continue
 
             # Verificar si el rol ya existe
@@ -87,6 +92,7 @@ def sync_roles(moodle_url):
 
             # Guardar cambios
             moodle_role.save(ignore_permissions=True)
+            track_progress(written=1)
 
         logs.append("Sincronización de roles completada con éxito.")
         frappe.log_error("\n".join(logs), "Sincronización de Roles Completada")
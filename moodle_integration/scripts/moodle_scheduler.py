@@ -0,0 +1,260 @@
+import frappe
+import json
+import time
+import uuid
+from moodle_integration.scripts.moodle_dead_letter import record_failed_event
+from moodle_integration.scripts.moodle_metrics import observe
+from moodle_integration.scripts.moodle_redis import decode, get_redis, make_key
+
+INSTANCES_KEY = "moodle_sched:instances"
+DEFICIT_KEY = "moodle_sched:deficit"
+PENDING_KEY = "moodle_sched:pending"
+DISPATCHER_JOB_ID = "moodle_scheduler_dispatch"
+# Tiempo máximo de un trabajo; pasado este tiempo su plaza se libera aunque el worker haya muerto
+JOB_TIMEOUT = 1800
+
+DEFAULT_QUEUE_WEIGHT = 1
+DEFAULT_WORKER_BUDGET = 2
+DEFAULT_WORKER_QUEUE = "default"
+DEFAULT_REALTIME_QUEUE = "short"
+DEFAULT_BULK_QUEUE = "long"
+SETTINGS_CACHE_TTL = 300
+
+# Carriles por orden de prioridad. Cada uno tiene su propia cola de RQ y sus propias plazas,
+# así los eventos ligeros no esperan detrás de las resincronizaciones pesadas
+LANES = ("realtime", "standard", "bulk")
+
+
+def _lane_suffix(lane):
+    # El carril standard conserva las claves anteriores a los carriles
+    return "" if lane == "standard" else f":{lane}"
+
+
+def _queue_key(moodle_instance_name, lane="standard"):
+    return make_key(f"moodle_sched:queue:{moodle_instance_name}{_lane_suffix(lane)}")
+
+
+def _inflight_key(moodle_instance_name, lane="standard"):
+    return make_key(f"moodle_sched:inflight:{moodle_instance_name}{_lane_suffix(lane)}")
+
+
+def _instances_key(lane):
+    return make_key(f"{INSTANCES_KEY}{_lane_suffix(lane)}")
+
+
+def _deficit_key(lane):
+    return make_key(f"{DEFICIT_KEY}{_lane_suffix(lane)}")
+
+
+def get_scheduling_settings(moodle_instance_name):
+    """
+    Configuración de colas de la Moodle Instance, cacheada unos minutos para no consultar
+    la base de datos en cada vuelta del dispatcher.
+    """
+    cache = frappe.cache()
+    cache_key = f"moodle_sched_settings:{moodle_instance_name}"
+    settings = cache.get_value(cache_key)
+    if settings:
+        return settings
+
+    values = frappe.db.get_value(
+        "Moodle Instance",
+        moodle_instance_name,
+        ["queue_weight", "worker_budget", "worker_queue", "realtime_queue", "bulk_queue"],
+        as_dict=True,
+    ) or {}
+    worker_queue = values.get("worker_queue") or DEFAULT_WORKER_QUEUE
+    settings = {
+        "queue_weight": values.get("queue_weight") or DEFAULT_QUEUE_WEIGHT,
+        "worker_budget": values.get("worker_budget") or DEFAULT_WORKER_BUDGET,
+        "worker_queue": worker_queue,
+        "lane_queues": {
+            "realtime": values.get("realtime_queue") or DEFAULT_REALTIME_QUEUE,
+            "standard": worker_queue,
+            "bulk": values.get("bulk_queue") or DEFAULT_BULK_QUEUE,
+        },
+        "lane_routes": dict(frappe.get_all(
+            "Moodle Instance Lane Route",
+            filters={"parent": moodle_instance_name, "parenttype": "Moodle Instance"},
+            fields=["route_action", "route_lane"],
+            as_list=True,
+        )),
+    }
+    cache.set_value(cache_key, settings, expires_in_sec=SETTINGS_CACHE_TTL)
+    return settings
+
+
+def clear_scheduling_settings(moodle_instance_name):
+    frappe.cache().delete_value(f"moodle_sched_settings:{moodle_instance_name}")
+
+
+def get_lane(settings, action):
+    """
+    Carril de una acción: el configurado en la instancia o, si no hay ruta, los borrados
+    (baratos) en realtime, las sincronizaciones de cursos, categorías y cohortes en bulk y el resto en standard.
+    """
+    if action in settings["lane_routes"]:
+        return settings["lane_routes"][action]
+    if action.startswith("delete_"):
+        return "realtime"
+    if action in ("create_course", "update_course") or action.endswith(("_category", "_cohort")):
+        return "bulk"
+    return "standard"
+
+
+def enqueue_instance_event(moodle_instance_name, action, entity_key, entity_id, payload=None):
+    """
+    Añade un evento a la cola de su carril en la instancia y despierta al dispatcher.
+    """
+    lane = get_lane(get_scheduling_settings(moodle_instance_name), action)
+    event = {
+        "action": action,
+        "entity_key": entity_key,
+        "entity_id": entity_id,
+        "payload": payload,
+        "lane": lane,
+        "queued_at": time.time(),
+    }
+    redis_client = get_redis()
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.rpush(_queue_key(moodle_instance_name, lane), json.dumps(event, default=str))
+    pipe.sadd(_instances_key(lane), moodle_instance_name)
+    pipe.execute()
+    kick()
+
+
+def kick():
+    """
+    Marca que hay trabajo pendiente y encola el dispatcher si no está ya en cola o corriendo.
+    También se ejecuta periódicamente para recuperar colas si un dispatcher se perdió.
+    """
+    get_redis().set(make_key(PENDING_KEY), 1)
+    frappe.enqueue(
+        "moodle_integration.scripts.moodle_scheduler.dispatch",
+        queue="short",
+        job_id=DISPATCHER_JOB_ID,
+        deduplicate=True,
+    )
+
+
+def dispatch():
+    """
+    Reparte los eventos de las colas de cada instancia a los workers de RQ con
+    Deficit Round Robin: en cada ronda una instancia gana tantos créditos como su
+    `queue_weight` y lanza un trabajo por crédito, sin superar nunca su `worker_budget`
+    de trabajos simultáneos. Así una instancia con miles de eventos no acapara los workers.
+    Cada carril se reparte por separado y en orden de prioridad, con su propio presupuesto.
+    """
+    redis_client = get_redis()
+    while True:
+        redis_client.delete(make_key(PENDING_KEY))
+        while any([_dispatch_round(redis_client, lane) for lane in LANES]):
+            pass
+        # Si llegaron eventos o terminaron trabajos mientras repartíamos, dar otra vuelta
+        if not redis_client.exists(make_key(PENDING_KEY)):
+            break
+
+
+def _dispatch_round(redis_client, lane):
+    dispatched = False
+    instances_key, deficit_key = _instances_key(lane), _deficit_key(lane)
+    instances = sorted(decode(name) for name in redis_client.smembers(instances_key))
+    now_ms = int(time.time() * 1000)
+
+    for moodle_instance_name in instances:
+        settings = get_scheduling_settings(moodle_instance_name)
+        queue_key, inflight_key = _queue_key(moodle_instance_name, lane), _inflight_key(moodle_instance_name, lane)
+        redis_client.zremrangebyscore(inflight_key, "-inf", now_ms)
+
+        deficit = float(redis_client.hget(deficit_key, moodle_instance_name) or 0)
+        deficit += settings["queue_weight"]
+
+        while deficit >= 1 and redis_client.zcard(inflight_key) < settings["worker_budget"]:
+            raw_event = redis_client.lpop(queue_key)
+            if raw_event is None:
+                break
+
+            lease_id = uuid.uuid4().hex
+            redis_client.zadd(inflight_key, {lease_id: now_ms + JOB_TIMEOUT * 1000})
+            frappe.enqueue(
+                "moodle_integration.scripts.moodle_scheduler.process_instance_event",
+                queue=settings["lane_queues"][lane],
+                timeout=JOB_TIMEOUT,
+                moodle_instance_name=moodle_instance_name,
+                event=json.loads(raw_event),
+                lease_id=lease_id,
+                lane=lane,
+            )
+            deficit -= 1
+            dispatched = True
+
+        if not redis_client.llen(queue_key):
+            # Una instancia sin cola no acumula créditos
+            deficit = 0
+            redis_client.srem(instances_key, moodle_instance_name)
+            if redis_client.llen(queue_key):
+                redis_client.sadd(instances_key, moodle_instance_name)
+
+        redis_client.hset(deficit_key, moodle_instance_name, min(deficit, settings["queue_weight"]))
+
+    return dispatched
+
+
+def process_instance_event(moodle_instance_name, event, lease_id, lane="standard"):
+    from moodle_integration.scripts.handle_moodle_data import run_moodle_action
+
+    try:
+        observe(
+            "moodle_scheduler_wait_seconds",
+            max(time.time() - event.get("queued_at", time.time()), 0),
+            {"instance": moodle_instance_name, "lane": lane},
+        )
+        moodle_instance = frappe.db.get_value(
+            "Moodle Instance", moodle_instance_name, ["name", "api_key", "site_url"], as_dict=True
+        )
+        if not moodle_instance:
+            # Instancia eliminada con eventos en cola: se descartan en vez de llenar los eventos fallidos
+            drop_instance_queues(moodle_instance_name)
+            return
+
+        response = run_moodle_action(moodle_instance, event["action"], event["entity_id"])
+
+        if response.get("status") == "error":
+            record_failed_event(
+                moodle_instance_name, event["action"], event["entity_key"], event["entity_id"],
+                payload=event.get("payload"), error=response.get("message"),
+            )
+    finally:
+        get_redis().zrem(_inflight_key(moodle_instance_name, lane), lease_id)
+        kick()
+
+
+def drop_instance_queues(moodle_instance_name):
+    """
+    Vacía las colas de una instancia en todos los carriles y la quita del reparto.
+    """
+    redis_client = get_redis()
+    pipe = redis_client.pipeline(transaction=False)
+    for lane in LANES:
+        pipe.delete(_queue_key(moodle_instance_name, lane))
+        pipe.srem(_instances_key(lane), moodle_instance_name)
+        pipe.hdel(_deficit_key(lane), moodle_instance_name)
+    pipe.execute()
+    clear_scheduling_settings(moodle_instance_name)
+
+
+def get_backlog_stats():
+    """
+    Eventos en cola y trabajos en curso por instancia y carril, para las métricas.
+    """
+    redis_client = get_redis()
+    stats = []
+    for moodle_instance_name in frappe.get_all("Moodle Instance", pluck="name"):
+        for lane in LANES:
+            stats.append((
+                moodle_instance_name,
+                lane,
+                redis_client.llen(_queue_key(moodle_instance_name, lane)),
+                redis_client.zcard(_inflight_key(moodle_instance_name, lane)),
+            ))
+    return stats
@@ -0,0 +1,138 @@
+import frappe
+import time
+from frappe.utils import add_to_date, now_datetime
+from moodle_integration.scripts.moodle_redis import decode, get_redis, make_key
+
+# Como mucho una actualización de progreso (Redis + realtime) por intervalo
+PROGRESS_INTERVAL = 1.0
+ACTIVE_RUNS_KEY = "moodle_sync_run:active"
+PROGRESS_TTL = 6 * 3600
+COUNTERS = ("total", "processed", "written", "skipped", "rest_calls", "rest_bytes")
+
+
+def get_active_sync_run():
+    return getattr(frappe.local, "moodle_sync_run", None)
+
+
+class SyncRunTracker:
+    """
+    Seguimiento de una sincronización: contadores, throughput y ETA.
+    Mientras corre, el progreso vive en Redis y se publica por realtime de forma limitada;
+    el Moodle Sync Run se inserta una sola vez al terminar.
+    """
+
+    def __init__(self, run_type, moodle_instance_name=None, entity_id=None):
+        self.name = frappe.generate_hash(length=10)
+        self.run_type = run_type
+        self.moodle_instance_name = moodle_instance_name
+        self.entity_id = entity_id
+        self.started = now_datetime()
+        self.start = time.monotonic()
+        self.last_flush = 0.0
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.redis = get_redis()
+        self.progress_key = make_key(f"moodle_sync_run:{self.name}")
+
+    def __enter__(self):
+        frappe.local.moodle_sync_run = self
+        self.redis.sadd(make_key(ACTIVE_RUNS_KEY), self.name)
+        self.flush(force=True)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        frappe.local.moodle_sync_run = None
+        self.redis.srem(make_key(ACTIVE_RUNS_KEY), self.name)
+        self.redis.delete(self.progress_key)
+
+    def add_total(self, count):
+        self.counters["total"] += count
+        self.flush()
+
+    def advance(self, written=0, skipped=0):
+        self.counters["processed"] += written + skipped
+        self.counters["written"] += written
+        self.counters["skipped"] += skipped
+        self.flush()
+
+    def record_rest(self, size):
+        self.counters["rest_calls"] += 1
+        self.counters["rest_bytes"] += size
+
+    def get_progress(self):
+        elapsed = time.monotonic() - self.start
+        processed, total = self.counters["processed"], self.counters["total"]
+        throughput = processed / elapsed if elapsed else 0
+        remaining = max(total - processed, 0)
+        return {
+            **self.counters,
+            "name": self.name,
+            "run_type": self.run_type,
+            "instance": self.moodle_instance_name,
+            "elapsed": round(elapsed, 2),
+            "throughput": round(throughput, 2),
+            "progress": round(processed * 100 / total, 1) if total else 0,
+            "eta_seconds": round(remaining / throughput, 1) if throughput and remaining else None,
+        }
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_flush < PROGRESS_INTERVAL:
+            return
+        self.last_flush = now
+
+        progress = self.get_progress()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(self.progress_key, mapping={k: str(v) for k, v in progress.items() if v is not None})
+        pipe.expire(self.progress_key, PROGRESS_TTL)
+        pipe.execute()
+        frappe.publish_realtime("moodle_sync_run_progress", progress, after_commit=False)
+
+    def finish(self, status, message=None, profile=None):
+        progress = self.get_progress()
+        run_doc = frappe.get_doc({
+            "doctype": "Moodle Sync Run",
+            "run_type": self.run_type,
+            "run_instance": self.moodle_instance_name,
+            "run_entity_id": self.entity_id,
+            "run_status": "Completado" if status == "success" else "Error",
+            "run_message": message,
+            "run_started": self.started,
+            "run_finished": add_to_date(self.started, seconds=progress["elapsed"]),
+            "run_duration": progress["elapsed"],
+            "run_total": self.counters["total"],
+            "run_processed": self.counters["processed"],
+            "run_written": self.counters["written"],
+            "run_skipped": self.counters["skipped"],
+            "run_rest_calls": self.counters["rest_calls"],
+            "run_rest_bytes": self.counters["rest_bytes"],
+            "run_throughput": progress["throughput"],
+            "run_profile": profile,
+        })
+        run_doc.insert(ignore_permissions=True, set_name=self.name)
+        return run_doc.name
+
+
+def track_total(count):
+    run = get_active_sync_run()
+    if run:
+        run.add_total(count)
+
+
+def track_progress(written=0, skipped=0):
+    run = get_active_sync_run()
+    if run:
+        run.advance(written=written, skipped=skipped)
+
+
+@frappe.whitelist()
+def get_active_sync_runs():
+    """
+    Progreso en vivo (desde Redis) de las sincronizaciones en curso.
+    """
+    redis_client = get_redis()
+    runs = []
+    for name in redis_client.smembers(make_key(ACTIVE_RUNS_KEY)):
+        progress = redis_client.hgetall(make_key(f"moodle_sync_run:{decode(name)}"))
+        if progress:
+            runs.append({decode(k): decode(v) for k, v in progress.items()})
+    return runs
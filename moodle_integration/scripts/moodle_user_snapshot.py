@@ -0,0 +1,112 @@
+import frappe
+import hashlib
+import json
+from moodle_integration.scripts.moodle_redis import decode, get_redis, make_key
+from moodle_integration.scripts.moodle_sync_run import get_active_sync_run
+
+# Vida de las instantáneas compartidas en Redis
+SNAPSHOT_TTL = 24 * 3600
+
+
+def get_fields_hash(fields):
+    return hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def _shared_key(moodle_instance_name):
+    return make_key(f"moodle_user_snapshot:{moodle_instance_name}")
+
+
+def clear_user_snapshot(moodle_instance_name, username):
+    get_redis().hdel(_shared_key(moodle_instance_name), username)
+
+
+def get_user_snapshot(moodle_instance_name):
+    """
+    Caché de usuarios de la sincronización en curso, de modo que un estudiante matriculado
+    en decenas de cursos se guarde una sola vez por sincronización. Si la instancia tiene
+    activado `share_user_snapshots` se comparte además en Redis entre sincronizaciones.
+    """
+    shared = bool(frappe.get_cached_value("Moodle Instance", moodle_instance_name, "share_user_snapshots"))
+    run = get_active_sync_run()
+    if not run:
+        return UserSnapshotCache(shared)
+    if not getattr(run, "user_snapshot", None):
+        run.user_snapshot = UserSnapshotCache(shared)
+    return run.user_snapshot
+
+
+class UserSnapshotCache:
+    """
+    (instancia, username) -> (nombre del Moodle User, hash de los últimos campos guardados).
+    """
+
+    def __init__(self, shared=False):
+        self.shared = shared
+        self.snapshots = {}
+
+    def get_snapshots(self, moodle_instance_name, usernames):
+        snapshots = {
+            username: self.snapshots[(moodle_instance_name, username)]
+            for username in usernames
+            if (moodle_instance_name, username) in self.snapshots
+        }
+        missing = [username for username in usernames if username not in snapshots]
+        if self.shared and missing:
+            values = get_redis().hmget(_shared_key(moodle_instance_name), missing)
+            for username, value in zip(missing, values):
+                if value:
+                    name, fields_hash = decode(value).rsplit("|", 1)
+                    snapshots[username] = self.snapshots[(moodle_instance_name, username)] = (name, fields_hash)
+        return snapshots
+
+    def save_users(self, moodle_instance_name, users):
+        """
+        Guarda los Moodle User ({username: campos}) cuyos campos cambiaron desde la última vez
+        y devuelve {username: nombre del Moodle User}. Los existentes se buscan con una sola consulta.
+        """
+        hashes = {username: get_fields_hash(fields) for username, fields in users.items()}
+        snapshots = self.get_snapshots(moodle_instance_name, list(users))
+
+        user_names = {
+            username: snapshots[username][0]
+            for username in users
+            if username in snapshots and snapshots[username][1] == hashes[username]
+        }
+        pending = [username for username in users if username not in user_names]
+        if not pending:
+            return user_names
+
+        existing = dict(frappe.get_all(
+            "Moodle User",
+            filters={"moodle_user_id": ["in", pending]},
+            fields=["moodle_user_id", "name"],
+            as_list=True,
+        ))
+        for username in pending:
+            user_doc = (
+                frappe.get_doc("Moodle User", existing[username])
+                if username in existing
+                else frappe.new_doc("Moodle User")
+            )
+            user_doc.update(users[username])
+            user_doc.save(ignore_permissions=True)
+            user_names[username] = user_doc.name
+            self.snapshots[(moodle_instance_name, username)] = (user_doc.name, hashes[username])
+
+        # Las instantáneas solo valen si los usuarios llegan a guardarse
+        saved = {username: f"{user_names[username]}|{hashes[username]}" for username in pending}
+        frappe.db.after_rollback.add(lambda: self.discard(moodle_instance_name, saved))
+        if self.shared:
+            frappe.db.after_commit.add(lambda: self.share(moodle_instance_name, saved))
+
+        return user_names
+
+    def discard(self, moodle_instance_name, saved):
+        for username in saved:
+            self.snapshots.pop((moodle_instance_name, username), None)
+
+    def share(self, moodle_instance_name, saved):
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.hset(_shared_key(moodle_instance_name), mapping=saved)
+        pipe.expire(_shared_key(moodle_instance_name), SNAPSHOT_TTL)
+        pipe.execute()
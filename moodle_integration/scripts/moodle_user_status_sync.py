@@ -1,18 +1,22 @@
 import frappe
-from urllib.parse import unquote, urlparse
-from datetime import datetime
+from frappe.utils import now_datetime
+from moodle_integration.scripts.moodle_connection_analytics import record_connection
+from moodle_integration.scripts.moodle_webhook_auth import authenticate_webhook
 
 @frappe.whitelist(allow_guest=True)
 def update_user_connection_status(user_id=None, moodle_url=None, action=None):
     """
     Actualiza el estado de conexión de un usuario de Moodle en Frappe.
-    Guarda la fecha y hora de la conexión en el campo `user_connection_status` del usuario en Moodle User.
+    Guarda la fecha y hora de la conexión en el campo `user_connection_status` del usuario en Moodle User
+    y la añade al historial de conexiones (Moodle Connection Event).
     """
     if not moodle_url or not user_id or action != "connect":
         return {"status": "error", "message": "Parámetros insuficientes o acción no permitida."}
 
-    # Procesar el dominio de la URL
-    domain = urlparse(unquote(moodle_url).rstrip("/")).netloc.replace("https://", "").replace("http://", "").strip("/")
+    # Rechazar tráfico no autenticado sin tocar la base de datos
+    moodle_instance_name = authenticate_webhook(moodle_url, "update_user_connection_status")
+    if not moodle_instance_name:
+        return {"status": "error", "message": "Webhook no autorizado."}
 
     # Buscar directamente los datos necesarios de Moodle Instance y Moodle User en una sola consulta
     moodle_user_data = frappe.db.sql("""
@@ -25,24 +29,19 @@ def update_user_connection_status(user_id=None, moodle_url=None, action=None):
         INNER JOIN 
             `tabMoodle Instance` mi ON mu.user_instance = mi.name
         WHERE 
-            mi.site_url LIKE %s
+            mi.name = %s
             AND mu.user_id = %s
-    """, (f"%{domain}%", user_id), as_dict=True)
+    """, (moodle_instance_name, user_id), as_dict=True)
 
     # Validar resultados de la consulta
     if not moodle_user_data:
-        return {"status": "error", "message": f"No se encontró una Moodle Instance o Usuario con user_id {user_id} y dominio {domain}."}
+        return {"status": "error", "message": f"No se encontró una Moodle Instance o Usuario con user_id {user_id} en {moodle_instance_name}."}
 
     moodle_user = moodle_user_data[0]  # Tomar el único resultado esperado
 
-    # Registrar la fecha y hora actuales en `user_connection_status`
-    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    # Registrar la fecha y hora actuales en `user_connection_status` y en el historial
+    now = now_datetime().replace(microsecond=0)
     frappe.db.set_value("Moodle User", moodle_user["user_name"], "user_connection_status", now)
-
-    # Log opcional para depuración
-    frappe.log_error(
-        f"Estado actualizado: {moodle_user['user_name']} a '{now}'.",
-        f"Estado de Usuario - {moodle_user['user_name']} (Conectado)"
-    )
+    record_connection(moodle_instance_name, moodle_user["user_name"], now)
 
     return {"status": "success", "message": f"Estado actualizado a '{now}' para {moodle_user['user_name']}."}
@@ -1,8 +1,11 @@
 import frappe
-import requests
+from moodle_integration.scripts.moodle_api import moodle_request
+from moodle_integration.scripts.moodle_metrics import track_sync
+from moodle_integration.scripts.moodle_sync_run import track_progress
 from datetime import datetime
 
 @frappe.whitelist(allow_guest=True)
+@track_sync("process_moodle_user")
 def process_moodle_user(moodle_instance_name, user_id, api_url, token, action):
     """
     Sincroniza un usuario de Moodle con ERPNext basado en su ID único de Moodle (user_id).
@@ -21,7 +24,7 @@ def process_moodle_user(moodle_instance_name, user_id, api_url, token, action):
         }
 
         logs.append(f"Consultando usuario en Moodle con parámetros: {user_params}")
-        response = requests.get(api_url, params=user_params, timeout=30)
+        response = moodle_request(moodle_instance_name, api_url, user_params)
 
         if response.status_code != 200:
             raise ValueError(f"Error en la consulta a Moodle: {response.text}")
@@ -89,6 +92,7 @@ def process_moodle_user(moodle_instance_name, user_id, api_url, token, action):
 
         # **Paso 8: Guardar el usuario en ERPNext**
         user_doc.save(ignore_permissions=True)
+        track_progress(written=1)
         logs.append(f"Datos guardados en ERPNext:\n    {user_doc.as_dict()}")
 
         return {"status": "success", "message": "Usuario sincronizado correctamente.", "logs": logs}
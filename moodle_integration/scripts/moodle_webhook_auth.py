@@ -0,0 +1,118 @@
+import frappe
+import hashlib
+import hmac
+import ipaddress
+import time
+from urllib.parse import unquote, urlparse
+from frappe.utils.password import get_decrypted_password
+from moodle_integration.scripts.moodle_metrics import inc
+
+AUTH_CACHE_KEY = "moodle_webhook_auth"
+# Segundos que cada worker conserva en memoria los datos de autenticación
+LOCAL_TTL = 60
+SIGNATURE_HEADER = "X-Moodle-Signature"
+
+# site -> {"expires": ..., "version": ..., "instances": {dominio: datos}}. Solo aquí, en la
+# memoria de cada worker, se guardan los secretos descifrados
+_local_cache = {}
+
+
+def get_domain(url):
+    """
+    Dominio de una URL de Moodle, con o sin esquema.
+    """
+    url = unquote(url or "").strip().rstrip("/")
+    if "://" not in url:
+        url = f"//{url}"
+    return urlparse(url).netloc.lower()
+
+
+def _load_instances():
+    # Lo que va a Redis no lleva secretos: dominios, redes permitidas y una versión que
+    # cambia cada vez que se recarga, para que los workers sepan cuándo releer los secretos
+    instances = {}
+    for instance in frappe.get_all("Moodle Instance", fields=["name", "site_url", "webhook_allowed_ips"]):
+        domain = get_domain(instance.site_url)
+        if not domain:
+            continue
+        instances[domain] = {
+            "name": instance.name,
+            "allowed_ips": [ip.strip() for ip in (instance.webhook_allowed_ips or "").splitlines() if ip.strip()],
+        }
+    return {"version": frappe.generate_hash(length=12), "instances": instances}
+
+
+def get_webhook_instances():
+    """
+    Instancias por dominio con su secreto y sus redes permitidas. Se leen de memoria; solo
+    cada LOCAL_TTL segundos se consulta la caché de Redis y, si no está, la base de datos.
+    Los secretos se descifran en cada worker y solo cuando cambia la versión de la caché.
+    """
+    site_cache = _local_cache.get(frappe.local.site)
+    if not site_cache or site_cache["expires"] < time.monotonic():
+        shared = frappe.cache().get_value(AUTH_CACHE_KEY, generator=_load_instances)
+        if "version" not in shared:
+            # Entrada con el formato anterior, que incluía los secretos: se sustituye
+            frappe.cache().delete_value(AUTH_CACHE_KEY)
+            shared = frappe.cache().get_value(AUTH_CACHE_KEY, generator=_load_instances)
+        if not site_cache or site_cache["version"] != shared["version"]:
+            instances = {
+                domain: {
+                    **instance,
+                    "secret": get_decrypted_password(
+                        "Moodle Instance", instance["name"], "webhook_secret", raise_exception=False
+                    ),
+                    "networks": [ipaddress.ip_network(ip, strict=False) for ip in instance["allowed_ips"]],
+                }
+                for domain, instance in shared["instances"].items()
+            }
+            site_cache = {"version": shared["version"], "instances": instances}
+        site_cache["expires"] = time.monotonic() + LOCAL_TTL
+        _local_cache[frappe.local.site] = site_cache
+    return site_cache["instances"]
+
+
+def clear_webhook_auth_cache():
+    frappe.cache().delete_value(AUTH_CACHE_KEY)
+    _local_cache.pop(frappe.local.site, None)
+
+
+def _ip_allowed(request_ip, networks):
+    try:
+        address = ipaddress.ip_address(request_ip)
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
+
+
+def _valid_signature(secret):
+    signature = (frappe.get_request_header(SIGNATURE_HEADER) or "").removeprefix("sha256=")
+    if not signature:
+        return False
+    payload = frappe.request.get_data() or frappe.request.query_string
+    expected = hmac.new(secret.encode(), payload, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(signature, expected)
+
+
+def authenticate_webhook(moodle_url, endpoint):
+    """
+    Comprueba que el webhook viene de una Moodle Instance conocida, desde una IP permitida
+    y con una firma válida, sin acceder a la base de datos. Devuelve el nombre de la
+    instancia o None si se rechaza (contabilizado en moodle_webhooks_rejected_total).
+    """
+    instance = get_webhook_instances().get(get_domain(moodle_url))
+
+    if not instance:
+        reason = "unknown_instance"
+    elif instance["networks"] and not _ip_allowed(frappe.local.request_ip, instance["networks"]):
+        reason = "ip"
+    elif instance["secret"] and not _valid_signature(instance["secret"]):
+        reason = "signature"
+    else:
+        # Solo un webhook firmado puede pedir el perfilado con su cabecera (ver moodle_profiler)
+        frappe.local.moodle_webhook_signed = bool(instance["secret"])
+        return instance["name"]
+
+    inc("moodle_webhooks_rejected_total", {"endpoint": endpoint, "reason": reason})
+    frappe.local.response.http_status_code = 403
+    return None
@@ -0,0 +1,133 @@
+# Copyright (c) 2026, xappiens and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from moodle_integration.scripts.moodle_anomaly import (
+	DETECTOR_TTL,
+	ERROR_BUCKET_SECONDS,
+	ERROR_BUCKETS,
+	ERROR_CLOSE_RATE,
+	ERROR_MIN_EVENTS,
+	ERROR_OPEN_RATE,
+	ERROR_RATE_LUA,
+	LATENCY_ALPHA,
+	LATENCY_CONSECUTIVE,
+	LATENCY_LUA,
+	LATENCY_MIN_SAMPLES,
+	LATENCY_MIN_SECONDS,
+	LATENCY_SIGMAS,
+	ROSTER_DROP,
+	ROSTER_LUA,
+	ROSTER_MIN_STUDENTS,
+	_run_detector,
+)
+from moodle_integration.scripts.moodle_redis import get_redis, make_key
+
+
+class TestMoodleAnomaly(FrappeTestCase):
+	def setUp(self):
+		self.subject = f"test-{frappe.generate_hash(length=10)}"
+
+	def tearDown(self):
+		for detector in ("error_rate", "latency", "roster"):
+			get_redis().delete(make_key(f"moodle_anomaly:{detector}:{self.subject}"))
+
+	def outcome(self, failed, now=1_000_000):
+		transition, rate, _ = _run_detector(
+			ERROR_RATE_LUA,
+			"error_rate",
+			(self.subject,),
+			[now, int(failed), ERROR_BUCKET_SECONDS, ERROR_BUCKETS, ERROR_MIN_EVENTS,
+			 ERROR_OPEN_RATE, ERROR_CLOSE_RATE, DETECTOR_TTL],
+		)[1:]
+		return transition, rate
+
+	def latency(self, seconds):
+		return _run_detector(
+			LATENCY_LUA,
+			"latency",
+			(self.subject,),
+			[seconds, LATENCY_ALPHA, LATENCY_MIN_SAMPLES, LATENCY_SIGMAS, LATENCY_MIN_SECONDS,
+			 LATENCY_CONSECUTIVE, DETECTOR_TTL],
+		)[1]
+
+	def roster(self, previous, current):
+		return _run_detector(
+			ROSTER_LUA, "roster", (self.subject,), [previous, current, ROSTER_DROP, ROSTER_MIN_STUDENTS, DETECTOR_TTL]
+		)[1]
+
+	def test_error_rate_opens_once_over_minimum_events(self):
+		transitions = [self.outcome(failed=True)[0] for _ in range(ERROR_MIN_EVENTS)]
+		# Con menos eventos que el mínimo no se abre, aunque todos fallen
+		self.assertEqual(transitions[:-1], [""] * (ERROR_MIN_EVENTS - 1))
+		self.assertEqual(transitions[-1], "open")
+		# Mientras sigue abierta no se repite la alerta
+		self.assertEqual(self.outcome(failed=True)[0], "")
+
+	def test_error_rate_resolves_below_close_rate(self):
+		for _ in range(ERROR_MIN_EVENTS):
+			self.outcome(failed=True)
+
+		transitions = []
+		for _ in range(ERROR_MIN_EVENTS * 10):
+			transition, rate = self.outcome(failed=False)
+			transitions.append(transition)
+			if transition:
+				break
+		self.assertEqual(transitions[-1], "resolve")
+		self.assertLessEqual(rate, ERROR_CLOSE_RATE)
+
+	def test_error_rate_forgets_buckets_outside_window(self):
+		for _ in range(ERROR_MIN_EVENTS):
+			self.outcome(failed=True)
+
+		# Pasada la ventana completa solo cuenta el evento nuevo
+		later = 1_000_000 + ERROR_BUCKET_SECONDS * ERROR_BUCKETS
+		self.assertEqual(self.outcome(failed=False, now=later), ("resolve", 0.0))
+
+	def test_latency_opens_on_sustained_step(self):
+		for i in range(200):
+			self.assertEqual(self.latency(0.3 + (i % 5) * 0.1), "")
+
+		# Un salto sostenido no debe subir su propio umbral antes de abrir la incidencia
+		transitions = [self.latency(30) for _ in range(LATENCY_CONSECUTIVE)]
+		self.assertEqual(transitions, [""] * (LATENCY_CONSECUTIVE - 1) + ["open"])
+
+	def test_latency_ignores_isolated_spikes(self):
+		for i in range(200):
+			self.latency(0.3 + (i % 5) * 0.1)
+
+		for _ in range(5):
+			for _ in range(LATENCY_CONSECUTIVE - 1):
+				self.assertEqual(self.latency(30), "")
+			self.assertEqual(self.latency(0.5), "")
+
+	def test_latency_needs_minimum_samples_and_seconds(self):
+		# Sin línea base suficiente no hay picos
+		for _ in range(LATENCY_MIN_SAMPLES - 1):
+			self.assertEqual(self.latency(0.01), "")
+		for _ in range(LATENCY_MIN_SAMPLES):
+			self.latency(0.01)
+		# Un pico por debajo de LATENCY_MIN_SECONDS tampoco es una incidencia
+		for _ in range(LATENCY_CONSECUTIVE * 2):
+			self.assertEqual(self.latency(LATENCY_MIN_SECONDS / 2), "")
+
+	def test_latency_resolves_after_normal_samples(self):
+		for i in range(200):
+			self.latency(0.3 + (i % 5) * 0.1)
+		for _ in range(LATENCY_CONSECUTIVE):
+			self.latency(30)
+
+		transitions = [self.latency(0.5) for _ in range(LATENCY_CONSECUTIVE)]
+		self.assertEqual(transitions, [""] * (LATENCY_CONSECUTIVE - 1) + ["resolve"])
+
+	def test_roster_drop(self):
+		# Cursos pequeños no abren incidencia
+		self.assertEqual(self.roster(ROSTER_MIN_STUDENTS - 1, 0), "")
+		self.assertEqual(self.roster(40, 30), "")
+		self.assertEqual(self.roster(40, 10), "open")
+		# Se resuelve al recuperar la línea base, no la sincronización anterior
+		self.assertEqual(self.roster(10, 15), "")
+		self.assertEqual(self.roster(15, 20), "resolve")
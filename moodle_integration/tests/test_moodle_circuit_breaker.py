@@ -0,0 +1,67 @@
+# Copyright (c) 2026, xappiens and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from moodle_integration.scripts.moodle_circuit_breaker import (
+	FAILURE_THRESHOLD,
+	MoodleCircuitBreaker,
+	MoodleCircuitOpen,
+)
+
+
+class TestMoodleCircuitBreaker(FrappeTestCase):
+	def setUp(self):
+		patcher = patch("frappe.log_error")
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.breaker = MoodleCircuitBreaker(f"test-{frappe.generate_hash(length=10)}")
+
+	def tearDown(self):
+		self.breaker.reset()
+
+	def trip(self):
+		for _ in range(FAILURE_THRESHOLD):
+			self.breaker.before_request()
+			self.breaker.record_failure()
+
+	def test_opens_after_threshold(self):
+		for _ in range(FAILURE_THRESHOLD - 1):
+			self.breaker.record_failure()
+		self.breaker.before_request()
+
+		self.breaker.record_failure()
+		self.assertTrue(self.breaker.is_open())
+		with self.assertRaises(MoodleCircuitOpen):
+			self.breaker.before_request()
+
+	def test_success_resets_failures(self):
+		for _ in range(FAILURE_THRESHOLD - 1):
+			self.breaker.record_failure()
+		self.breaker.record_success()
+		self.breaker.record_failure()
+		self.assertFalse(self.breaker.is_open())
+
+	def test_half_open_allows_single_probe(self):
+		self.trip()
+		# Simula que ha pasado OPEN_SECONDS
+		self.breaker.redis.delete(self.breaker.open_key)
+
+		self.breaker.before_request()
+		with self.assertRaises(MoodleCircuitOpen):
+			self.breaker.before_request()
+
+		self.breaker.record_success()
+		self.breaker.before_request()
+		self.breaker.before_request()
+
+	def test_failed_probe_reopens(self):
+		self.trip()
+		self.breaker.redis.delete(self.breaker.open_key)
+
+		self.breaker.before_request()
+		self.breaker.record_failure()
+		self.assertTrue(self.breaker.is_open())
@@ -0,0 +1,61 @@
+# Copyright (c) 2026, xappiens and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from moodle_integration.scripts.moodle_entity_lock import EntityLock
+
+
+class TestMoodleEntityLock(FrappeTestCase):
+	def setUp(self):
+		self.instance = f"test-{frappe.generate_hash(length=10)}"
+		self.owner = self.make_lock()
+		self.other = self.make_lock()
+
+	def tearDown(self):
+		self.owner.redis.delete(self.owner.lock_key, self.owner.dirty_key)
+
+	def make_lock(self):
+		return EntityLock(self.instance, "course_id", 42)
+
+	def test_single_owner(self):
+		self.assertTrue(self.owner.acquire("update_course"))
+		self.assertIsNone(self.owner.release())
+		self.assertTrue(self.other.acquire("update_course"))
+		self.assertFalse(self.owner.acquire("update_course"))
+
+	def test_contended_action_is_returned_to_owner(self):
+		self.owner.acquire("update_course")
+		self.other.acquire("update_course")
+		# Se guarda la última acción recibida
+		self.other.acquire("delete_course")
+
+		self.assertEqual(self.owner.release(), "delete_course")
+		self.assertFalse(self.owner.redis.exists(self.owner.lock_key))
+
+	def test_keep_if_dirty_holds_lock_until_clean(self):
+		self.owner.acquire("update_course")
+		self.other.acquire("update_course")
+
+		self.assertEqual(self.owner.release(keep_if_dirty=True), "update_course")
+		self.assertFalse(self.make_lock().acquire("update_course"))
+
+		# La acción que acaba de marcarse se recoge en la siguiente vuelta
+		self.assertEqual(self.owner.release(keep_if_dirty=True), "update_course")
+		self.assertIsNone(self.owner.release(keep_if_dirty=True))
+		self.assertTrue(self.other.acquire("update_course"))
+
+	def test_release_by_non_owner(self):
+		self.owner.acquire("update_course")
+		self.other.acquire("update_course")
+
+		self.assertIsNone(self.other.release())
+		self.assertTrue(self.owner.redis.exists(self.owner.lock_key))
+		self.assertEqual(self.owner.release(), "update_course")
+
+	def test_locks_are_per_entity(self):
+		other_course = EntityLock(self.instance, "course_id", 43)
+		self.owner.acquire("update_course")
+		self.assertTrue(other_course.acquire("update_course"))
+		self.assertIsNone(other_course.release())
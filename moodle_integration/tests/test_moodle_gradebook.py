@@ -0,0 +1,81 @@
+# Copyright (c) 2026, xappiens and Contributors
+# See license.txt
+
+import numpy as np
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from moodle_integration.scripts.moodle_gradebook import HISTOGRAM_BINS, compute_gradebook
+
+
+def make_item(name, max_grade, weight, min_grade=0):
+	return frappe._dict(
+		name=name,
+		grade_item_name=name.title(),
+		grade_item_min_grade=min_grade,
+		grade_item_max_grade=max_grade,
+		grade_item_weight=weight,
+	)
+
+
+class TestMoodleGradebook(FrappeTestCase):
+	def setUp(self):
+		self.students = ["ana", "luis", "marta", "pablo"]
+		self.items = [make_item("examen", 10, 1), make_item("proyecto", 20, 3)]
+		self.matrix = np.array([
+			[10, 20],
+			[5, np.nan],
+			[np.nan, np.nan],
+			[0, 10],
+		])
+
+	def test_weighted_totals_ignore_ungraded_items(self):
+		gradebook = compute_gradebook(self.students, self.items, self.matrix)
+
+		# luis solo tiene el examen: su total se calcula sobre lo calificado
+		self.assertEqual(gradebook["totals"], [100.0, 50.0, None, 37.5])
+		self.assertEqual(gradebook["matrix"][1], [5.0, None])
+		self.assertEqual(gradebook["percentile_ranks"], [100.0, 66.7, None, 33.3])
+		self.assertEqual(gradebook["total_percentiles"][50], 50.0)
+
+	def test_at_risk(self):
+		gradebook = compute_gradebook(self.students, self.items, self.matrix)
+
+		self.assertEqual(gradebook["at_risk"], [
+			{"student": "luis", "low_total": False, "missing_grades": True},
+			{"student": "marta", "low_total": True, "missing_grades": True},
+			{"student": "pablo", "low_total": True, "missing_grades": False},
+		])
+
+	def test_item_stats(self):
+		examen, proyecto = compute_gradebook(self.students, self.items, self.matrix)["item_stats"]
+
+		self.assertEqual(examen["graded"], 3)
+		self.assertEqual(examen["mean"], 5.0)
+		self.assertEqual(examen["percentiles"][50], 5.0)
+		# La nota máxima cae en el último intervalo
+		expected = [0] * HISTOGRAM_BINS
+		expected[0] = expected[HISTOGRAM_BINS // 2] = expected[-1] = 1
+		self.assertEqual(examen["histogram"], expected)
+		self.assertEqual(proyecto["graded"], 2)
+		self.assertEqual(proyecto["mean"], 15.0)
+
+	def test_grades_are_normalized_to_item_range(self):
+		items = [make_item("practica", 10, 1, min_grade=5), make_item("test", 100, 1)]
+		gradebook = compute_gradebook(["ana"], items, np.array([[7.5, 50]]))
+		self.assertEqual(gradebook["totals"], [50.0])
+
+	def test_without_weights_items_weigh_the_same(self):
+		items = [make_item("examen", 10, 0), make_item("proyecto", 20, 0)]
+		gradebook = compute_gradebook(["ana"], items, np.array([[10, 0]]))
+
+		self.assertEqual([item["weight"] for item in gradebook["items"]], [1.0, 1.0])
+		self.assertEqual(gradebook["totals"], [50.0])
+
+	def test_empty_course(self):
+		gradebook = compute_gradebook([], [], np.empty((0, 0)))
+
+		self.assertEqual(gradebook["totals"], [])
+		self.assertEqual(gradebook["item_stats"], [])
+		self.assertEqual(gradebook["at_risk"], [])
@@ -0,0 +1,57 @@
+# Copyright (c) 2026, xappiens and Contributors
+# See license.txt
+
+import time
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from moodle_integration.scripts.moodle_idempotency import (
+	IDEMPOTENCY_TTL,
+	claim_event,
+	get_idempotency_key,
+	release_event,
+)
+
+
+class TestMoodleIdempotency(FrappeTestCase):
+	def setUp(self):
+		self.key = f"https://moodle.test|{frappe.generate_hash(length=10)}"
+
+	def tearDown(self):
+		release_event(self.key)
+
+	def test_get_idempotency_key(self):
+		request_data = {"moodle_url": "https://moodle.test", "action": "update_course", "timecreated": 1700000000}
+		with patch("frappe.get_request_header", return_value=None):
+			self.assertEqual(
+				get_idempotency_key(request_data, 7), "https://moodle.test|update_course|7|1700000000"
+			)
+			self.assertEqual(
+				get_idempotency_key({**request_data, "event_id": "abc"}, 7), "https://moodle.test|abc"
+			)
+			# Sin identificador ni marca de tiempo no se puede reconocer un reintento
+			self.assertIsNone(get_idempotency_key({"moodle_url": "https://moodle.test", "action": "update_course"}, 7))
+
+		with patch("frappe.get_request_header", return_value="header-key"):
+			self.assertEqual(get_idempotency_key(request_data, 7), "https://moodle.test|header-key")
+
+	def test_claim_once(self):
+		self.assertTrue(claim_event(self.key))
+		self.assertFalse(claim_event(self.key))
+		self.assertTrue(claim_event(f"{self.key}-other"))
+		release_event(f"{self.key}-other")
+
+	def test_release_allows_retry(self):
+		claim_event(self.key)
+		release_event(self.key)
+		self.assertTrue(claim_event(self.key))
+
+	def test_duplicate_across_window_boundary(self):
+		window_end = (int(time.time() // IDEMPOTENCY_TTL) + 1) * IDEMPOTENCY_TTL - 1
+		with patch("time.time", return_value=window_end):
+			self.assertTrue(claim_event(self.key))
+		# Un reintento justo después del cambio de ventana sigue siendo un duplicado
+		with patch("time.time", return_value=window_end + 2):
+			self.assertFalse(claim_event(self.key))
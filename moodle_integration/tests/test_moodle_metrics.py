@@ -0,0 +1,64 @@
+# Copyright (c) 2026, xappiens and Contributors
+# See license.txt
+
+from unittest.mock import MagicMock, patch
+
+from frappe.tests.utils import FrappeTestCase
+
+from moodle_integration.scripts import moodle_metrics
+from moodle_integration.scripts.moodle_metrics import (
+	_format_labels,
+	_format_value,
+	_metric_key,
+	_render_histogram,
+	render_metrics,
+)
+
+
+class TestMoodleMetrics(FrappeTestCase):
+	def test_format_value(self):
+		# Sin redondeo: un contador grande debe seguir creciendo entre scrapes
+		self.assertEqual(_format_value(b"1234567"), "1234567")
+		self.assertEqual(_format_value(1234568.0), "1234568")
+		self.assertEqual(_format_value("0.25"), "0.25")
+		self.assertEqual(_format_value(12345.678901), "12345.678901")
+		self.assertEqual(_format_value(0), "0")
+
+	def test_format_labels(self):
+		self.assertEqual(_format_labels(None), "")
+		self.assertEqual(_format_labels({"b": 1, "a": 'x"y\\z\n'}), 'a="x\\"y\\\\z\\n",b="1"')
+
+	def test_histogram_buckets_are_cumulative(self):
+		label_str = _format_labels({"handler": "course"})
+		fields = {
+			f"{label_str}|0.5": b"2",
+			f"{label_str}|5": b"1",
+			f"{label_str}|+Inf": b"1",
+			f"{label_str}|sum": b"1000003.5",
+			f"{label_str}|count": b"4",
+		}
+		lines = []
+		_render_histogram("moodle_sync_duration_seconds", fields, lines)
+
+		self.assertIn('moodle_sync_duration_seconds_bucket{handler="course",le="0.1"} 0', lines)
+		self.assertIn('moodle_sync_duration_seconds_bucket{handler="course",le="0.5"} 2', lines)
+		self.assertIn('moodle_sync_duration_seconds_bucket{handler="course",le="2.5"} 2', lines)
+		self.assertIn('moodle_sync_duration_seconds_bucket{handler="course",le="5"} 3', lines)
+		self.assertIn('moodle_sync_duration_seconds_bucket{handler="course",le="+Inf"} 4', lines)
+		self.assertIn('moodle_sync_duration_seconds_sum{handler="course"} 1000003.5', lines)
+		self.assertIn('moodle_sync_duration_seconds_count{handler="course"} 4', lines)
+
+	def test_render_counters(self):
+		label_str = _format_labels({"action": "update_course"})
+		hashes = {_metric_key("moodle_webhooks_received_total"): {label_str.encode(): b"98765432"}}
+		redis_client = MagicMock()
+		redis_client.hgetall.side_effect = lambda key: hashes.get(key, {})
+
+		with patch.object(moodle_metrics, "get_redis", return_value=redis_client), patch.object(
+			moodle_metrics, "_collect_gauges"
+		):
+			output = render_metrics()
+
+		self.assertIn("# TYPE moodle_webhooks_received_total counter\n", output)
+		self.assertIn('moodle_webhooks_received_total{action="update_course"} 98765432\n', output)
+		self.assertTrue(output.endswith("\n"))
@@ -0,0 +1,62 @@
+# Copyright (c) 2026, xappiens and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from moodle_integration.scripts import moodle_rate_limiter
+from moodle_integration.scripts.moodle_rate_limiter import MoodleRateLimiter, MoodleRateLimitTimeout
+
+
+class TestMoodleRateLimiter(FrappeTestCase):
+	def setUp(self):
+		self.limits = {"max_concurrent_requests": 4, "max_requests_per_second": 2, "target_latency_ms": 1000}
+		patcher = patch.object(moodle_rate_limiter, "get_instance_limits", return_value=self.limits)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.limiter = MoodleRateLimiter(f"test-{frappe.generate_hash(length=10)}")
+
+	def tearDown(self):
+		limiter = self.limiter
+		limiter.redis.delete(limiter.bucket_key, limiter.inflight_key, limiter.limit_key, limiter.backoff_key)
+
+	def test_token_bucket(self):
+		# El bucket empieza lleno (tantos tokens como peticiones por segundo)
+		self.assertEqual(self.limiter._take_token(), 0)
+		self.assertEqual(self.limiter._take_token(), 0)
+		wait_ms = self.limiter._take_token()
+		self.assertGreater(wait_ms, 0)
+		self.assertLessEqual(wait_ms, 500)
+
+	def test_additive_increase_multiplicative_decrease(self):
+		self.assertEqual(self.limiter.record_response(5000), 2)
+		# Como mucho una reducción por ventana, aunque lleguen varias respuestas lentas
+		self.assertEqual(self.limiter.record_response(5000), 2)
+		self.assertEqual(self.limiter.record_response(100), 2.5)
+		self.limiter.redis.delete(self.limiter.backoff_key)
+		self.assertEqual(self.limiter.record_response(100, failed=True), 1.25)
+
+	def test_limit_never_exceeds_configured_maximum(self):
+		for _ in range(20):
+			limit = self.limiter.record_response(100)
+		self.assertEqual(limit, self.limits["max_concurrent_requests"])
+
+	def test_slots_follow_adaptive_limit(self):
+		self.limiter.record_response(5000)
+		self.assertTrue(self.limiter._try_acquire_slot("a"))
+		self.assertTrue(self.limiter._try_acquire_slot("b"))
+		self.assertFalse(self.limiter._try_acquire_slot("c"))
+
+		self.limiter._release_slot("a")
+		self.assertTrue(self.limiter._try_acquire_slot("c"))
+
+	def test_slot_timeout(self):
+		self.limiter.redis.set(self.limiter.limit_key, 1)
+		with self.limiter.slot():
+			with self.assertRaises(MoodleRateLimitTimeout):
+				with self.limiter.slot(acquire_timeout=0.05):
+					pass
+		# Al salir del bloque la plaza queda libre
+		self.assertEqual(self.limiter.redis.zcard(self.limiter.inflight_key), 0)
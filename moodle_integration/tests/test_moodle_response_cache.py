@@ -0,0 +1,69 @@
+# Copyright (c) 2026, xappiens and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from moodle_integration.scripts import moodle_response_cache
+from moodle_integration.scripts.moodle_response_cache import (
+	MAX_RESPONSE_BYTES,
+	clear_moodle_cache,
+	get_cached_response,
+	get_invalidation_tags,
+	get_tags,
+	invalidate_moodle_cache,
+	set_cached_response,
+)
+
+
+def group_params(course_id, token="secret"):
+	return {"wstoken": token, "wsfunction": "core_group_get_course_groups", "courseid": course_id}
+
+
+class TestMoodleResponseCache(FrappeTestCase):
+	def setUp(self):
+		self.instance = f"test-{frappe.generate_hash(length=10)}"
+		for patcher in (patch.object(moodle_response_cache, "inc"), patch("frappe.only_for")):
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	def tearDown(self):
+		clear_moodle_cache(self.instance)
+		invalidate_moodle_cache(self.instance, ["course:2", "course:3", "categories", "roles"])
+
+	def test_get_tags(self):
+		self.assertEqual(get_tags(group_params(7)), ["course:7"])
+		self.assertEqual(get_tags({"wsfunction": "core_course_get_categories"}), ["categories"])
+		self.assertEqual(get_tags({"wsfunction": "core_course_get_courses"}), [])
+
+	def test_get_invalidation_tags(self):
+		self.assertEqual(get_invalidation_tags("update_course", {"course_id": 5}), ["course:5"])
+		self.assertEqual(get_invalidation_tags("create_group", {"courseid": 5}), ["course:5"])
+		self.assertEqual(get_invalidation_tags("delete_group", {}), [])
+		self.assertEqual(get_invalidation_tags("update_category", {}), ["categories"])
+		self.assertEqual(get_invalidation_tags("assign_role", {}), ["roles"])
+		# Las matriculaciones no invalidan los grupos del curso
+		self.assertEqual(get_invalidation_tags("enrol_user", {"course_id": 5}), [])
+
+	def test_cache_roundtrip_ignores_token(self):
+		set_cached_response(self.instance, group_params(2), b"[]")
+		self.assertEqual(get_cached_response(self.instance, group_params(2, token="other")), b"[]")
+		self.assertIsNone(get_cached_response(self.instance, group_params(3)))
+
+	def test_only_cacheable_functions(self):
+		params = {"wsfunction": "core_enrol_get_enrolled_users", "courseid": 2}
+		set_cached_response(self.instance, params, b"[]")
+		self.assertIsNone(get_cached_response(self.instance, params))
+
+		set_cached_response(self.instance, group_params(3), b"x" * (MAX_RESPONSE_BYTES + 1))
+		self.assertIsNone(get_cached_response(self.instance, group_params(3)))
+
+	def test_invalidate_by_tag(self):
+		set_cached_response(self.instance, group_params(2), b"[2]")
+		set_cached_response(self.instance, group_params(3), b"[3]")
+
+		invalidate_moodle_cache(self.instance, get_invalidation_tags("update_group", {"courseid": 2}))
+		self.assertIsNone(get_cached_response(self.instance, group_params(2)))
+		self.assertEqual(get_cached_response(self.instance, group_params(3)), b"[3]")
@@ -0,0 +1,145 @@
+# Copyright (c) 2026, xappiens and Contributors
+# See license.txt
+
+from collections import Counter
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from moodle_integration.scripts import moodle_scheduler
+from moodle_integration.scripts.moodle_redis import get_redis, make_key
+from moodle_integration.scripts.moodle_scheduler import (
+	LANES,
+	_dispatch_round,
+	_inflight_key,
+	_queue_key,
+	drop_instance_queues,
+	enqueue_instance_event,
+	get_lane,
+)
+
+
+def make_settings(queue_weight=1, worker_budget=10, lane_routes=None):
+	return {
+		"queue_weight": queue_weight,
+		"worker_budget": worker_budget,
+		"worker_queue": "default",
+		"lane_queues": {"realtime": "short", "standard": "default", "bulk": "long"},
+		"lane_routes": lane_routes or {},
+	}
+
+
+class TestMoodleScheduler(FrappeTestCase):
+	def setUp(self):
+		self.redis = get_redis()
+		self.prefix = f"test-{frappe.generate_hash(length=10)}"
+		self.settings = {}
+
+		# Conjuntos de instancias y créditos propios del test, para no repartir eventos de otras instancias
+		scope = f"moodle_sched_test:{self.prefix}"
+		for patcher in (
+			patch.object(moodle_scheduler, "_instances_key", lambda lane: make_key(f"{scope}:instances:{lane}")),
+			patch.object(moodle_scheduler, "_deficit_key", lambda lane: make_key(f"{scope}:deficit:{lane}")),
+			patch.object(moodle_scheduler, "get_scheduling_settings", lambda name: self.settings[name]),
+			patch.object(moodle_scheduler, "clear_scheduling_settings"),
+			patch.object(moodle_scheduler, "kick"),
+			patch("frappe.enqueue"),
+		):
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	def tearDown(self):
+		for name in self.settings:
+			drop_instance_queues(name)
+			for lane in LANES:
+				self.redis.delete(_inflight_key(name, lane))
+		for lane in LANES:
+			self.redis.delete(moodle_scheduler._instances_key(lane), moodle_scheduler._deficit_key(lane))
+
+	def add_instance(self, suffix, events, action="create_user", **settings):
+		name = f"{self.prefix}-{suffix}"
+		self.settings[name] = make_settings(**settings)
+		for i in range(events):
+			enqueue_instance_event(name, action, "user_id", i)
+		return name
+
+	def dispatched(self):
+		return Counter(call.kwargs["moodle_instance_name"] for call in frappe.enqueue.call_args_list)
+
+	def test_round_dispatches_by_weight(self):
+		light = self.add_instance("light", 10, queue_weight=1)
+		heavy = self.add_instance("heavy", 10, queue_weight=3)
+
+		self.assertTrue(_dispatch_round(self.redis, "standard"))
+		self.assertEqual(self.dispatched(), {light: 1, heavy: 3})
+
+		_dispatch_round(self.redis, "standard")
+		self.assertEqual(self.dispatched(), {light: 2, heavy: 6})
+
+	def test_fractional_weight_accumulates_deficit(self):
+		slow = self.add_instance("slow", 5, queue_weight=0.5)
+
+		_dispatch_round(self.redis, "standard")
+		self.assertEqual(self.dispatched()[slow], 0)
+		_dispatch_round(self.redis, "standard")
+		self.assertEqual(self.dispatched()[slow], 1)
+
+	def test_worker_budget_caps_inflight_jobs(self):
+		name = self.add_instance("busy", 10, queue_weight=5, worker_budget=2)
+
+		_dispatch_round(self.redis, "standard")
+		self.assertEqual(self.dispatched()[name], 2)
+		self.assertFalse(_dispatch_round(self.redis, "standard"))
+
+		# Al terminar un trabajo su plaza queda libre para el siguiente evento
+		lease_id = frappe.enqueue.call_args.kwargs["lease_id"]
+		self.redis.zrem(_inflight_key(name, "standard"), lease_id)
+		self.assertTrue(_dispatch_round(self.redis, "standard"))
+		self.assertEqual(self.dispatched()[name], 3)
+
+	def test_events_keep_order(self):
+		self.add_instance("ordered", 3, queue_weight=3)
+
+		_dispatch_round(self.redis, "standard")
+		self.assertEqual([call.kwargs["event"]["entity_id"] for call in frappe.enqueue.call_args_list], [0, 1, 2])
+
+	def test_empty_instance_leaves_rotation(self):
+		name = self.add_instance("idle", 1, queue_weight=2)
+
+		_dispatch_round(self.redis, "standard")
+		self.assertFalse(self.redis.sismember(moodle_scheduler._instances_key("standard"), name))
+		# Sin cola no acumula créditos para la próxima ráfaga
+		self.assertEqual(float(self.redis.hget(moodle_scheduler._deficit_key("standard"), name)), 0)
+
+	def test_drop_instance_queues(self):
+		name = self.add_instance("deleted", 3)
+
+		drop_instance_queues(name)
+		self.assertEqual(self.redis.llen(_queue_key(name)), 0)
+		self.assertFalse(_dispatch_round(self.redis, "standard"))
+
+	def test_get_lane(self):
+		settings = make_settings(lane_routes={"update_course": "standard"})
+		self.assertEqual(get_lane(settings, "delete_user"), "realtime")
+		self.assertEqual(get_lane(settings, "create_course"), "bulk")
+		self.assertEqual(get_lane(settings, "update_category"), "bulk")
+		self.assertEqual(get_lane(settings, "enrol_user"), "standard")
+		# La ruta configurada en la instancia manda sobre la regla por defecto
+		self.assertEqual(get_lane(settings, "update_course"), "standard")
+
+	def test_lanes_dispatch_separately(self):
+		name = self.add_instance("lanes", 2, action="create_course", worker_budget=1)
+		for i in range(2):
+			enqueue_instance_event(name, "delete_user", "user_id", i)
+
+		self.assertEqual(self.redis.llen(_queue_key(name, "bulk")), 2)
+		self.assertEqual(self.redis.llen(_queue_key(name, "realtime")), 2)
+
+		# Cada carril tiene su propio presupuesto y su propia cola de RQ
+		_dispatch_round(self.redis, "bulk")
+		_dispatch_round(self.redis, "realtime")
+		self.assertEqual(
+			[(call.kwargs["lane"], call.kwargs["queue"]) for call in frappe.enqueue.call_args_list],
+			[("bulk", "long"), ("realtime", "short")],
+		)